@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Report the database file size, build time and query times for each ``--db`` size.
+
+The databases are rebuilt on every run (downloading the GeoNames files if needed) into
+the working directory given by ``--dir``. Each is copied into a v1 (pre schema version)
+layout alongside, and the searches and zone counts both layouts can answer are timed on
+each.
+
+    $ python benchmarks/bench_schema.py --dir .dev/bench
+"""
+
+import argparse
+import sqlite3
+import time
+import timeit
+from pathlib import Path
+
+from when import db as dbm
+from when.cli import DBSizeAction
+from when.db import client
+
+# Cities per zone of the country with the most populous city
+ZONES_QUERY = """
+SELECT tz_id, COUNT(*) FROM city_data
+WHERE co_id = (SELECT co_id FROM city_data ORDER BY pop DESC LIMIT 1)
+GROUP BY tz_id
+"""
+
+
+# City and alias tables as they were before schema versions, as in the tests' v1_db
+V1_SCHEMA = """
+CREATE TABLE city (id INTEGER PRIMARY KEY, name, ascii, co, sub, tz, pop);
+CREATE TABLE alias (alias TEXT PRIMARY KEY, city_id INTEGER);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+V1_SEARCH_QUERY = """
+SELECT c.id, c.name, c.ascii, c.sub, c.co, c.tz FROM city c
+WHERE c.id = :value OR c.name LIKE :like OR c.ascii LIKE :like
+"""
+
+V1_XSEARCH_QUERY = """
+SELECT c.id, c.name, c.ascii, c.sub, c.co, c.tz FROM city c
+WHERE c.id = :value OR UPPER(c.name) = :value OR UPPER(c.ascii) = :value
+"""
+
+V1_ZONES_QUERY = """
+SELECT tz, COUNT(*) FROM city
+WHERE co = (SELECT co FROM city ORDER BY pop DESC LIMIT 1)
+GROUP BY tz
+"""
+
+# name: (v1 SQL, v1 params, search value, exact); zones has no search value
+SCHEMA_QUERIES = {
+    "search": (V1_SEARCH_QUERY, {"value": "PARIS", "like": "%PARIS%"}, "PARIS", False),
+    "exact": (V1_XSEARCH_QUERY, {"value": "PARIS"}, "PARIS", True),
+    "prefix": (V1_SEARCH_QUERY, {"value": "SAN", "like": "%SAN%"}, "SAN", False),
+    "zones": (V1_ZONES_QUERY, {}, None, False),
+}
+
+
+def create_v1(db, filename):
+    filename.unlink(missing_ok=True)
+    with db.connection() as con:
+        rows = con.execute("SELECT id, name, ascii, co, sub, tz, pop FROM city").fetchall()
+
+    con = sqlite3.connect(filename)
+    con.executescript(V1_SCHEMA)
+    con.executemany("INSERT INTO city VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+
+
+def timed(con, sql, params, number):
+    con.execute(sql, params).fetchall()
+    elapsed = timeit.timeit(lambda: con.execute(sql, params).fetchall(), number=number)
+    return elapsed / number * 1000
+
+
+def compare_schemas(db, v1_filename, number):
+    v1 = sqlite3.connect(v1_filename)
+    with db.connection() as con:
+        for name, (v1_sql, v1_params, value, exact) in SCHEMA_QUERIES.items():
+            v2_sql, v2_params = db.search_query(con, value, exact) if value else (ZONES_QUERY, {})
+            v1_ms = timed(v1, v1_sql, v1_params, number)
+            v2_ms = timed(con, v2_sql, v2_params, number)
+            print(f"    {name:8} v1 {v1_ms:8.3f}ms  v2 {v2_ms:8.3f}ms")
+
+    v1.close()
+
+
+def zones(db):
+    with db.connection() as con:
+        tzs = db.lookups(con)[2]
+        return [(tzs[tz], count) for tz, count in db._execute(con, ZONES_QUERY, {})]
+
+
+QUERIES = {
+    "search": lambda db: db.search("paris"),
+    "exact": lambda db: db.search("paris", exact=True),
+    "prefix": lambda db: db.search("san"),
+    "ranked": lambda db: db.search("san", limit=5, order="population", by_zone=True),
+    "fuzzy": lambda db: db.search("pittsbrg", fuzzy=True),
+    "many": lambda db: db.search_many(["paris", "berlin", "san", "tokyo", "lima"] * 20),
+    "near": lambda db: db.nearest(40.7, -74.0, 5),
+    "zones": zones,
+}
+
+
+def bench(dirname, label, size, pop, number):
+    filename = dirname / f"when-{size}.db"
+    db = client.DB(filename)
+    start = time.perf_counter()
+    dbm.create(db, size, pop, remove_existing=True, dirname=dirname)
+    built = time.perf_counter() - start
+    print(f"[{label}] {filename.name}: {db.size:,} bytes, built in {built:.1f}s")
+    v1_filename = filename.with_suffix(".v1.db")
+    create_v1(db, v1_filename)
+    print(f"    v1 {v1_filename.name}: {v1_filename.stat().st_size:,} bytes")
+    compare_schemas(db, v1_filename, number)
+    print("    v2 only:")
+    for name, query in QUERIES.items():
+        query(db)
+        elapsed = timeit.timeit(lambda q=query: q(db), number=number) / number
+        print(f"    {name:8} {elapsed * 1000:8.3f}ms")
+
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dir", type=Path, default=Path.cwd())
+    parser.add_argument("--number", type=int, default=50)
+    parser.add_argument("--pop", type=int, default=0)
+    args = parser.parse_args()
+    args.dir.mkdir(parents=True, exist_ok=True)
+
+    for label, _, size, _ in DBSizeAction.city_file_sizes:
+        bench(args.dir, label, size, args.pop, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Compare FTS5, LIKE, fuzzy (trigram) and in-memory index city searches against the ``xl`` and ``sm`` GeoNames builds.
+
+The databases are built (downloading the GeoNames files if needed) into the working
+directory given by ``--dir`` and reused on later runs.
+
+    $ python benchmarks/bench_search.py --dir .dev/bench
+"""
+
+import argparse
+import timeit
+from pathlib import Path
+
+from when import db as dbm
+from when.db import client, index
+
+SIZES = {"xl": 500, "sm": 15_000}
+QUERIES = [
+    "paris",
+    "new york",
+    "san",
+    "honolulu",
+    "maastricht",
+    "springfield, us",
+    "pittsburg",
+    "dusseldorf",
+    "zzz",
+]
+
+
+def get_db(dirname, size, pop):
+    filename = dirname / f"when-{size}.db"
+    if not filename.exists():
+        dbm.create(client.DB(filename), size, pop, dirname=dirname)
+
+    return filename
+
+
+def bench(filename, number):
+    fts_db = client.DB(filename)
+    like_db = client.DB(filename, fts=False)
+    city_index = index.CityIndex(filename)
+    city_index.search(QUERIES[0])  # warm up: load or build the columns
+    engines = {
+        "fts": fts_db.search,
+        "like": like_db.search,
+        "fuzzy": lambda value: fts_db.search(value, fuzzy=True),
+        "index": city_index.search,
+    }
+    for query in QUERIES:
+        row = [f"{query!r:20}"]
+        for name, search in engines.items():
+            count = len(search(query))
+            elapsed = timeit.timeit(lambda s=search, q=query: s(q), number=number) / number
+            row.append(f"{name}: {elapsed * 1000:8.3f}ms ({count:4} rows)")
+
+        print("  ".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dir", type=Path, default=Path.cwd())
+    parser.add_argument("--number", type=int, default=20)
+    parser.add_argument("--pop", type=int, default=0)
+    args = parser.parse_args()
+    args.dir.mkdir(parents=True, exist_ok=True)
+
+    for label, size in SIZES.items():
+        filename = get_db(args.dir, size, args.pop)
+        print(f"[{label}] {filename} ({filename.stat().st_size:,} bytes)")
+        bench(filename, args.number)
+
+
+if __name__ == "__main__":
+    main()
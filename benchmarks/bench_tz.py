@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Compare the throughput of ``--all`` conversions (a timestamp converted to every zone), with
+and without formatting the results, for each timezone backend, and of converting many
+timestamps with a compiled ``ZoneTable`` against ``tzinfo`` calls.
+
+    $ python benchmarks/bench_tz.py --number 20
+"""
+
+import argparse
+import timeit
+from datetime import datetime
+
+from when import transitions, utils
+from when.config import Settings
+from when.core import When
+from when.db import client
+
+TIMESTAMP = "Jul 10, 2023 4:30am"
+
+
+def bench(backend, db, number):
+    settings = Settings()
+    settings.data["timezones"] = {"backend": backend}
+    when = When(settings, db=db)
+    formatter = when.formatter()
+    targets = utils.all_zones()
+
+    def convert():
+        return when.results(TIMESTAMP, targets=targets)
+
+    def format():
+        return [formatter(result) for result in convert()]
+
+    count = len(format())  # warm up: resolve and cache the zones
+    for label, func in [("convert", convert), ("format", format)]:
+        elapsed = timeit.timeit(func, number=number) / number
+        print(
+            f"{backend:10} {label:8} {elapsed * 1000:8.3f}ms for {count} zones "
+            f"({count / elapsed:,.0f} conversions/s)"
+        )
+
+
+def bench_table(backend, number, zone="America/New_York", count=10_000):
+    tz = utils.gettz(zone, utils.tz_backend(backend))
+    table = transitions.compile_zone(tz)
+    epochs = [1_600_000_000 + i * 7919 for i in range(count)]
+    local = [dt.replace(tzinfo=None) for dt in table.to_local(epochs)]
+    for label, direct, compiled in [
+        (
+            "to_local",
+            lambda: [datetime.fromtimestamp(epoch, tz) for epoch in epochs],
+            lambda: table.to_local(epochs),
+        ),
+        (
+            "to_utc",
+            lambda: [dt.replace(tzinfo=tz).timestamp() for dt in local],
+            lambda: table.to_utc(local),
+        ),
+    ]:
+        before, after = (timeit.timeit(func, number=number) / number for func in (direct, compiled))
+        print(
+            f"{backend:10} {label:8} {before * 1000:8.3f}ms => {after * 1000:8.3f}ms "
+            f"for {count:,} timestamps"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default=client.DB_FILENAME)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    db = client.DB(args.db)
+    for backend in utils.TZ_BACKENDS:
+        bench(backend, db, args.number)
+
+    for backend in utils.TZ_BACKENDS:
+        bench_table(backend, args.number)
+
+
+if __name__ == "__main__":
+    main()
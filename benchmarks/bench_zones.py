@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Time ``When()`` construction and the first lookup of a city, zone name, glob and
+abbreviation, each in a fresh interpreter so that nothing is loaded or cached yet, then
+the same lookups again once warm.
+
+    $ python benchmarks/bench_zones.py --db .dev/bench/when-500.db
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import timeit
+from pathlib import Path
+
+from when.core import When
+from when.db import client
+
+QUERIES = ["paris", "Europe/Paris", "europe/*", "KST"]
+
+FIRST_LOOKUP = """
+import time
+from when.core import When
+from when.db import client
+
+db = client.DB({filename!r})
+start = time.perf_counter()
+when = When(db=db)
+built = time.perf_counter()
+when.find_zones({query!r})
+print(built - start, time.perf_counter() - built)
+"""
+
+
+def first_lookup(filename, query, number):
+    script = FIRST_LOOKUP.format(filename=str(filename), query=query)
+    runs = [
+        [float(t) for t in subprocess.check_output([sys.executable, "-c", script]).split()]
+        for _ in range(number)
+    ]
+    return [statistics.median(times) for times in zip(*runs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", type=Path, default=client.DB_FILENAME)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"[cold] median of {args.number} fresh interpreters")
+    for query in QUERIES:
+        construct, lookup = first_lookup(args.db, query, args.number)
+        print(f"{query!r:16} When(): {construct * 1000:8.3f}ms  first: {lookup * 1000:8.3f}ms")
+
+    print("[warm]")
+    db = client.DB(args.db)
+    elapsed = timeit.timeit(lambda: When(db=db), number=args.number) / args.number
+    print(f"{'When()':16} {elapsed * 1000:8.3f}ms")
+    when = When(db=db, cache_size=0)
+    for query in QUERIES:
+        elapsed = timeit.timeit(lambda q=query: when.find_zones(q), number=args.number)
+        elapsed /= args.number
+        print(f"{query!r:16} {elapsed * 1000:8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
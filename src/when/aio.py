@@ -0,0 +1,125 @@
+"""
+Asyncio facade for ``When``, for use inside an event loop.
+
+DB searches and timestamp parsing block, so ``AsyncWhen`` runs them on a bounded pool of
+threads (each with its own read-only DB connection), resolving the sources and targets of
+a call concurrently.
+"""
+
+import asyncio
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from . import utils
+from .core import When
+
+DEFAULT_WORKERS = 4
+
+
+class AsyncWhen:
+    """
+    Wrap a ``When`` (by default, a new one) with coroutine versions of its lookups. At most
+    ``max_workers`` lookups run at once, unless an ``executor`` is given; other calls wait
+    their turn without blocking the event loop. Results are in the same order as the
+    ``When`` methods they mirror.
+
+        async with AsyncWhen() as when:
+            results = await when.results("noon", sources=["paris"], targets=["seoul"])
+    """
+
+    def __init__(self, when=None, max_workers=DEFAULT_WORKERS, executor=None):
+        self.when = when or When()
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers, thread_name_prefix="when")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def find_zones(
+        self, objs, exact=False, fuzzy=False, limit=None, order=None, by_zone=False
+    ):
+        return await self._run(self.when.find_zones, objs, exact, fuzzy, limit, order, by_zone)
+
+    async def complete(self, prefix, limit=10):
+        return await self._run(self.when.complete, prefix, limit)
+
+    async def zones_at(self, points):
+        return await self._run(self.when.zones_at, points)
+
+    async def zone_at(self, lat, lng):
+        return (await self.zones_at([(lat, lng)]))[0]
+
+    async def convert(
+        self,
+        timestr,
+        sources=None,
+        targets=None,
+        offset=None,
+        exact=False,
+        fuzzy=False,
+        limit=None,
+        order=None,
+        by_zone=False,
+    ):
+        search = (exact, fuzzy, limit, order, by_zone)
+
+        async def find(objs):
+            return await self.find_zones(objs, *search) if objs else None
+
+        source_zones, target_zones = await asyncio.gather(find(sources), find(targets))
+        return await self._run(self.when.convert_zones, timestr, source_zones, target_zones, offset)
+
+    async def results(
+        self,
+        timestamp="",
+        sources=None,
+        targets=None,
+        offset=None,
+        exact=False,
+        fuzzy=False,
+        limit=None,
+        order=None,
+        by_zone=False,
+    ):
+        return await self.convert(
+            utils.parse_source_input(timestamp),
+            sources,
+            targets,
+            offset,
+            exact,
+            fuzzy,
+            limit,
+            order,
+            by_zone,
+        )
+
+    async def as_json(
+        self,
+        timestamp="",
+        sources=None,
+        targets=None,
+        offset=None,
+        exact=False,
+        fuzzy=False,
+        limit=None,
+        order=None,
+        by_zone=False,
+        **json_kwargs,
+    ):
+        converts = await self.results(
+            timestamp, sources, targets, offset, exact, fuzzy, limit, order, by_zone
+        )
+        settings = self.when.settings
+        return json.dumps([convert.to_dict(settings) for convert in converts], **json_kwargs)
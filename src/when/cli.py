@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import argparse
 import sys
+import time
 import logging
 from pathlib import Path
 
@@ -35,6 +36,27 @@ class DBSizeAction(argparse.Action):
         return ", ".join(f"'{a}' ('{b}')" for a, b, *c in cls.city_file_sizes)
 
 
+def coordinates(value):
+    try:
+        lat, lng = (float(v) for v in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected LAT,LNG, got {value!r}")
+
+    return lat, lng
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer, got {value!r}")
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected at least 1, got {number}")
+
+    return number
+
+
 def get_parser(settings):
     parser = argparse.ArgumentParser(
         description="Convert times to and from time zones or cities",
@@ -86,6 +108,15 @@ def get_parser(settings):
         """,
     )
 
+    parser.add_argument(
+        "--complete",
+        metavar="PREFIX",
+        help="""
+            Show the city names, aliases, zone names and abbreviations starting with PREFIX
+            (the last part, if comma delimited), most populous first, for shell completion
+        """,
+    )
+
     default_format = settings["formats"]["named"]["default"]
     parser.add_argument(
         "-f",
@@ -159,6 +190,22 @@ def get_parser(settings):
         help="Force an existing database to be overwritten",
     )
 
+    parser.add_argument(
+        "--db-update",
+        type=Path,
+        dest="db_update",
+        metavar="DIR",
+        help="Apply the GeoNames daily modifications-* and deletes-* files in DIR to the database",
+    )
+
+    parser.add_argument(
+        "--db-migrate",
+        action="store_true",
+        default=False,
+        dest="db_migrate",
+        help="Rebuild a database made with an older schema in the current one, keeping its aliases",
+    )
+
     parser.add_argument(
         "--search",
         action="store_true",
@@ -175,6 +222,52 @@ def get_parser(settings):
         help="DB searches must be exact",
     )
 
+    parser.add_argument(
+        "--fuzzy",
+        action="store_true",
+        default=False,
+        dest="db_fuzzy",
+        help="DB searches are typo-tolerant, showing the closest matches by name and population",
+    )
+
+    parser.add_argument(
+        "--limit",
+        type=positive_int,
+        dest="db_limit",
+        help="Show at most this many cities for each city search",
+    )
+
+    parser.add_argument(
+        "--order",
+        choices=["population"],
+        dest="db_order",
+        help="Sort city search results, most populous first",
+    )
+
+    parser.add_argument(
+        "--by-zone",
+        action="store_true",
+        default=False,
+        dest="db_by_zone",
+        help="Show only the most populous matching city of each timezone",
+    )
+
+    parser.add_argument(
+        "--near",
+        type=coordinates,
+        dest="db_near",
+        metavar="LAT,LNG",
+        help="Show the city nearest to the given coordinates (use --near=LAT,LNG if LAT < 0)",
+    )
+
+    parser.add_argument(
+        "--db-profile",
+        action="store_true",
+        default=False,
+        dest="db_profile",
+        help="Report the DB queries run, with their timings and query plans, to stderr",
+    )
+
     parser.add_argument(
         "--alias", type=int, dest="db_alias", help="Create a new alias from the city id"
     )
@@ -187,6 +280,63 @@ def get_parser(settings):
         help="Show all DB aliases",
     )
 
+    parser.add_argument(
+        "--alias-import",
+        type=Path,
+        dest="db_alias_import",
+        metavar="FILE",
+        help="Import aliases from a CSV or NDJSON (.ndjson, .jsonl) file of alias, city_id "
+        "and lang records in a single transaction; - reads stdin",
+    )
+
+    parser.add_argument(
+        "--alias-conflict",
+        choices=["replace", "ignore", "fail"],
+        default="replace",
+        dest="db_conflict",
+        help="For --alias-import, what to do with an alias that already exists, "
+        "default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--alias-export",
+        type=Path,
+        dest="db_alias_export",
+        metavar="FILE",
+        help="Export all DB aliases to a CSV or NDJSON file, for --alias-import; - is stdout",
+    )
+
+    parser.add_argument(
+        "--db-dump",
+        type=Path,
+        dest="db_dump",
+        metavar="FILE",
+        help="Export all DB cities to a CSV or NDJSON file; - is stdout",
+    )
+
+    parser.add_argument(
+        "--db-alt-names",
+        action="store_true",
+        default=False,
+        dest="db_alt_names",
+        help="Import GeoNames alternate names (downloading alternateNamesV2.zip) as DB aliases",
+    )
+
+    parser.add_argument(
+        "--db-alt-names-file",
+        type=Path,
+        dest="db_alt_names_file",
+        metavar="FILE",
+        help="Import alternate names as DB aliases from a local alternateNamesV2 .zip or .txt",
+    )
+
+    parser.add_argument(
+        "--db-langs",
+        default=",".join(db.make.ALT_NAME_LANGUAGES),
+        dest="db_langs",
+        help="Comma-separated languages of alternate names to import, default: %(default)s",
+    )
+
     parser.add_argument(
         "--population",
         default=10_000,
@@ -282,7 +432,8 @@ def main(sys_args, when=None, settings=None):
         return core.holidays(settings, args.holidays, args.timestr[0] if args.timestr else None)
 
     if args.tz_alias:
-        for tz, name in timezones.zones.get(args.timestr[0] if args.timestr else ""):
+        backend = utils.tz_backend(settings["timezones"]["backend"])
+        for tz, name in timezones.zones.get(args.timestr[0] if args.timestr else "", backend):
             print(f"{name:.<40}{tz}")
 
         return 0
@@ -294,7 +445,36 @@ def main(sys_args, when=None, settings=None):
         return 0
 
     when = when or core.When(settings)
-    db_triggers = ("db_size", "db_search", "db_alias")
+    if args.complete is not None:
+        head, comma, prefix = args.complete.rpartition(",")
+        for completion in when.complete(prefix, limit=args.db_limit or 10):
+            print(f"{head}{comma}{completion.text}")
+
+        return 0
+
+    if not args.db_profile:
+        return run(when, args, settings)
+
+    with when.db.profile() as profiler:
+        start = time.perf_counter()
+        result = run(when, args, settings)
+        elapsed = time.perf_counter() - start
+
+    print(profiler.report(elapsed), file=sys.stderr)
+    return result
+
+
+def run(when, args, settings):
+    db_triggers = (
+        "db_size",
+        "db_update",
+        "db_migrate",
+        "db_search",
+        "db_near",
+        "db_alias",
+        "db_alt_names",
+        "db_dump",
+    )
     if any(a for a in vars(args) if a.startswith(db_triggers) and getattr(args, a)):
         return db.db_main(when.db, args)
 
@@ -308,6 +488,10 @@ def main(sys_args, when=None, settings=None):
                 indent=2,
                 offset=args.offset,
                 exact=args.db_exact,
+                fuzzy=args.db_fuzzy,
+                limit=args.db_limit,
+                order=args.db_order,
+                by_zone=args.db_by_zone,
             )
         )
         return 0
@@ -320,6 +504,10 @@ def main(sys_args, when=None, settings=None):
             sources=args.source,
             offset=args.offset,
             exact=args.db_exact,
+            fuzzy=args.db_fuzzy,
+            limit=args.db_limit,
+            order=args.db_order,
+            by_zone=args.db_by_zone,
         )
     except exceptions.UnknownSourceError as e:
         print(e, file=sys.stderr)
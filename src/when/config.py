@@ -102,6 +102,8 @@ from pathlib import Path
 
 import toml
 
+from . import utils
+
 FORMAT_SPECIFIERS = [
     ["%a", "Abbreviated weekday name", "Thu", "*"],
     ["%A", "Full weekday name", "Thursday", "*"],
@@ -159,6 +161,7 @@ FORMAT_SPECIFIERS = [
 ]
 
 DEFAULT_FORMAT = os.getenv("WHENFORMAT", "%F %T%z (%Z%!Z) %jd%Ww %!C[%!l]")
+DEFAULT_TZ_BACKEND = utils.DEFAULT_TZ_BACKEND
 DEFAULT_TOML = f"""[calendar]
 months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
@@ -219,6 +222,10 @@ C = "({{}})"
 
 [formats.source]
 grouped = " ↳ @"
+
+[timezones]
+# dateutil, or zoneinfo for the standard library's (faster) zones
+backend = "{DEFAULT_TZ_BACKEND}"
 """
 
 
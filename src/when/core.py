@@ -1,4 +1,3 @@
-import fnmatch
 import json
 import re
 from datetime import date, datetime, timedelta
@@ -7,11 +6,12 @@ from itertools import chain
 from dateutil import rrule
 from dateutil.easter import easter
 
-from . import exceptions, timezones, utils, config
-from .db import client
+from . import exceptions, timezones, transitions, utils, config
+from .db import client, index
 from .lunar import lunar_phase
 
 logger = utils.logger()
+DEFAULT_CACHE_SIZE = 1024
 
 
 def holidays(settings, co="US", ts=None):
@@ -248,52 +248,185 @@ class Result:
     def convert(self, tz):
         return Result(self.dt.astimezone(tz.tz), tz, self)
 
+    @classmethod
+    def convert_all(cls, sources, zones, backend=None):
+        """
+        ``[source.convert(zone) for source in sources for zone in zones]``, converting every
+        source to each zone in one go through its compiled transitions
+        """
+        if isinstance(backend, utils.ZoneInfoBackend):
+            # ``ZoneInfo`` converts in C, faster than the epochs the tables need
+            return [source.convert(zone) for source in sources for zone in zones]
+
+        epochs = [source.dt.timestamp() for source in sources]
+        converted = [transitions.to_local(zone.tz, epochs) for zone in zones]
+        return [
+            # ``astimezone`` leaves a datetime already in the target zone as it is
+            cls(source.dt if source.dt.tzinfo is zone.tz else dts[i], zone, source)
+            for i, source in enumerate(sources)
+            for zone, dts in zip(zones, converted)
+        ]
+
     def __repr__(self):
         return f"<Result(dt={self.dt}, zone={self.zone}, offset={self.offset})>"
 
 
 class When:
-    def __init__(self, settings=None, local_zone=None, db=None):
+    def __init__(self, settings=None, local_zone=None, db=None, cache_size=DEFAULT_CACHE_SIZE):
         self.settings = settings or config.Settings()
+        self.tz_backend = utils.tz_backend(self.settings["timezones"]["backend"])
         self.db = db or client.DB()
-        self.tz_dict = {z: z for z in utils.all_zones()}
-        for key in list(self.tz_dict):
-            self.tz_dict[key.lower()] = self.tz_dict[key]
-
-        self.tz_keys = list(self.tz_dict)
-        self.local_zone = local_zone or TimeZoneDetail()
+        self.local_zone = local_zone or TimeZoneDetail(utils.gettz(backend=self.tz_backend))
+        self.cache = utils.LRUCache(cache_size)
+        self._cache_generation = self.db.generation
+        self._completions = None
 
     def formatter(self, format="default", delta=None):
         return Formatter(self.settings, format=format, delta=delta)
 
+    @property
+    def tz_dict(self):
+        return timezones.zone_index().lookup
+
+    @property
+    def tz_keys(self):
+        return timezones.zone_index().keys
+
+    def gettz(self, name):
+        # ``TimeZoneDetail`` would take a missing zone for the local one
+        tz = utils.gettz(name, self.tz_backend)
+        if tz is None:
+            raise exceptions.WhenError(f"No timezone data for {name}")
+
+        return tz
+
     def get_tz(self, name):
         value = self.tz_dict[name]
-        return (utils.gettz(value), name)
+        return (self.gettz(value), name)
 
-    def find_zones(self, objs, exact=False):
-        if isinstance(objs, str):
-            objs = [objs]
+    def db_zone(self, name, city=None):
+        # Zone names from the DB are canonical already, so they need no zone index lookup
+        return TimeZoneDetail(self.gettz(name), name, city)
 
-        tzs = {}
-        for o in objs:
-            matches = fnmatch.filter(self.tz_keys, o)
-            if matches:
-                for m in matches:
-                    tz, name = self.get_tz(m)
-                    if name not in tzs:
-                        tzs.setdefault(name, []).append(TimeZoneDetail(tz, name))
+    def cache_info(self):
+        return self.cache.cache_info()
 
-            for tz, name in timezones.zones.get(o):
-                tzs.setdefault(name, []).append(TimeZoneDetail(tz, name))
+    def _check_generation(self):
+        # Cached lookups and completions are stale once the DB has been written to; the
+        # completion snapshot is older than the DB then, so ``load_columns`` rebuilds it
+        if self._cache_generation != self.db.generation:
+            self.cache.clear()
+            self._completions = None
+            self._cache_generation = self.db.generation
+
+    @property
+    def completion_snapshot(self):
+        return self.db.filename.with_suffix(index.COMPLETION_SUFFIX)
+
+    def completion_entries(self):
+        """
+        (text, kind, population, keys) entries for the ``PrefixIndex`` of ``complete``: DB
+        city names and aliases, zone names (also keyed by their last part, e.g. ``NEW_YORK``)
+        and zone abbreviations, ranked by the population of their most populous city
+        """
+        try:
+            for name, key, pop, kind in self.db.completions():
+                yield name, kind, pop, [key]
+
+            pops = self.db.zone_populations()
+        except exceptions.DBError as err:
+            logger.debug("Completing zones only: %s", err)
+            pops = {}
+
+        for zone in utils.all_zones():
+            keys = [client.normalize(zone), client.normalize(zone.rpartition("/")[2])]
+            yield zone, "zone", pops.get(zone, 0), keys
+
+        for abbr, zones in timezones.ALIASES.items():
+            pop = max(pops.get(value, 0) if isinstance(value, str) else 0 for value, _ in zones)
+            yield abbr, "abbr", pop, [client.normalize(abbr)]
+
+    def complete(self, prefix, limit=10):
+        """
+        Up to ``limit`` ``Completion``s of city names, aliases, zone names and abbreviations
+        starting with ``prefix``, most populous first. The index they come from is loaded
+        on first use from a snapshot next to the DB, which is rebuilt once the DB changes.
+        """
+        self._check_generation()
+        if self._completions is None:
+            files = [self.db.filename, self.db.user_filename]
+            self._completions = index.PrefixIndex(
+                index.load_columns(
+                    self.completion_snapshot,
+                    files,
+                    lambda: index.PrefixIndex.build_columns(self.completion_entries()),
+                )
+            )
+
+        return self._completions.complete(prefix, limit)
+
+    def zones_for_country(self, co, sub=None):
+        """
+        The zones of the cities in country ``co`` (and subdivision ``sub``), starting with
+        the zone of the most populous city
+        """
+        try:
+            names = self.db.zones_in(co, sub)
+        except exceptions.DBError as err:
+            raise exceptions.WhenError("Missing DB", str(err))
+
+        return [self.db_zone(name) for name in names]
+
+    def lookup_zones(self, obj, cities):
+        """
+        The zone name, abbreviation and city ``TimeZoneDetail`` matches for ``obj``, given
+        the ``cities`` found for it, or the zones of a ``co:CC[,subdivision]`` expression
+        """
+        if country := client.parse_country(obj):
+            return self.zones_for_country(*country), [], []
 
+        names = [TimeZoneDetail(*self.get_tz(m)) for m in timezones.zone_index().find(obj)]
+        abbrs = [TimeZoneDetail(tz, name) for tz, name in timezones.zones.get(obj, self.tz_backend)]
+        found = [self.db_zone(c.tz, c) for c in cities]
+        return names, abbrs, found
+
+    def find_zones(self, objs, exact=False, fuzzy=False, limit=None, order=None, by_zone=False):
+        """
+        Resolve zone names, abbreviations, city search expressions and ``co:`` country
+        expressions to ``TimeZoneDetail`` instances. Each expression's matches, including
+        none at all, are cached until the DB is next written to.
+        """
+        if isinstance(objs, str):
+            objs = [objs]
+
+        self._check_generation()
+        search = (exact, fuzzy, limit, order, by_zone)
+        matches = {o: self.cache.get((o, *search)) for o in objs}
+        missing = [o for o, match in matches.items() if match is None]
+        if missing:
             try:
-                results = self.db.search(o, exact)
+                found = self.db.search_many(
+                    [o for o in missing if not client.parse_country(o)], *search
+                )
             except exceptions.DBError as err:
                 raise exceptions.WhenError("Missing DB", str(err))
 
-            for c in results:
-                tz, name = self.get_tz(c.tz)
-                tzs.setdefault(None, []).append(TimeZoneDetail(tz, name, c))
+            for o in missing:
+                matches[o] = self.lookup_zones(o, found.get(o, []))
+                self.cache.put((o, *search), matches[o])
+
+        tzs = {}
+        for o in objs:
+            names, abbrs, cities = matches[o]
+            for detail in names:
+                if detail.name not in tzs:
+                    tzs.setdefault(detail.name, []).append(detail)
+
+            for detail in abbrs:
+                tzs.setdefault(detail.name, []).append(detail)
+
+            if cities:
+                tzs.setdefault(None, []).extend(cities)
 
         zones = list(chain.from_iterable(tzs.values()))
         if not zones:
@@ -303,7 +436,42 @@ class When:
 
         return zones
 
-    def convert(self, timestr, sources=None, targets=None, offset=None, exact=False):
+    def zones_at(self, points):
+        """
+        For each (lat, lng) in ``points``, the ``TimeZoneDetail`` of the nearest city in the
+        DB, or ``None`` if there is none
+        """
+        try:
+            found = self.db.nearest_many(points)
+        except exceptions.DBError as err:
+            raise exceptions.WhenError("Missing DB", str(err))
+
+        zones = []
+        for nearest in found:
+            zone = None
+            if nearest:
+                city, _ = nearest[0]
+                zone = self.db_zone(city.tz, city)
+
+            zones.append(zone)
+
+        return zones
+
+    def zone_at(self, lat, lng):
+        return self.zones_at([(lat, lng)])[0]
+
+    def convert(
+        self,
+        timestr,
+        sources=None,
+        targets=None,
+        offset=None,
+        exact=False,
+        fuzzy=False,
+        limit=None,
+        order=None,
+        by_zone=False,
+    ):
         """
         +================================================================+
         |                  Without a given timestr                       |
@@ -333,35 +501,77 @@ class When:
         +----------+----------+------------------------------------------+
         """
         logger.debug("GOT ts %s, targets %s, sources: %s", timestr or '""', targets, sources)
-        local = self.local_zone
-        if not any([timestr, sources, targets]):
-            return [Result(local.now(), local, offset=offset)]
-
-        target_zones = self.find_zones(targets, exact) if targets else [local]
-        source_zones = self.find_zones(sources, exact) if sources else [local]
+        search = (exact, fuzzy, limit, order, by_zone)
+        target_zones = self.find_zones(targets, *search) if targets else None
+        source_zones = self.find_zones(sources, *search) if sources else None
+        return self.convert_zones(timestr, source_zones, target_zones, offset)
 
+    def convert_zones(self, timestr, source_zones=None, target_zones=None, offset=None):
+        """
+        The rest of ``convert``, once the ``find_zones`` for the sources and targets given
+        are known (``None`` for those not given)
+        """
+        local = self.local_zone
         if timestr:
             dt = utils.parse_timestamp(timestr).replace(microsecond=0)
-            if not (sources or targets):
+            if source_zones is None and target_zones is None:
                 return [Result(local.replace(dt), local, offset=offset)]
             else:
-                srcs = [Result(src.replace(dt), src, offset=offset) for src in source_zones]
-                return [sz.convert(tz) for sz in srcs for tz in target_zones]
+                srcs = [
+                    Result(src.replace(dt), src, offset=offset) for src in source_zones or [local]
+                ]
+                return Result.convert_all(srcs, target_zones or [local], self.tz_backend)
+
+        if source_zones is None and target_zones is None:
+            return [Result(local.now(), local, offset=offset)]
 
-        if sources and targets:
+        if source_zones is not None and target_zones is not None:
             srcs = [Result(src.now(), src, offset=offset) for src in source_zones]
-            return [sz.convert(tz) for sz in srcs for tz in target_zones]
+            return Result.convert_all(srcs, target_zones, self.tz_backend)
 
-        items = source_zones if sources else target_zones
+        items = source_zones if target_zones is None else target_zones
         return [Result(i.now(), i, offset=offset) for i in items]
 
-    def results(self, timestamp="", sources=None, targets=None, offset=None, exact=False):
-        return self.convert(utils.parse_source_input(timestamp), sources, targets, offset, exact)
+    def results(
+        self,
+        timestamp="",
+        sources=None,
+        targets=None,
+        offset=None,
+        exact=False,
+        fuzzy=False,
+        limit=None,
+        order=None,
+        by_zone=False,
+    ):
+        return self.convert(
+            utils.parse_source_input(timestamp),
+            sources,
+            targets,
+            offset,
+            exact,
+            fuzzy,
+            limit,
+            order,
+            by_zone,
+        )
 
     def as_json(
-        self, timestamp="", sources=None, targets=None, offset=None, exact=False, **json_kwargs
+        self,
+        timestamp="",
+        sources=None,
+        targets=None,
+        offset=None,
+        exact=False,
+        fuzzy=False,
+        limit=None,
+        order=None,
+        by_zone=False,
+        **json_kwargs,
     ):
-        converts = self.results(timestamp, sources, targets, offset, exact)
+        converts = self.results(
+            timestamp, sources, targets, offset, exact, fuzzy, limit, order, by_zone
+        )
         return json.dumps([convert.to_dict(self.settings) for convert in converts], **json_kwargs)
 
     def grouped(self, results, offset=None):
@@ -1,33 +1,164 @@
 import sys
 
-from . import make, client
+from . import client, index, make
+
+__all__ = [
+    "CITY_FILE_SIZES",
+    "client",
+    "create",
+    "db_main",
+    "dump",
+    "export_aliases",
+    "import_aliases",
+    "import_alt_names",
+    "index",
+    "make",
+    "update",
+]
 
 CITY_FILE_SIZES = make.CITY_FILE_SIZES
 
 
 def create(db, size, pop, remove_existing=False, dirname=None):
     dirname = dirname or db.filename.parent
-    filename = make.fetch_cities(size, dirname=dirname)
-    admin_1 = make.fetch_admin_1(dirname=dirname)
-    with open(filename) as fp:
-        data = make.process_geonames_txt(fp, pop, admin_1)
+    filename, admin_1 = make.fetch_build_inputs(size, dirname=dirname)
+    columns = make.load_geonames_columns(filename)
+    db.create_db(make.process_geonames_columns(columns, pop, admin_1), remove_existing)
+
+    db.set_meta(size=size, population=pop)
+
+
+def import_alt_names(db, filename=None, languages=make.ALT_NAME_LANGUAGES):
+    """
+    Stream GeoNames alternate names from ``filename`` (by default, a downloaded copy of
+    ``alternateNamesV2.zip``) into ``db`` as aliases of the cities it already has
+    """
+    filename = filename or make.fetch_alt_names(dirname=db.filename.parent)
+    with make.open_geonames(filename) as fp:
+        return db.add_alt_names(make.process_alternate_names(fp, db.city_ids(), languages))
+
+
+def import_aliases(db, filename, conflict="replace"):
+    """
+    Import aliases from a CSV or NDJSON file (``-`` for stdin) of ``alias``, ``city_id``
+    and optional ``lang`` records, returning the number read and added or changed
+    """
+    with make.open_records(filename) as fp:
+        records = make.read_records(fp, make.records_format(filename))
+        try:
+            return db.import_aliases(make.process_aliases(records), conflict)
+        except ValueError as err:
+            raise client.DBError(str(err))
+
+
+def export_aliases(db, filename):
+    """
+    Write the aliases of ``db`` to a CSV or NDJSON file (``-`` for stdout), in the format
+    read by ``import_aliases``, returning the number written
+    """
+    with make.open_records(filename, write=True) as fp:
+        rows = db.export_aliases()
+        return make.write_records(
+            fp, client.ALIAS_EXPORT_FIELDS, rows, make.records_format(filename)
+        )
+
+
+def dump(db, filename):
+    """
+    Write the cities of ``db`` to a CSV or NDJSON file (``-`` for stdout), returning the
+    number written
+    """
+    with make.open_records(filename, write=True) as fp:
+        return make.write_records(
+            fp, client.CITY_DUMP_FIELDS, db.dump(), make.records_format(filename)
+        )
 
-    db.create_db(data, remove_existing)
+
+def update(db, dirname, admin_1=None):
+    """
+    Apply the GeoNames daily modification and deletion files in ``dirname`` that are newer
+    than the last update applied to ``db``, using the cities file and filters the DB was
+    created with
+    """
+    meta = db.meta()
+    try:
+        size, pop = int(meta["size"]), int(meta["population"])
+    except (KeyError, ValueError):
+        size = pop = None
+
+    if size not in make.CITY_FILE_SEATS:
+        raise client.DBError(
+            f"{db.filename} does not record the cities file and population it was built with, "
+            "rebuild it to apply updates"
+        )
+
+    if admin_1 is None:
+        admin_1 = make.fetch_admin_1(dirname=db.filename.parent)
+
+    applied = []
+    for date, files in make.find_updates(dirname, meta.get("updated")).items():
+        rows, removed = [], []
+        if "modifications" in files:
+            with files["modifications"].open(encoding="utf-8") as fp:
+                rows, removed = make.process_modifications(fp, size, pop, admin_1)
+
+        if "deletes" in files:
+            with files["deletes"].open(encoding="utf-8") as fp:
+                removed += make.process_deletes(fp)
+
+        applied.append((date, *db.update_db(rows, removed, date)))
+
+    return applied
 
 
 def db_main(db, args):
     try:
         if args.db_size:
             create(db, args.db_size, args.db_pop, args.db_force)
+        elif args.db_update:
+            for date, nrows, nremoved in update(db, args.db_update):
+                print(f"{date}: {nrows:,} updated, {nremoved:,} removed")
+        elif args.db_migrate:
+            size = db.size
+            if db.migrate():
+                print(
+                    f"Migrated to schema version {client.SCHEMA_VERSION}: {size:,} => {db.size:,} bytes"
+                )
+            else:
+                print(f"Already at schema version {client.SCHEMA_VERSION}")
         elif args.db_search:
-            for row in db.search(" ".join(args.timestr), args.db_exact):
+            value = " ".join(args.timestr)
+            search = (args.db_exact, args.db_fuzzy, args.db_limit, args.db_order, args.db_by_zone)
+            if country := client.parse_country(value):
+                rows = db.cities_in(*country, limit=args.db_limit)
+            else:
+                rows = db.search(value, *search)
+
+            for row in rows:
                 print(f"{row.id:7} {row}")
+        elif args.db_near:
+            for row, km in db.nearest(*args.db_near):
+                print(f"{row.id:7} {row} ({km:,.1f} km)")
         elif args.db_alias:
             db.add_alias(" ".join(args.timestr), args.db_alias)
         elif args.db_aliases:
             for row in db.aliases():
                 alias, *details = row
                 print(f"{alias}: {' | '.join(details)}")
+        elif args.db_alias_import:
+            nread, added = import_aliases(db, args.db_alias_import, args.db_conflict)
+            print(f"Imported {nread:,} aliases: {added:,} added or changed")
+        elif args.db_alias_export:
+            count = export_aliases(db, args.db_alias_export)
+            print(f"Exported {count:,} aliases", file=sys.stderr)
+        elif args.db_dump:
+            count = dump(db, args.db_dump)
+            print(f"Dumped {count:,} cities", file=sys.stderr)
+
+        if args.db_alt_names or args.db_alt_names_file:
+            languages = args.db_langs.split(",")
+            count = import_alt_names(db, args.db_alt_names_file, languages)
+            print(f"Imported {count:,} aliases")
 
     except client.DBError as err:
         print(f"{err}", file=sys.stderr)
@@ -1,9 +1,15 @@
 import os
 import re
+import math
+import time
 import sqlite3
+import unicodedata
+import threading
+import itertools
 import contextlib
 from pathlib import Path
 from collections import namedtuple
+from functools import cache
 
 from .. import utils
 from ..exceptions import DBError
@@ -11,52 +17,449 @@ from ..exceptions import DBError
 logger = utils.logger()
 
 DB_FILENAME = Path(__file__).parent / "when.db"
+
+# Where the user overlay DB is kept, if not next to the DB it is for
+USER_DB_ENV = "WHENUSERDB"
+
+# Stored as ``PRAGMA user_version``: databases made before version 2 (with the country,
+# subdivision and zone names repeated in every ``city`` row) are rebuilt by ``migrate``
+SCHEMA_VERSION = 2
+
+# Country codes, subdivision names and zone names are stored once each, in lookup tables
+# referenced by ``city_data``. Lookups read ``city_data`` and decode the ids in Python (see
+# ``DB.lookups``); the ``city`` view, which puts the names back together, is for the FTS
+# index, builds and dumps. Its joins are LEFT JOINs so that SQLite can leave out those a
+# query has no columns from
 DB_SCHEMA = """
 PRAGMA encoding = "UTF-8";
-CREATE TABLE "city" (
+PRAGMA user_version = 2;
+CREATE TABLE "country" (
+    "id"    INTEGER PRIMARY KEY,
+    "code"  TEXT NOT NULL UNIQUE
+);
+CREATE TABLE "subdivision" (
     "id"    INTEGER PRIMARY KEY,
-    "name"  TEXT NOT NULL,
-    "ascii" TEXT NOT NULL,
-    "co"    TEXT NOT NULL,
-    "sub"   TEXT NOT NULL,
-    "tz"    TEXT NOT NULL,
-    "pop"   INTEGER
+    "name"  TEXT NOT NULL UNIQUE,
+    "key"   TEXT NOT NULL
 );
+CREATE TABLE "zone" (
+    "id"    INTEGER PRIMARY KEY,
+    "name"  TEXT NOT NULL UNIQUE
+);
+CREATE TABLE "city_data" (
+    "id"        INTEGER PRIMARY KEY,
+    "name"      TEXT NOT NULL,
+    "ascii"     TEXT NOT NULL,
+    "co_id"     INTEGER NOT NULL REFERENCES "country",
+    "sub_id"    INTEGER NOT NULL REFERENCES "subdivision",
+    "tz_id"     INTEGER NOT NULL REFERENCES "zone",
+    "pop"       INTEGER,
+    "lat"       REAL,
+    "lng"       REAL,
+    "name_key"  TEXT NOT NULL,
+    "ascii_key" TEXT NOT NULL,
+    "ntri"      INTEGER NOT NULL
+);
+CREATE VIEW "city" AS
+SELECT
+    d.id, d.name, d.ascii, co.code AS co, s.name AS sub, z.name AS tz, d.pop, d.lat, d.lng,
+    d.name_key, d.ascii_key, s.key AS sub_key, d.ntri
+FROM city_data d
+LEFT JOIN country co ON co.id = d.co_id
+LEFT JOIN subdivision s ON s.id = d.sub_id
+LEFT JOIN zone z ON z.id = d.tz_id;
 CREATE TABLE "alias" (
     "alias" TEXT PRIMARY KEY,
-    "city_id" INTEGER NOT NULL
-);
+    "city_id" INTEGER NOT NULL,
+    "key"   TEXT NOT NULL,
+    "lang"  TEXT
+) WITHOUT ROWID;
+CREATE TABLE "trigram" (
+    "tri"     TEXT NOT NULL,
+    "city_id" INTEGER NOT NULL,
+    PRIMARY KEY ("tri", "city_id")
+) WITHOUT ROWID;
+"""
+
+# Also added (and analyzed) by ``update_db`` for databases built without it
+COUNTRY_INDEX = """
+CREATE INDEX "city-country" ON "city_data" ("co_id", "sub_id", "pop", "tz_id")
+"""
+
+# User aliases are kept in a small overlay DB of their own, so that the (read-only) base DB
+# can be replaced by a rebuild without losing them. Readers attach it as ``user``
+USER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}."alias" (
+    "alias" TEXT PRIMARY KEY,
+    "city_id" INTEGER NOT NULL,
+    "key"   TEXT NOT NULL,
+    "lang"  TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS {schema}."alias-key" ON "alias" ("key", "city_id");
+"""
+
+# The aliases of both files, with those of the user overlay taking precedence
+ALIAS_VIEW = """
+CREATE TEMP VIEW "alias_all" AS
+SELECT alias, city_id, key, lang FROM user.alias
+UNION ALL
+SELECT alias, city_id, key, lang FROM main.alias b
+WHERE NOT EXISTS (SELECT 1 FROM user.alias u WHERE u.alias = b.alias)
+"""
+
+# Created once the bulk load in ``create_db`` is done
+DB_INDEXES = f"""
 CREATE INDEX "city-index" ON "alias" ("city_id");
+CREATE INDEX "alias-key" ON "alias" ("key", "city_id");
+CREATE INDEX "city-name-key" ON "city_data" ("name_key", "co_id", "sub_id");
+CREATE INDEX "city-ascii-key" ON "city_data" ("ascii_key", "co_id", "sub_id");
+{COUNTRY_INDEX.strip()};
+"""
+
+# Per-connection settings for building a new database file: if the build fails, the
+# file is removed and rebuilt anyway, so there is nothing to gain from a rollback journal
+# or from syncing to disk until it is complete
+BULK_PRAGMAS = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -65536;
 """
+BULK_BATCH = 50_000
+
+CITY_INSERT = """
+INSERT INTO city_data (id, name, ascii, co_id, sub_id, tz_id, pop, lat, lng, name_key, ascii_key, ntri)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Lookup table => columns, the first of which is the value looked up
+LOOKUPS = {
+    "country": ("code",),
+    "subdivision": ("name", "key"),
+    "zone": ("name",),
+}
+
+# ``city`` columns kept by ``migrate``; any missing from an older database are left empty
+MIGRATE_COLUMNS = ("id", "name", "ascii", "co", "sub", "tz", "pop", "lat", "lng")
+
+OLD_SCHEMA = """
+The database was made with an older layout, and must be migrated before it can be
+used. Migrate it with:
+
+    when --db-migrate
+"""
+
+# Build settings and update state, plus the temporary table of city ids changed by an
+# incremental update, whose FTS and trigram rows are rebuilt from it
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "meta" (
+    "key"   TEXT PRIMARY KEY,
+    "value" TEXT
+) WITHOUT ROWID;
+CREATE TEMP TABLE IF NOT EXISTS "changed" ("id" INTEGER PRIMARY KEY);
+DELETE FROM "changed";
+"""
+
+FTS_DELETE = """
+INSERT INTO city_fts(city_fts, rowid, name, ascii, sub, co)
+SELECT 'delete', id, name, ascii, sub, co FROM city WHERE id IN changed
+"""
+
+FTS_INSERT = """
+INSERT INTO city_fts(rowid, name, ascii, sub, co)
+SELECT id, name, ascii, sub, co FROM city WHERE id IN changed
+"""
+
+# R*Tree over the city coordinates, each stored as a zero-area box
+GEO_SCHEMA = """
+CREATE VIRTUAL TABLE "city_geo" USING rtree("id", "min_lat", "max_lat", "min_lng", "max_lng");
+INSERT INTO city_geo SELECT id, lat, lat, lng, lng FROM city WHERE lat IS NOT NULL;
+"""
+
+GEO_DELETE = "DELETE FROM city_geo WHERE id IN changed"
+GEO_INSERT = """
+INSERT INTO city_geo SELECT id, lat, lat, lng, lng FROM city WHERE id IN changed AND lat IS NOT NULL
+"""
+
+NEAR_QUERY = """
+SELECT c.id, c.name, c.ascii, c.sub_id, c.co_id, c.tz_id, c.lat, c.lng
+FROM city_geo g
+JOIN city_data c ON c.id = g.id
+WHERE g.min_lat <= :north AND g.max_lat >= :south AND g.min_lng <= :east AND g.max_lng >= :west
+"""
+
+# Half-widths, in degrees of latitude, of the boxes tried in turn around a point until one
+# holds the nearest cities
+NEAR_RADII = (0.25, 1, 4, 16, 64, 180)
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+MISSING_GEO = """
+The database has no coordinates index, recreate it with:
+
+    when --db --force
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE "city_fts" USING fts5(
+    "name",
+    "ascii",
+    "sub",
+    "co",
+    content="city",
+    content_rowid="id",
+    tokenize="unicode61 remove_diacritics 2",
+    prefix="2 3"
+);
+INSERT INTO "city_fts"("city_fts") VALUES ('rebuild');
+"""
+
+TABLES_QUERY = "SELECT name FROM sqlite_master WHERE type = 'table'"
+INDEXES_QUERY = "SELECT name FROM sqlite_master WHERE type = 'index'"
+FTS_MATCH_EXPR = "c.id IN (SELECT rowid FROM city_fts WHERE city_fts MATCH :match)"
+
+# Lookups return ``CITY_COLUMNS`` rows, with the subdivision, country and zone ids decoded
+# by ``DB.cities``. Countries are filtered on by id, looked up once, and subdivisions by
+# the key of each candidate's own (subdivision keys are not unique). Searches ranked by
+# wrapping them also select ``RANKED_COLUMNS``, to rank by population.
+CITY_COLUMNS = "c.id, c.name, c.ascii, c.sub_id, c.co_id, c.tz_id"
+RANKED_COLUMNS = f"{CITY_COLUMNS}, c.pop"
+CO_FILTER = "c.co_id = (SELECT id FROM country WHERE code = :co)"
+SUB_FILTER = "EXISTS (SELECT 1 FROM subdivision s WHERE s.id = c.sub_id AND s.key = :sub)"
 
 SEARCH_QUERY = """
-SELECT c.id, c.name, c.ascii, c.sub, c.co, c.tz
-FROM city c
+SELECT {columns}
+FROM city_data c
 WHERE
     c.id = :value OR
     {}
 """
 
 XSEARCH_QUERY = """
-SELECT c.id, c.name, c.ascii, c.sub, c.co, c.tz
-FROM city c
+SELECT {columns}
+FROM city_data c
 WHERE
-    (c.id = :value OR UPPER(c.name) = :value OR UPPER(c.ascii) = :value)
+    (c.id = :value OR c.name_key = :value OR c.ascii_key = :value)
+"""
+
+# Resolve many search expressions at once: every input is a row of the ``q`` CTE,
+# with alias hits (part 0) ordered ahead of city matches (part 1) for each input. The
+# ``hit`` ids are matched on their own, or the correlated FTS match could be re-run for
+# every row joined
+SEARCH_MANY_QUERY = """
+WITH q(idx, value, sub, co, match) AS (VALUES {values}), hit AS MATERIALIZED (
+    SELECT q.idx, q.sub, q.co, c.id
+    FROM q
+    JOIN city_data c ON c.id = q.value OR {match}
+)
+SELECT q.idx, 0, {columns}
+FROM q
+JOIN alias_all a ON a.key = q.value
+JOIN city_data c ON c.id = a.city_id
+UNION ALL
+SELECT h.idx, 1, {columns}
+FROM hit h
+JOIN city_data c ON
+    c.id = h.id
+    AND (h.co IS NULL OR c.co_id = (SELECT id FROM country WHERE code = h.co))
+    AND (h.sub IS NULL OR EXISTS (SELECT 1 FROM subdivision s WHERE s.id = c.sub_id AND s.key = h.sub))
+ORDER BY 1, 2, 3
+"""
+
+# Search results by zone, ranked in SQL: ``r`` numbers the rows in search order, ``z`` the
+# cities of each zone, most populous first. Other searches are sorted and limited directly.
+RANKED_QUERY = """
+WITH r AS (
+    SELECT s.*, ROW_NUMBER() OVER () AS pos FROM ({query}) s
+), z AS (
+    SELECT r.*, ROW_NUMBER() OVER (PARTITION BY r.tz_id ORDER BY r.pop DESC, r.pos) AS n
+    FROM r
+)
+SELECT id, name, ascii, sub_id, co_id, tz_id
+FROM z
+WHERE n = 1
+ORDER BY {order}
+LIMIT :max_rows
+"""
+
+# Fuzzy matches, which come in similarity order, sorted by ``order`` instead
+ORDERED_QUERY = """
+WITH r AS (
+    SELECT s.*, ROW_NUMBER() OVER () AS pos FROM ({query}) s
+)
+SELECT id, name, ascii, sub_id, co_id, tz_id
+FROM r
+ORDER BY {order}
+LIMIT :max_rows
+"""
+
+RANKED_MANY_QUERY = """
+WITH m(idx, part, id, name, ascii, sub_id, co_id, tz_id, pop) AS ({query}), z AS (
+    SELECT m.*, ROW_NUMBER() OVER (PARTITION BY m.idx, {partition} ORDER BY m.part, m.pop DESC, m.id) AS n
+    FROM m
+), r AS (
+    SELECT z.*, ROW_NUMBER() OVER (PARTITION BY z.idx ORDER BY part, {order}) AS rank
+    FROM z
+    WHERE n = 1
+)
+SELECT idx, part, id, name, ascii, sub_id, co_id, tz_id
+FROM r
+{limit}
+ORDER BY idx, part, {order}
+"""
+
+# ``order`` options for searches, as sort keys of the search query itself, of RANKED_QUERY
+# and ORDERED_QUERY, and of RANKED_MANY_QUERY
+SEARCH_ORDERS = {
+    None: ("c.id", "pos", "id"),
+    "population": ("c.pop DESC, c.id", "pop DESC, pos", "pop DESC, id"),
+}
+
+SEARCH_MANY_MATCH = {
+    "exact": "c.name_key = q.value OR c.ascii_key = q.value",
+    "fts": "c.id IN (SELECT rowid FROM city_fts WHERE city_fts MATCH q.match)",
+    "like": "c.name_key LIKE '%' || q.value || '%' OR c.ascii_key LIKE '%' || q.value || '%'",
+}
+
+# Inputs per SEARCH_MANY_QUERY, keeping the bound parameters well under SQLite's limit
+SEARCH_MANY_BATCH = 1_000
+
+# Candidates share at least one trigram with the search value; they are ranked by
+# Jaccard similarity of the trigram sets, then by population
+FUZZY_SEARCH_QUERY = """
+SELECT {columns}
+FROM (
+    SELECT t.city_id, COUNT(*) AS shared
+    FROM trigram t
+    WHERE t.tri IN ({})
+    GROUP BY t.city_id
+    HAVING COUNT(*) >= :min_shared
+) m
+JOIN city_data c ON c.id = m.city_id
+WHERE m.shared >= :threshold * (c.ntri + :ntri - m.shared) {}
+ORDER BY m.shared * 1.0 / (c.ntri + :ntri - m.shared) DESC, c.pop DESC
+LIMIT :limit
+"""
+
+FUZZY_LIMIT = 10
+FUZZY_THRESHOLD = 0.3
+
+MISSING_TRIGRAMS = """
+The database does not have a trigram index for fuzzy searches. Rebuild it with:
+
+    when --db <SIZE> --force
+"""
+
+# Country (and subdivision) expressions, such as ``co:BR`` or ``co:US,California``
+COUNTRY_PREFIX = "co:"
+
+COUNTRY_FILTERS = {
+    "sub": "AND d.sub_id IN (SELECT id FROM subdivision WHERE key = :sub)",
+    "min_pop": "AND d.pop >= :min_pop",
+}
+
+# Both are answered from the ``city-country`` index, most populous first
+CITIES_IN_QUERY = """
+SELECT d.id, d.name, d.ascii, d.sub_id, d.co_id, d.tz_id
+FROM city_data d
+WHERE d.co_id = (SELECT id FROM country WHERE code = :co) {}
+ORDER BY d.pop DESC, d.id
+LIMIT :max_rows
+"""
+
+ZONES_IN_QUERY = """
+SELECT z.name
+FROM city_data d
+JOIN zone z ON z.id = d.tz_id
+WHERE d.co_id = (SELECT id FROM country WHERE code = :co) {}
+GROUP BY d.tz_id
+ORDER BY MAX(d.pop) DESC, z.name
+"""
+
+# Completion candidates, as (name, search key, population, kind) rows: each city's name,
+# its ASCII name when that has another key, and the aliases of both DB files
+COMPLETIONS_QUERY = """
+SELECT name, name_key, pop, 'city' FROM city_data
+UNION ALL
+SELECT ascii, ascii_key, pop, 'city' FROM city_data WHERE ascii_key != name_key
+UNION ALL
+SELECT a.alias, a.key, d.pop, 'alias' FROM alias_all a JOIN city_data d ON d.id = a.city_id
+"""
+
+ZONE_POPULATION_QUERY = """
+SELECT z.name, MAX(d.pop)
+FROM city_data d
+JOIN zone z ON z.id = d.tz_id
+GROUP BY d.tz_id
 """
 
 ALIASES_LISTING_QUERY = """
-SELECT a.alias, c.name, c.sub, c.co, c.tz
-FROM alias a
-LEFT JOIN city c on a.city_id = c.id
+SELECT a.alias, d.name, s.name, co.code, z.name
+FROM alias_all a
+LEFT JOIN city_data d ON d.id = a.city_id
+LEFT JOIN country co ON co.id = d.co_id
+LEFT JOIN subdivision s ON s.id = d.sub_id
+LEFT JOIN zone z ON z.id = d.tz_id
+"""
+
+ALIAS_SEARCH_QUERY = f"""
+SELECT {CITY_COLUMNS}
+FROM city_data c
+WHERE c.id IN (SELECT city_id FROM alias_all WHERE key = ?)
+ORDER BY c.pop DESC
+"""
+
+ALIAS_INSERT = "INSERT INTO alias (alias, city_id, key) VALUES (?, ?, ?)"
+
+# Imported into the user overlay. Aliases of cities that are not in the base DB are
+# skipped; an alias that already exists is replaced, kept as is ("ignore"), or aborts the
+# whole import ("fail")
+ALIAS_IMPORT = """
+INSERT INTO alias (alias, city_id, key, lang)
+SELECT :alias, id, :key, :lang FROM base.city_data
+WHERE id = :gid
+{}
 """
 
-ALIAS_SEARCH_QUERY = """
-SELECT c.id, c.name, c.ascii, c.sub, c.co, c.tz
-FROM city c
-LEFT JOIN alias a on a.city_id = c.id
-WHERE a.alias = ?
+ALIAS_CONFLICTS = {
+    "replace": """ON CONFLICT (alias) DO UPDATE
+SET city_id = excluded.city_id, key = excluded.key, lang = excluded.lang""",
+    "ignore": "ON CONFLICT (alias) DO NOTHING",
+    "fail": "",
+}
+
+ALIAS_EXPORT_FIELDS = ("alias", "city_id", "lang")
+ALIAS_EXPORT_QUERY = "SELECT alias, city_id, lang FROM user.alias ORDER BY alias"
+
+# Aliases with no language, made by hand, that a base DB built before the user overlay
+# existed may still have; they are moved to the overlay when it is rebuilt or migrated
+KEEP_ALIASES_QUERY = "SELECT alias, city_id FROM alias {}"
+KEEP_ALIAS_INSERT = "INSERT OR IGNORE INTO alias (alias, city_id, key) VALUES (?, ?, ?)"
+
+CITY_DUMP_FIELDS = ("id", "name", "ascii", "sub", "co", "tz", "pop", "lat", "lng")
+CITY_DUMP_QUERY = f"SELECT {', '.join(CITY_DUMP_FIELDS)} FROM city ORDER BY id"
+
+# GeoNames alternate names are imported with their language ("" if unspecified), and never
+# replace hand-made aliases (with no language). Names that are the same as the city's own
+# name are skipped, and when two cities share a name, the more populous one wins
+ALT_NAME_INSERT = """
+INSERT INTO alias (alias, city_id, key, lang)
+SELECT :alias, id, :key, :lang FROM city_data
+WHERE id = :gid AND :key NOT IN (name_key, ascii_key)
+ON CONFLICT (alias) DO UPDATE SET city_id = excluded.city_id, key = excluded.key
+WHERE alias.lang IS NOT NULL
+    AND (SELECT pop FROM city_data WHERE id = excluded.city_id)
+        > (SELECT pop FROM city_data WHERE id = alias.city_id)
 """
 
+# Applied to the long-lived, read-only connections used for lookups. ``query_only`` comes
+# last, once the ``alias_all`` view is created (setting ``temp_store`` would drop it)
+READER_PRAGMAS = [
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -8192",
+    "PRAGMA temp_store = MEMORY",
+]
+
 MISSING_DB = """
 The database is not currently available. You can generate it easily
 (assuming you have internet access) by issuing the following command:
@@ -74,6 +477,277 @@ EXISTING_DB = """
 """
 
 
+Query = namedtuple("Query", "sql params elapsed rows plan")
+QueryShape = namedtuple("QueryShape", "shape count elapsed max rows plan")
+SCAN_RE = re.compile(r"SCAN (?!.*(VIRTUAL TABLE|CONSTANT ROW))")
+
+
+def query_shape(sql):
+    """
+    One-line form of ``sql``, with repeated ``VALUES`` groups collapsed, so that statements
+    differing only in the number of batched inputs are grouped together
+    """
+    sql = " ".join(sql.split())
+    return re.sub(r"(\([?, ]+\))(?:, \1)+", r"\1, ...", sql)
+
+
+class Profiler:
+    """
+    Records every statement run by ``DB._execute`` while active (see ``DB.profile``): its
+    SQL, parameters, wall time, number of rows, and ``EXPLAIN QUERY PLAN`` output
+    """
+
+    def __init__(self, explain=True):
+        self.explain = explain
+        self.queries = []
+        self._plans = {}
+
+    def record(self, con, sql, params, elapsed, rows):
+        plan = None
+        if self.explain:
+            if sql not in self._plans:
+                depths, plan = {}, []
+                for node, parent, _, detail in con.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                    depths[node] = depths.get(parent, -1) + 1
+                    plan.append(f"{'  ' * depths[node]}{detail}")
+
+                self._plans[sql] = plan
+
+            plan = self._plans[sql]
+
+        self.queries.append(Query(sql, params, elapsed, rows, plan))
+
+    @property
+    def elapsed(self):
+        return sum(query.elapsed for query in self.queries)
+
+    def summary(self):
+        "Per query shape totals, slowest first"
+        shapes = {}
+        for query in self.queries:
+            shape = query_shape(query.sql)
+            count, elapsed, longest, rows, _ = shapes.get(shape, (0, 0, 0, 0, None))
+            shapes[shape] = (
+                count + 1,
+                elapsed + query.elapsed,
+                max(longest, query.elapsed),
+                rows + query.rows,
+                query.plan,
+            )
+
+        summary = [QueryShape(shape, *totals) for shape, totals in shapes.items()]
+        return sorted(summary, key=lambda s: s.elapsed, reverse=True)
+
+    def scans(self):
+        "Query shapes whose plan scans a table, subquery or CTE, rather than searching it"
+        return [
+            shape
+            for shape in self.summary()
+            if any(SCAN_RE.match(line.strip()) for line in shape.plan or [])
+        ]
+
+    def report(self, total=None):
+        lines = [f"{'count':>6} {'total ms':>10} {'mean ms':>10} {'max ms':>10} {'rows':>7}  query"]
+        for shape in self.summary():
+            lines.append(
+                f"{shape.count:6,} {shape.elapsed * 1000:10.3f} "
+                f"{shape.elapsed / shape.count * 1000:10.3f} {shape.max * 1000:10.3f} "
+                f"{shape.rows:7,}  {shape.shape}"
+            )
+            lines.extend(f"{'':47}{line}" for line in shape.plan or [])
+
+        footer = f"{len(self.queries):,} statements, {self.elapsed * 1000:,.3f}ms"
+        if total:
+            footer = f"{footer} of {total * 1000:,.3f}ms total ({self.elapsed / total:.1%})"
+
+        lines.append(footer)
+        return "\n".join(lines)
+
+
+def ranked(cities, limit=None, by_zone=False):
+    """
+    Apply ``limit`` and ``by_zone`` to alias matches followed by (ranked) search results
+    """
+    if by_zone:
+        zones = set()
+        cities = [c for c in cities if c.tz not in zones and not zones.add(c.tz)]
+
+    return cities if limit is None else cities[:limit]
+
+
+def normalize(value):
+    """
+    Search key for a name: accents and other combining marks are removed and the
+    result is upper-cased, e.g.: ``Île-de-France`` => ``ILE-DE-FRANCE``
+    """
+    value = unicodedata.normalize("NFKD", value)
+    return "".join(c for c in value if not unicodedata.combining(c)).upper()
+
+
+def trigrams(value):
+    """
+    Set of 3-character sequences for each word of ``value``, padded with a leading and
+    trailing space, e.g.: ``SEOUL`` => `` SE``, ``SEO``, ``EOU``, ``OUL``, ``UL ``
+    """
+    grams = set()
+    for word in re.findall(r"\w+", value):
+        word = f" {word} "
+        grams.update(word[i : i + 3] for i in range(len(word) - 2))
+
+    return grams
+
+
+def with_keys(row):
+    gid, name, ascii, co, sub, tz, pop, lat, lng = row
+    name_key, ascii_key = normalize(name), normalize(ascii)
+    ntri = len(trigrams(name_key) | trigrams(ascii_key))
+    return [gid, name, ascii, co, sub, tz, pop, lat, lng, name_key, ascii_key, normalize(sub), ntri]
+
+
+def encode_rows(con, rows):
+    """
+    ``with_keys`` rows as ``CITY_INSERT`` rows, with the country, subdivision and zone
+    replaced by their lookup table ids; values not seen before are added as they turn up
+    """
+    ids = {
+        table: dict(con.execute(f'SELECT "{columns[0]}", id FROM "{table}"'))
+        for table, columns in LOOKUPS.items()
+    }
+
+    def lookup(table, *values):
+        found = ids[table].get(values[0])
+        if found is None:
+            columns, params = ", ".join(LOOKUPS[table]), ", ".join("?" * len(values))
+            sql = f'INSERT INTO "{table}" ({columns}) VALUES ({params})'
+            found = ids[table][values[0]] = con.execute(sql, values).lastrowid
+
+        return found
+
+    for gid, name, ascii, co, sub, tz, pop, lat, lng, name_key, ascii_key, sub_key, ntri in rows:
+        yield [
+            gid,
+            name,
+            ascii,
+            lookup("country", co),
+            lookup("subdivision", sub, sub_key),
+            lookup("zone", tz),
+            pop,
+            lat,
+            lng,
+            name_key,
+            ascii_key,
+            ntri,
+        ]
+
+
+def schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def attached_file(con, schema):
+    """
+    The file of the database attached to ``con`` as ``schema``, empty for an in-memory one
+    """
+    for _, name, filename in con.execute("PRAGMA database_list"):
+        if name == schema:
+            return filename
+
+    return None
+
+
+def check_order(order):
+    if order not in SEARCH_ORDERS:
+        raise DBError(f"Invalid search order: {order}")
+
+
+def check_limit(limit):
+    if limit < 1:
+        raise ValueError(f"limit must be at least 1, got {limit}")
+
+
+def distance(lat1, lng1, lat2, lng2):
+    "Great-circle distance in kilometers"
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def near_boxes(lat, lng, radius):
+    """
+    Latitude/longitude boxes covering every point within ``radius`` degrees of latitude
+    (``radius * KM_PER_DEGREE`` km) of ``lat, lng``, split in two across the antimeridian
+    """
+    south, north = max(-90.0, lat - radius), min(90.0, lat + radius)
+    cos = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+    width = radius / cos if cos > 0 else 180.0
+    if width >= 180:
+        return [(south, north, -180.0, 180.0)]
+
+    west, east = lng - width, lng + width
+    if west < -180:
+        return [(south, north, -180.0, east), (south, north, west + 360, 180.0)]
+
+    if east > 180:
+        return [(south, north, west, 180.0), (south, north, -180.0, east - 360)]
+
+    return [(south, north, west, east)]
+
+
+@cache
+def rtree_available():
+    con = sqlite3.connect(":memory:")
+    try:
+        con.execute("CREATE VIRTUAL TABLE rtree_check USING rtree(id, x0, x1)")
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        con.close()
+
+    return True
+
+
+@cache
+def fts5_available():
+    con = sqlite3.connect(":memory:")
+    try:
+        con.execute("CREATE VIRTUAL TABLE fts5_check USING fts5(value)")
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        con.close()
+
+    return True
+
+
+def fts_match(value):
+    """
+    Convert a search value into an FTS5 query where every word is a prefix match
+    against the name or ascii columns, e.g.: ``{name ascii} : ("NEW"* "YORK"*)``.
+    A value without any words becomes an empty phrase, which matches nothing.
+    """
+    tokens = re.findall(r"\w+", value)
+    if not tokens:
+        return '""'
+
+    terms = " ".join(f'"{token}"*' for token in tokens)
+    return f"{{name ascii}} : ({terms})"
+
+
+def parse_country(value):
+    """
+    The (country code, subdivision key or ``None``) of a ``co:CC[,subdivision]`` expression,
+    or ``None`` for any other value
+    """
+    if value[: len(COUNTRY_PREFIX)].lower() != COUNTRY_PREFIX:
+        return None
+
+    co, _, sub = value[len(COUNTRY_PREFIX) :].partition(",")
+    return co.strip().upper(), normalize(sub.strip()) or None
+
+
 class City(namedtuple("City", ["id", "name", "ascii", "sub", "co", "tz"])):
     __slots__ = ()
     sub_number_re = re.compile(r"\d")
@@ -132,22 +806,133 @@ class City(namedtuple("City", ["id", "name", "ascii", "sub", "co", "tz"])):
         return dct
 
 
+class Lookup(dict):
+    """
+    The values of a lookup table ``column`` by id, read once; ids added since, by an update
+    in another process, are read as they turn up
+    """
+
+    def __init__(self, db, table, column, con):
+        super().__init__(con.execute(f'SELECT id, "{column}" FROM "{table}"'))
+        self.db = db
+        self.sql = f'SELECT "{column}" FROM "{table}" WHERE id = ?'
+
+    def __missing__(self, key):
+        with self.db.connection() as con:
+            row = con.execute(self.sql, (key,)).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        self[key] = row[0]
+        return row[0]
+
+
 class DB:
-    def __init__(self, filename=DB_FILENAME):
+    """
+    City lookups in a base DB file, which only ``create_db``, ``update_db``, ``migrate`` and
+    ``add_alt_names`` (for the GeoNames alternate names) write to, layered with a user
+    overlay DB for the aliases added by ``add_alias`` and ``import_aliases``. The overlay is ``user_filename``, by default the ``WHENUSERDB``
+    environment variable or ``<name>-user.db`` next to the base DB.
+    """
+
+    def __init__(self, filename=DB_FILENAME, fts=None, persistent=True, user_filename=None):
         self.filename = Path(filename)
+        self.user_filename = Path(
+            user_filename
+            or os.getenv(USER_DB_ENV)
+            or self.filename.with_name(f"{self.filename.stem}-user.db")
+        )
+        self.fts = fts
+        self.persistent = persistent
+        self._tables = None
+        self._lookups = None
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        self.profiler = None
+        # Bumped by every write that can change search results, to invalidate caches
+        self.generation = 0
+
+    def _trace(self, db):
+        if os.getenv("WHENSQL", "").upper() in {"1", "YES", "ON", "TRUE"}:
+            db.set_trace_callback(print)
+
+        return db
 
     @property
     def _db(self):
-        return sqlite3.connect(self.filename)
+        return self._trace(sqlite3.connect(self.filename))
+
+    def _connect_reader(self):
+        """
+        Read-only connection to the base DB, with the user overlay attached as ``user``
+        (or, until there is one, an empty stand-in) and the ``alias_all`` view of both
+        """
+        uri = f"{self.filename.resolve().as_uri()}?mode=ro"
+        db = self._trace(sqlite3.connect(uri, uri=True, check_same_thread=False))
+        try:
+            if self.user_filename.exists():
+                user_uri = f"{self.user_filename.resolve().as_uri()}?mode=ro"
+                db.execute("ATTACH DATABASE ? AS user", (user_uri,))
+            else:
+                db.execute("ATTACH DATABASE ':memory:' AS user")
+                db.executescript(USER_SCHEMA.format(schema="user"))
+
+            for pragma in READER_PRAGMAS:
+                db.execute(pragma)
+
+            db.execute(ALIAS_VIEW)
+            db.execute("PRAGMA query_only = ON")
+
+            if schema_version(db) < SCHEMA_VERSION:
+                raise DBError(OLD_SCHEMA)
+        except BaseException:
+            db.close()
+            raise
+
+        return db
+
+    @property
+    def _reader(self):
+        """
+        Per-thread, read-only connection that stays open for the life of this instance, or
+        until a user overlay turns up in place of the stand-in it was opened with
+        """
+        db = getattr(self._local, "db", None)
+        if db is not None and self._local.stand_in and self.user_filename.exists():
+            with self._lock:
+                self._readers.remove(db)
+
+            db.close()
+            db = None
+
+        if db is None:
+            db = self._local.db = self._connect_reader()
+            self._local.stand_in = not attached_file(db, "user")
+            with self._lock:
+                self._readers.append(db)
+
+        return db
+
+    def close(self):
+        with self._lock:
+            for db in self._readers:
+                db.close()
+
+            self._readers.clear()
+            self._local = threading.local()
 
     @contextlib.contextmanager
     def connection(self, commit=False, create=False):
         if not create and not self.filename.exists():
             raise DBError(MISSING_DB)
 
-        db = self._db
-        if os.getenv("WHENSQL", "").upper() in {"1", "YES", "ON", "TRUE"}:
-            db.set_trace_callback(print)
+        if self.persistent and not (commit or create):
+            yield self._reader
+            return
+
+        db = self._db if commit or create else self._connect_reader()
         try:
             yield db
         finally:
@@ -156,49 +941,437 @@ class DB:
 
             db.close()
 
+    @contextlib.contextmanager
+    def user_connection(self):
+        """
+        Connection to the user overlay, created if need be, with the base DB attached
+        read-only as ``base``; committed once done
+        """
+        if not self.filename.exists():
+            raise DBError(MISSING_DB)
+
+        created = not self.user_filename.exists()
+        self.user_filename.parent.mkdir(parents=True, exist_ok=True)
+        db = self._trace(sqlite3.connect(self.user_filename.resolve().as_uri(), uri=True))
+        try:
+            db.executescript(USER_SCHEMA.format(schema="main"))
+            db.execute(
+                "ATTACH DATABASE ? AS base", (f"{self.filename.resolve().as_uri()}?mode=ro",)
+            )
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+        if created:
+            # Readers opened before there was an overlay have a stand-in attached instead
+            self.close()
+
     def aliases(self):
         with self.connection() as con:
-            return con.execute(ALIASES_LISTING_QUERY).fetchall()
+            yield from con.execute(ALIASES_LISTING_QUERY)
+
+    def export_aliases(self):
+        """
+        Yield each alias of the user overlay as an (alias, city id, language) row, in alias
+        order
+        """
+        with self.connection() as con:
+            yield from con.execute(ALIAS_EXPORT_QUERY)
+
+    def dump(self):
+        """
+        Yield each city as a row of ``CITY_DUMP_FIELDS``, in id order
+        """
+        with self.connection() as con:
+            yield from con.execute(CITY_DUMP_QUERY)
 
     def add_alias(self, name, gid):
-        with self.connection(commit=True) as con:
+        with self.user_connection() as con:
             con.executemany(
-                "INSERT INTO alias(alias, city_id) VALUES (?, ?)",
-                [(val.strip(), gid) for val in name.split(",")],
+                ALIAS_INSERT,
+                [(val.strip(), gid, normalize(val.strip())) for val in name.split(",")],
             )
 
+        self.generation += 1
+
+    @utils.timer
+    def import_aliases(self, aliases, conflict="replace"):
+        """
+        Import (alias, city id, language) rows in a single transaction, rolled back if any
+        row fails. Returns the number of rows read and the number of aliases added or
+        changed. See ``ALIAS_IMPORT`` for the ``conflict`` policies.
+        """
+        if conflict not in ALIAS_CONFLICTS:
+            raise DBError(f"Invalid alias conflict policy: {conflict}")
+
+        nread = 0
+
+        def params():
+            nonlocal nread
+            for alias, gid, lang in aliases:
+                nread += 1
+                yield {"alias": alias, "key": normalize(alias), "lang": lang, "gid": gid}
+
+        with self.user_connection() as con:
+            changes = con.total_changes
+            try:
+                with con:
+                    con.executemany(ALIAS_IMPORT.format(ALIAS_CONFLICTS[conflict]), params())
+            except sqlite3.IntegrityError as err:
+                raise DBError(f"Alias import failed at row {nread:,}: {err}")
+
+            added = con.total_changes - changes
+
+        self.generation += 1
+        return nread, added
+
+    @utils.timer
+    def add_alt_names(self, names):
+        """
+        Bulk import (name, city id, language) alternate names as aliases, returning the
+        number of aliases added or changed
+        """
+        with self.connection(commit=True) as con:
+            changes = con.total_changes
+            self._bulk_insert(
+                con,
+                ALT_NAME_INSERT,
+                (
+                    {"alias": name, "key": normalize(name), "gid": gid, "lang": lang}
+                    for name, gid, lang in names
+                ),
+            )
+            added = con.total_changes - changes
+
+        self.generation += 1
+        return added
+
+    def city_ids(self):
+        with self.connection() as con:
+            return {gid for (gid,) in con.execute("SELECT id FROM city_data")}
+
     @property
     def size(self):
         return self.filename.stat().st_size if self.filename.exists() else 0
 
     @utils.timer
     def create_db(self, data, remove_existing=True):
+        """
+        Build the base DB from the city rows in ``data`` as a new file that then replaces
+        the existing one, so that readers never see it half-built
+        """
         if self.filename.exists():
             if not remove_existing:
                 raise DBError(EXISTING_DB)
 
-            self.filename.unlink()
+            with contextlib.closing(self._db) as con:
+                self.keep_aliases(con)
+
+        building = self.filename.with_name(f"{self.filename.name}.build")
+        building.unlink(missing_ok=True)
+        try:
+            with contextlib.closing(self._trace(sqlite3.connect(building))) as con:
+                con.executescript(BULK_PRAGMAS)
+                con.executescript(DB_SCHEMA)
+                nrows = self.load_cities(con, data)
+                self.load_trigrams(con)
+                self.create_indexes(con)
+                self.optimize(con)
 
-        with self.connection(commit=True, create=True) as con:
-            cur = con.cursor()
-            cur.executescript(DB_SCHEMA)
-            cur.executemany("INSERT INTO city VALUES (?, ?, ?, ?, ?, ?, ?)", data)
-            nrows = cur.rowcount
+            with building.open("rb+") as fp:
+                os.fsync(fp.fileno())
+
+            os.replace(building, self.filename)
+        finally:
+            building.unlink(missing_ok=True)
 
+        self.close()
+        self._tables = self._lookups = None
+        self.generation += 1
         logger.info(f"Inserted {nrows:,} rows ({self.size:,} bytes)")
 
+    def keep_aliases(self, con):
+        """
+        Copy the hand-made aliases still kept in the base DB ``con`` (see
+        ``KEEP_ALIASES_QUERY``) to the user overlay, returning how many there were
+        """
+        found = {row[1] for row in con.execute('PRAGMA table_info("alias")')}
+        where = "WHERE lang IS NULL" if "lang" in found else ""
+        rows = con.execute(KEEP_ALIASES_QUERY.format(where)).fetchall() if found else []
+        if rows:
+            with self.user_connection() as user:
+                user.executemany(
+                    KEEP_ALIAS_INSERT, [(alias, gid, normalize(alias)) for alias, gid in rows]
+                )
+
+        return len(rows)
+
+    def _bulk_insert(self, con, sql, rows):
+        count = 0
+        while batch := list(itertools.islice(rows, BULK_BATCH)):
+            con.executemany(sql, batch)
+            con.commit()
+            count += len(batch)
+
+        return count
+
+    @utils.timer
+    def load_cities(self, con, data):
+        return self._bulk_insert(con, CITY_INSERT, encode_rows(con, map(with_keys, data)))
+
+    @utils.timer
+    def load_trigrams(self, con):
+        cities = con.execute("SELECT id, name_key, ascii_key FROM city_data").fetchall()
+        return self._bulk_insert(
+            con,
+            "INSERT INTO trigram VALUES (?, ?)",
+            (
+                (tri, gid)
+                for gid, name_key, ascii_key in cities
+                for tri in trigrams(name_key) | trigrams(ascii_key)
+            ),
+        )
+
+    @utils.timer
+    def create_indexes(self, con):
+        con.executescript(DB_INDEXES)
+        if rtree_available():
+            con.executescript(GEO_SCHEMA)
+        else:
+            logger.warning("SQLite R*Tree is not available, nearest city lookups are disabled")
+
+        if fts5_available():
+            con.executescript(FTS_SCHEMA)
+        else:
+            logger.warning("SQLite FTS5 is not available, falling back to LIKE searches")
+
+    @utils.timer
+    def optimize(self, con):
+        """
+        Gather statistics for the query planner, then rewrite the file without free pages
+        """
+        con.commit()
+        con.execute("ANALYZE")
+        con.commit()
+        con.execute("VACUUM")
+
+    @utils.timer
+    def update_db(self, rows, deleted=(), updated=None):
+        """
+        Replace the cities in ``rows`` and remove the ``deleted`` city ids, keeping aliases
+        and recording ``updated`` as the last update applied. Returns the number of cities
+        replaced or added and the number of cities removed (of the ``deleted`` ids in the DB).
+        """
+        deleted = set(deleted)
+        rows = [with_keys(row) for row in rows if row[0] not in deleted]
+        with self.connection(commit=True) as con:
+            if schema_version(con) < SCHEMA_VERSION:
+                raise DBError(OLD_SCHEMA)
+
+            con.executescript(META_SCHEMA)
+            if "city-country" not in self.indexes(con):
+                con.execute(COUNTRY_INDEX)
+                con.execute('ANALYZE "city-country"')
+
+            con.executemany(
+                "INSERT OR IGNORE INTO changed VALUES (?)",
+                [(row[0],) for row in rows] + [(gid,) for gid in deleted],
+            )
+            tables = self.tables(con)
+            if "city_fts" in tables:
+                con.execute(FTS_DELETE)
+
+            if "city_geo" in tables:
+                con.execute(GEO_DELETE)
+
+            con.execute("DELETE FROM trigram WHERE city_id IN changed")
+            removed = con.executemany(
+                "DELETE FROM city_data WHERE id = ?", [(gid,) for gid in deleted]
+            ).rowcount
+            con.execute("DELETE FROM city_data WHERE id IN changed")
+            con.executemany(CITY_INSERT, list(encode_rows(con, rows)))
+            con.executemany(
+                "INSERT INTO trigram VALUES (?, ?)",
+                [(tri, row[0]) for row in rows for tri in trigrams(row[9]) | trigrams(row[10])],
+            )
+            if "city_fts" in tables:
+                con.execute(FTS_INSERT)
+
+            if "city_geo" in tables:
+                con.execute(GEO_INSERT)
+
+            if updated:
+                con.execute("REPLACE INTO meta VALUES ('updated', ?)", (updated,))
+
+        self._tables = self._lookups = None
+        self.generation += 1
+        return len(rows), removed
+
+    def meta(self):
+        with self.connection() as con:
+            if "meta" not in self.tables(con):
+                return {}
+
+            return dict(con.execute("SELECT key, value FROM meta"))
+
+    def set_meta(self, **values):
+        with self.connection(commit=True) as con:
+            con.executescript(META_SCHEMA)
+            con.executemany("REPLACE INTO meta VALUES (?, ?)", values.items())
+
+        self._tables = None
+
+    @utils.timer
+    def migrate(self):
+        """
+        Rebuild a database made with an older schema in the current one, keeping its
+        alternate names and build settings, and moving its hand-made aliases to the user
+        overlay. Returns ``False`` if it is already up to date.
+        """
+        if not self.filename.exists():
+            raise DBError(MISSING_DB)
+
+        with contextlib.closing(self._db) as con:
+            if schema_version(con) >= SCHEMA_VERSION:
+                return False
+
+            tables = self.tables(con)
+            found = {row[1] for row in con.execute('PRAGMA table_info("city")')}
+            columns = ", ".join(col if col in found else "NULL" for col in MIGRATE_COLUMNS)
+            rows = con.execute(f"SELECT {columns} FROM city").fetchall()
+            found = {row[1] for row in con.execute('PRAGMA table_info("alias")')}
+            aliases = []
+            if "lang" in found:
+                sql = "SELECT alias, city_id, lang FROM alias WHERE lang IS NOT NULL"
+                aliases = con.execute(sql).fetchall()
+
+            self.keep_aliases(con)
+            meta = dict(con.execute("SELECT key, value FROM meta")) if "meta" in tables else {}
+
+        migrated = DB(self.filename.with_suffix(".migrate"), persistent=False)
+        try:
+            migrated.create_db(rows)
+            with migrated.connection(commit=True) as con:
+                con.executemany(
+                    "INSERT OR IGNORE INTO alias (alias, city_id, key, lang) VALUES (?, ?, ?, ?)",
+                    [(alias, gid, normalize(alias), lang) for alias, gid, lang in aliases],
+                )
+
+            migrated.set_meta(**meta)
+            self.close()
+            os.replace(migrated.filename, self.filename)
+        finally:
+            migrated.filename.unlink(missing_ok=True)
+
+        self._tables = self._lookups = None
+        self.generation += 1
+        logger.info(f"Migrated {len(rows):,} rows to schema version {SCHEMA_VERSION}")
+        return True
+
     def _execute(self, con, sql, params):
-        return con.execute(sql, params).fetchall()
+        if self.profiler is None:
+            return con.execute(sql, params).fetchall()
+
+        start = time.perf_counter()
+        rows = con.execute(sql, params).fetchall()
+        elapsed = time.perf_counter() - start
+        self.profiler.record(con, sql, params, elapsed, len(rows))
+        return rows
+
+    @contextlib.contextmanager
+    def profile(self, explain=True):
+        """
+        Record the statements this instance runs within the block:
+
+            with db.profile() as profiler:
+                db.search("paris")
+
+            print(profiler.report())
+        """
+        self.profiler = Profiler(explain)
+        try:
+            yield self.profiler
+        finally:
+            self.profiler = None
+
+    def tables(self, con):
+        if self._tables is None:
+            self._tables = {name for (name,) in con.execute(TABLES_QUERY)}
+
+        return self._tables
 
-    def _search(self, sql, value, params):
+    def indexes(self, con):
+        return {name for (name,) in con.execute(INDEXES_QUERY)}
+
+    def lookups(self, con):
+        """
+        The country codes, subdivision names and zone names of the lookup tables, by id
+        """
+        if self._lookups is None:
+            self._lookups = tuple(
+                Lookup(self, table, columns[0], con) for table, columns in LOOKUPS.items()
+            )
+
+        return self._lookups
+
+    def cities(self, con, rows):
+        """
+        ``City`` objects for ``CITY_COLUMNS`` rows, decoded with the cached ``lookups``
+        """
+        cos, subs, tzs = self.lookups(con)
+        make = City._make
+        return [
+            make((gid, name, ascii, subs[sub], cos[co], tzs[tz]))
+            for gid, name, ascii, sub, co, tz in rows
+        ]
+
+    def use_fts(self, con):
+        if self.fts is not None:
+            return self.fts
+
+        return "city_fts" in self.tables(con)
+
+    def _search(self, value, exact, sub, co, fuzzy=False, limit=None, order=None, by_zone=False):
         with self.connection() as con:
+            # Searches by zone are sorted once ranked, others by the search query itself
+            wrapped = by_zone or (fuzzy and order)
+            columns = RANKED_COLUMNS if wrapped else CITY_COLUMNS
+            base_order = None if by_zone else order
+            sql, params = self.search_query(con, value, exact, sub, co, fuzzy, base_order, columns)
+            if limit is not None or wrapped:
+                sql, params = self.ranked_query(sql, params, limit, order, by_zone)
+
             results = self._execute(con, ALIAS_SEARCH_QUERY, (value,))
             results += self._execute(con, sql, params)
+            cities = self.cities(con, results)
+
+        return ranked(cities, limit, by_zone)
 
-        return City.from_results(results)
+    def ranked_query(self, sql, params, limit=None, order=None, by_zone=False):
+        """
+        Limit a ``search_query`` to ``limit`` cities and, if ``by_zone``, to the most
+        populous city per zone. Fuzzy matches are sorted by ``order`` here, from the closest
+        ``FUZZY_LIMIT`` names (or ``limit``, if more).
+        """
+        check_order(order)
+        fuzzy = "min_shared" in params
+        params = params | {"max_rows": -1 if limit is None else limit}
+        if by_zone:
+            sql = RANKED_QUERY.format(query=sql, order=SEARCH_ORDERS[order][1])
+        elif fuzzy:
+            if order:
+                sql = ORDERED_QUERY.format(query=sql, order=SEARCH_ORDERS[order][1])
+        else:
+            sql = f"{sql}\nLIMIT :max_rows"
+
+        if limit is not None and fuzzy:
+            params["limit"] = max(limit, FUZZY_LIMIT)
+
+        return sql, params
 
     def parse_search(self, value):
-        bits = [a.strip().upper() for a in value.split(",")]
+        bits = [normalize(a.strip()) for a in value.split(",")]
         nbits = len(bits)
         if nbits > 3:
             raise DBError(f"Invalid city search expression: {value}")
@@ -211,35 +1384,204 @@ class DB:
             case 3:
                 return bits
 
-    def search(self, value, exact=False):
-        value, sub, co = self.parse_search(value)
+    def fuzzy_query(self, con, value, sub=None, co=None, columns=CITY_COLUMNS):
+        if "trigram" not in self.tables(con):
+            raise DBError(MISSING_TRIGRAMS)
+
+        grams = sorted(trigrams(value))
+        data = {
+            "ntri": len(grams),
+            "min_shared": max(1, math.ceil(FUZZY_THRESHOLD * len(grams))),
+            "threshold": FUZZY_THRESHOLD,
+            "limit": FUZZY_LIMIT,
+        }
+        data.update((f"t{i}", gram) for i, gram in enumerate(grams))
+        filters = ""
+        if co:
+            data["co"] = co
+            filters = f"AND {CO_FILTER}"
+            if sub:
+                data["sub"] = sub
+                filters = f"{filters} AND {SUB_FILTER}"
+
+        placeholders = ", ".join(f":t{i}" for i in range(len(grams))) or "NULL"
+        return FUZZY_SEARCH_QUERY.format(placeholders, filters, columns=columns), data
+
+    def search_query(
+        self, con, value, exact=False, sub=None, co=None, fuzzy=False, order=None, columns=None
+    ):
+        check_order(order)
+        columns = columns or CITY_COLUMNS
+        if fuzzy:
+            return self.fuzzy_query(con, value, sub, co, columns)
+
         if exact:
             data = {"value": value}
-            sql = XSEARCH_QUERY
+            sql = XSEARCH_QUERY.format(columns=columns)
             if co:
                 data["co"] = co
-                sql = f"{sql} AND UPPER(c.co) = :co"
+                sql = f"{sql} AND {CO_FILTER}"
                 if sub:
                     data["sub"] = sub
-                    sql = f"{sql} AND UPPER(c.sub) = :sub"
+                    sql = f"{sql} AND {SUB_FILTER}"
 
-            return self._search(sql, value, data)
+            return f"{sql} ORDER BY {SEARCH_ORDERS[order][0]}", data
+
+        data = {"value": value, "co": co, "sub": sub}
+        if self.use_fts(con):
+            data["match"] = fts_match(value)
+            exprs = [FTS_MATCH_EXPR]
+        else:
+            data["like"] = f"%{value}%"
+            exprs = ["c.name_key LIKE :like", "c.ascii_key LIKE :like"]
 
-        like_exprs = ["c.name LIKE :like", "c.ascii LIKE :like"]
         if co:
-            like_exprs = (
-                [f"({bit} AND c.co = :co AND UPPER(c.sub) = :sub)" for bit in like_exprs]
+            exprs = (
+                [f"({bit} AND {CO_FILTER} AND {SUB_FILTER})" for bit in exprs]
                 if sub
-                else [f"({bit} AND c.co = :co)" for bit in like_exprs]
+                else [f"({bit} AND {CO_FILTER})" for bit in exprs]
             )
 
-        return self._search(
-            SEARCH_QUERY.format(" OR ".join(like_exprs)),
-            value,
-            {
-                "like": f"%{value}%",
-                "value": value,
-                "co": co,
-                "sub": sub,
-            },
-        )
+        sql = SEARCH_QUERY.format(" OR ".join(exprs), columns=columns)
+        return (f"{sql}ORDER BY {SEARCH_ORDERS[order][0]}" if order else sql), data
+
+    def search(self, value, exact=False, fuzzy=False, limit=None, order=None, by_zone=False):
+        """
+        Search for cities by id, alias or name. ``fuzzy`` searches are typo-tolerant and
+        return the ``FUZZY_LIMIT`` closest names, most populous first among equals.
+
+        Alias matches come first, then at most ``limit`` cities in all, in table (or
+        similarity) order, or most populous first for ``order="population"``. With
+        ``by_zone``, only the most populous city of each zone is kept.
+        """
+        if limit is not None:
+            check_limit(limit)
+
+        value, sub, co = self.parse_search(value)
+        return self._search(value, exact, sub, co, fuzzy, limit, order, by_zone)
+
+    def search_many(self, values, exact=False, fuzzy=False, limit=None, order=None, by_zone=False):
+        """
+        Resolve several city search expressions in a single query (per batch of
+        ``SEARCH_MANY_BATCH`` inputs), returning a dict of input => list of ``City``.
+        ``limit``, ``order`` and ``by_zone`` apply to each input, as for ``search``.
+        """
+        if limit is not None:
+            check_limit(limit)
+
+        if fuzzy:
+            return {
+                value: self.search(value, False, True, limit, order, by_zone) for value in values
+            }
+
+        check_order(order)
+        rank = limit is not None or order or by_zone
+        values = list(dict.fromkeys(values))
+        parsed = [self.parse_search(value) for value in values]
+        found = {value: [] for value in values}
+        with self.connection() as con:
+            kind = "exact" if exact else ("fts" if self.use_fts(con) else "like")
+            for start in range(0, len(parsed), SEARCH_MANY_BATCH):
+                batch = parsed[start : start + SEARCH_MANY_BATCH]
+                params = []
+                for idx, (value, sub, co) in enumerate(batch, start):
+                    params.extend(
+                        [idx, value, sub, co, fts_match(value) if kind == "fts" else None]
+                    )
+
+                sql = SEARCH_MANY_QUERY.format(
+                    values=", ".join(["(?, ?, ?, ?, ?)"] * len(batch)),
+                    match=SEARCH_MANY_MATCH[kind],
+                    columns=RANKED_COLUMNS if rank else CITY_COLUMNS,
+                )
+                if rank:
+                    sql = RANKED_MANY_QUERY.format(
+                        query=sql,
+                        partition="m.tz_id" if by_zone else "m.part, m.id",
+                        order=SEARCH_ORDERS[order][2],
+                        limit="" if limit is None else f"WHERE rank <= {int(limit)}",
+                    )
+
+                cos, subs, tzs = self.lookups(con)
+                for idx, _, gid, name, ascii, sub, co, tz in self._execute(con, sql, params):
+                    city = City._make((gid, name, ascii, subs[sub], cos[co], tzs[tz]))
+                    found[values[idx]].append(city)
+
+        return found
+
+    def country_filters(self, co, sub=None, min_pop=None):
+        params = {"co": co.upper(), "sub": normalize(sub) if sub else None, "min_pop": min_pop}
+        filters = " ".join(sql for key, sql in COUNTRY_FILTERS.items() if params[key])
+        return filters, params
+
+    def cities_in(self, co, sub=None, min_pop=None, limit=None):
+        """
+        The cities of country ``co`` (and subdivision ``sub``, by name) with at least
+        ``min_pop`` people, most populous first
+        """
+        filters, params = self.country_filters(co, sub, min_pop)
+        params["max_rows"] = -1 if limit is None else limit
+        with self.connection() as con:
+            return self.cities(con, self._execute(con, CITIES_IN_QUERY.format(filters), params))
+
+    def zones_in(self, co, sub=None):
+        """
+        The distinct zone names of the cities of country ``co`` (and subdivision ``sub``),
+        starting with the zone of the most populous city
+        """
+        filters, params = self.country_filters(co, sub)
+        with self.connection() as con:
+            return [tz for (tz,) in self._execute(con, ZONES_IN_QUERY.format(filters), params)]
+
+    def completions(self):
+        """
+        Yield a (name, search key, population, kind) row for each city name and alias, where
+        ``kind`` is ``city`` or ``alias``
+        """
+        with self.connection() as con:
+            yield from con.execute(COMPLETIONS_QUERY)
+
+    def zone_populations(self):
+        """
+        The population of the most populous city of each zone, by zone name
+        """
+        with self.connection() as con:
+            return {tz: pop or 0 for tz, pop in con.execute(ZONE_POPULATION_QUERY)}
+
+    def _nearest(self, con, lat, lng, limit):
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise DBError(f"Invalid coordinates: {lat}, {lng}")
+
+        if "city_geo" not in self.tables(con):
+            raise DBError(MISSING_GEO)
+
+        found = []
+        for radius in NEAR_RADII:
+            rows = {}
+            for south, north, west, east in near_boxes(lat, lng, radius):
+                params = {"south": south, "north": north, "west": west, "east": east}
+                rows.update((row[0], row) for row in self._execute(con, NEAR_QUERY, params))
+
+            found = sorted((distance(lat, lng, *row[6:]), row) for row in rows.values())
+            found = found[:limit]
+            if len(found) == limit and found[-1][0] <= radius * KM_PER_DEGREE:
+                break
+
+        cities = self.cities(con, [row[:6] for _, row in found])
+        return [(city, dist) for city, (dist, _) in zip(cities, found)]
+
+    def nearest(self, lat, lng, limit=1):
+        """
+        The ``limit`` cities closest to ``lat, lng``, as a list of (``City``, km) pairs
+        """
+        check_limit(limit)
+        with self.connection() as con:
+            return self._nearest(con, lat, lng, limit)
+
+    def nearest_many(self, points, limit=1):
+        """
+        ``nearest`` for each (lat, lng) in ``points``, sharing one connection
+        """
+        check_limit(limit)
+        with self.connection() as con:
+            return [self._nearest(con, lat, lng, limit) for lat, lng in points]
@@ -0,0 +1,539 @@
+"""
+In-memory city lookups, as an alternative to querying SQLite for every search.
+
+``CityIndex`` loads the ``city`` and ``alias`` tables once into array-backed columns,
+with sorted, normalized keys for binary-search exact and word-prefix lookups, and keeps
+a binary snapshot of those columns next to the database file for quick reloads.
+
+``PrefixIndex`` answers search-as-you-type completions from the same kind of sorted keys.
+"""
+
+import heapq
+import io
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import accumulate, chain, pairwise
+from pathlib import Path
+
+from .. import utils
+from .client import DB, DB_FILENAME, City, check_limit, check_order, normalize, ranked
+
+logger = utils.logger()
+
+SNAPSHOT_MAGIC = b"WHENIDX1"
+SNAPSHOT_SUFFIX = ".idx"
+COMPLETION_SUFFIX = ".cmp"
+MAX_CHAR = "\U0010ffff"
+COMPLETION_TOP = 16
+COMPLETION_SPAN = 64
+
+CITY_COLUMNS_QUERY = """
+SELECT id, name, ascii, sub, co, tz, pop, name_key, ascii_key, sub_key
+FROM city
+ORDER BY id
+"""
+
+ALIAS_COLUMNS_QUERY = """
+SELECT a.key, c.id
+FROM alias_all a
+JOIN city c ON a.city_id = c.id
+ORDER BY a.key, c.pop DESC
+"""
+
+
+class Strings:
+    """
+    Compact, immutable sequence of strings, stored as one string and an array of offsets
+    """
+
+    __slots__ = ("offsets", "text")
+
+    def __init__(self, values=(), text=None, offsets=None):
+        if text is None:
+            values = list(values)
+            offsets = array("I", [0])
+            for value in values:
+                offsets.append(offsets[-1] + len(value))
+
+            text = "".join(values)
+
+        self.text = text
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.text[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        text, offsets = self.text, self.offsets
+        return (text[start:end] for start, end in pairwise(offsets))
+
+    def to_bytes(self):
+        return struct.pack("<I", len(self.offsets)) + self.offsets.tobytes() + self.text.encode()
+
+    @classmethod
+    def from_bytes(cls, data):
+        (count,) = struct.unpack_from("<I", data)
+        offsets = array("I")
+        offsets.frombytes(data[4 : 4 + count * offsets.itemsize])
+        text = data[4 + count * offsets.itemsize :].decode()
+        return cls(text=text, offsets=offsets)
+
+
+class StringsBuilder:
+    """
+    Appends strings one at a time, for a ``Strings`` built without holding them all
+    """
+
+    __slots__ = ("offsets", "text")
+
+    def __init__(self):
+        self.text = io.StringIO()
+        self.offsets = array("I", [0])
+
+    def append(self, value):
+        self.text.write(value)
+        self.offsets.append(self.offsets[-1] + len(value))
+
+    def build(self):
+        return Strings(text=self.text.getvalue(), offsets=self.offsets)
+
+
+class Interned:
+    """
+    Column of repeated strings, stored as an array of indices into the distinct values
+    """
+
+    __slots__ = ("indices", "values")
+
+    def __init__(self, values, indices):
+        self.values = values
+        self.indices = indices
+
+    @classmethod
+    def from_values(cls, values):
+        lookup = {}
+        indices = array("I", (lookup.setdefault(value, len(lookup)) for value in values))
+        return cls(Strings(lookup), indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        return self.values[self.indices[i]]
+
+    def __iter__(self):
+        values = list(self.values)
+        return (values[i] for i in self.indices)
+
+
+class InternedBuilder:
+    """
+    Appends repeated strings one at a time, for an ``Interned`` column
+    """
+
+    __slots__ = ("indices", "lookup")
+
+    def __init__(self):
+        self.lookup = {}
+        self.indices = array("I")
+
+    def append(self, value):
+        lookup = self.lookup
+        self.indices.append(lookup.setdefault(value, len(lookup)))
+
+    def build(self):
+        return Interned(Strings(self.lookup), self.indices)
+
+
+def write_columns(fp, columns):
+    """
+    Write a dict of name => ``array`` | ``Strings`` | ``Interned`` to a binary file.
+    Arrays are written in native byte order.
+    """
+    fp.write(SNAPSHOT_MAGIC)
+    fp.write(struct.pack("<I", len(columns)))
+    for name, column in columns.items():
+        match column:
+            case array():
+                kind, parts = f"a{column.typecode}", [column.tobytes()]
+            case Strings():
+                kind, parts = "s ", [column.to_bytes()]
+            case Interned():
+                kind, parts = "i ", [column.values.to_bytes(), column.indices.tobytes()]
+
+        header = name.encode()
+        fp.write(struct.pack("<H", len(header)) + header + kind.encode())
+        fp.write(struct.pack("<I", len(parts)))
+        for part in parts:
+            fp.write(struct.pack("<Q", len(part)))
+            fp.write(part)
+
+
+def read_columns(fp):
+    if fp.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError("Not a column snapshot file")
+
+    def read_bytes(size):
+        data = fp.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated column snapshot file")
+
+        return data
+
+    def read(fmt):
+        return struct.unpack(fmt, read_bytes(struct.calcsize(fmt)))[0]
+
+    columns = {}
+    for _ in range(read("<I")):
+        name = read_bytes(read("<H")).decode()
+        kind = read_bytes(2).decode()
+        parts = [read_bytes(read("<Q")) for _ in range(read("<I"))]
+        match kind[0]:
+            case "a":
+                column = array(kind[1])
+                column.frombytes(parts[0])
+            case "s":
+                column = Strings.from_bytes(parts[0])
+            case "i":
+                indices = array("I")
+                indices.frombytes(parts[1])
+                column = Interned(Strings.from_bytes(parts[0]), indices)
+            case _:
+                raise ValueError(f"Unknown column kind {kind!r}")
+
+        columns[name] = column
+
+    return columns
+
+
+def sorted_index(pairs):
+    """
+    Build a (``Strings`` of sorted keys, ``array`` of rows) lookup from (key, row) pairs
+    """
+    pairs = sorted(set(pairs))
+    return Strings(key for key, _ in pairs), array("I", (row for _, row in pairs))
+
+
+def prefix_range(keys, prefix):
+    return bisect_left(keys, prefix), bisect_left(keys, prefix + MAX_CHAR)
+
+
+Completion = namedtuple("Completion", ["text", "kind", "pop"])
+
+
+def is_fresh(snapshot, files):
+    """
+    Whether ``snapshot`` exists and is no older than any of the existing ``files``
+    """
+    if not snapshot.exists():
+        return False
+
+    changed = max((f.stat().st_mtime for f in files if f.exists()), default=0)
+    return snapshot.stat().st_mtime >= changed
+
+
+def load_columns(snapshot, files, build):
+    """
+    Columns read from ``snapshot``, unless the first of ``files`` is missing, ``snapshot``
+    is older than any of them or unreadable: then they are ``build()`` and written to
+    ``snapshot``
+    """
+    if files[0].exists() and is_fresh(snapshot, files):
+        try:
+            with snapshot.open("rb") as fp:
+                return read_columns(fp)
+        except (ValueError, struct.error, UnicodeDecodeError) as err:
+            logger.warning(f"Rebuilding unreadable index snapshot {snapshot}: {err}")
+
+    columns = build()
+    try:
+        with snapshot.open("wb") as fp:
+            write_columns(fp, columns)
+    except OSError as err:
+        logger.warning(f"Unable to write index snapshot {snapshot}: {err}")
+
+    return columns
+
+
+class PrefixIndex:
+    """
+    Completions of a prefix, most populous first, from the columns of ``build_columns``.
+
+    Entries are numbered in rank order and their keys sorted, so the candidates for a
+    prefix are a contiguous range of keys whose smallest entry numbers are the best. The
+    ``top`` best of every prefix of more than ``span`` keys are worked out up front, which
+    keeps each lookup down to a binary search and a heap over at most ``span`` items.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.top = columns["top"][0]
+        self.best = {key: i for i, key in enumerate(columns["best_key"])}
+
+    def __len__(self):
+        return len(self.columns["text"])
+
+    @classmethod
+    def from_entries(cls, entries, top=COMPLETION_TOP, span=COMPLETION_SPAN):
+        return cls(cls.build_columns(entries, top, span))
+
+    @classmethod
+    @utils.timer
+    def build_columns(cls, entries, top=COMPLETION_TOP, span=COMPLETION_SPAN):
+        """
+        Columns for (text, kind, population, keys) ``entries``, whose keys are already
+        ``normalize``d. Texts given more than once are merged, keeping the highest population.
+        """
+        pops, kinds, pairs = {}, {}, []
+        for text, kind, pop, keys in entries:
+            pop = pop or 0
+            if pops.get(text, -1) < pop:
+                pops[text], kinds[text] = pop, kind
+
+            pairs.extend((key, text) for key in keys if key)
+
+        texts = sorted(pops, key=lambda text: (-pops[text], text))
+        numbers = {text: i for i, text in enumerate(texts)}
+        keys, key_entries = sorted_index((key, numbers[text]) for key, text in pairs)
+        best = cls.best_entries(list(keys), key_entries, top, span)
+        best_keys = sorted(best)
+        return {
+            "top": array("I", [top]),
+            "text": Strings(texts),
+            "kind": Interned.from_values(kinds[text] for text in texts),
+            "pop": array("q", (pops[text] for text in texts)),
+            "key": keys,
+            "key_entry": key_entries,
+            "best_key": Strings(best_keys),
+            "best_offset": array("I", [0, *accumulate(len(best[key]) for key in best_keys)]),
+            "best_entry": array("I", chain.from_iterable(best[key] for key in best_keys)),
+        }
+
+    @staticmethod
+    def best_entries(keys, key_entries, top, span):
+        """
+        The ``top`` smallest entries of each prefix of more than ``span`` ``keys``, by prefix
+        """
+        best, ranges = {}, [(0, len(keys), 0)]
+        while ranges:
+            lo, hi, depth = ranges.pop()
+            best[keys[lo][:depth] if lo < hi else ""] = heapq.nsmallest(
+                top, set(key_entries[lo:hi])
+            )
+            while lo < hi:
+                if len(keys[lo]) == depth:
+                    lo += 1
+                    continue
+
+                end = bisect_left(keys, keys[lo][: depth + 1] + MAX_CHAR, lo, hi)
+                if end - lo > span:
+                    ranges.append((lo, end, depth + 1))
+
+                lo = end
+
+        return best
+
+    def complete(self, prefix, limit=COMPLETION_TOP):
+        cols, key = self.columns, normalize(prefix)
+        if limit is not None and limit <= self.top and (i := self.best.get(key)) is not None:
+            offsets = cols["best_offset"]
+            found = cols["best_entry"][offsets[i] : offsets[i] + limit]
+        else:
+            lo, hi = prefix_range(cols["key"], key)
+            entries = set(cols["key_entry"][lo:hi])
+            found = sorted(entries) if limit is None else heapq.nsmallest(limit, entries)
+
+        texts, kinds, pops = cols["text"], cols["kind"], cols["pop"]
+        return [Completion(texts[i], kinds[i], pops[i]) for i in found]
+
+
+class CityIndex(DB):
+    """
+    Drop-in replacement for ``DB`` in ``When(db=...)`` that answers ``search`` and
+    ``search_many`` from memory. Fuzzy searches, and all writes, still go through SQLite;
+    writes also discard the in-memory columns and the snapshot.
+    """
+
+    def __init__(self, filename=DB_FILENAME, snapshot=None, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.snapshot = Path(snapshot) if snapshot else self.filename.with_suffix(SNAPSHOT_SUFFIX)
+        self._columns = None
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = self.load()
+
+        return self._columns
+
+    def is_fresh(self):
+        return is_fresh(self.snapshot, [self.filename, self.user_filename])
+
+    def load(self):
+        return load_columns(self.snapshot, [self.filename, self.user_filename], self.build_columns)
+
+    def reset(self):
+        self._columns = None
+        self.snapshot.unlink(missing_ok=True)
+
+    @utils.timer
+    def build_columns(self):
+        with self.connection() as con:
+            rows = con.execute(CITY_COLUMNS_QUERY).fetchall()
+            aliases = con.execute(ALIAS_COLUMNS_QUERY).fetchall()
+
+        ids, names, asciis, subs, cos, tzs, pops, name_keys, ascii_keys, sub_keys = (
+            zip(*rows) if rows else [()] * 10
+        )
+        keys, key_rows = sorted_index(
+            (key, row) for row, pair in enumerate(zip(name_keys, ascii_keys)) for key in set(pair)
+        )
+        words, word_rows = sorted_index(
+            (word, row)
+            for row, pair in enumerate(zip(name_keys, ascii_keys))
+            for word in set(re.findall(r"\w+", " ".join(pair)))
+        )
+        row_by_id = {gid: row for row, gid in enumerate(ids)}
+        return {
+            "id": array("q", ids),
+            "pop": array("q", (pop or 0 for pop in pops)),
+            "name": Strings(names),
+            "ascii": Strings(asciis),
+            "sub": Interned.from_values(subs),
+            "sub_key": Interned.from_values(sub_keys),
+            "co": Interned.from_values(cos),
+            "tz": Interned.from_values(tzs),
+            "key": keys,
+            "key_row": key_rows,
+            "word": words,
+            "word_row": word_rows,
+            "alias": Strings(alias for alias, _ in aliases),
+            "alias_row": array("I", (row_by_id[gid] for _, gid in aliases)),
+        }
+
+    def create_db(self, data, remove_existing=True):
+        super().create_db(data, remove_existing)
+        self.reset()
+
+    def update_db(self, rows, deleted=(), updated=None):
+        counts = super().update_db(rows, deleted, updated)
+        self.reset()
+        return counts
+
+    def add_alias(self, name, gid):
+        super().add_alias(name, gid)
+        self.reset()
+
+    def import_aliases(self, aliases, conflict="replace"):
+        counts = super().import_aliases(aliases, conflict)
+        self.reset()
+        return counts
+
+    def add_alt_names(self, names):
+        added = super().add_alt_names(names)
+        self.reset()
+        return added
+
+    def migrate(self):
+        migrated = super().migrate()
+        self.reset()
+        return migrated
+
+    def city(self, row):
+        cols = self.columns
+        return City(
+            cols["id"][row],
+            cols["name"][row],
+            cols["ascii"][row],
+            cols["sub"][row],
+            cols["co"][row],
+            cols["tz"][row],
+        )
+
+    def _id_rows(self, value):
+        if not value.isdigit():
+            return set()
+
+        ids = self.columns["id"]
+        row = bisect_left(ids, int(value))
+        return {row} if row < len(ids) and ids[row] == int(value) else set()
+
+    def _exact_rows(self, value):
+        keys = self.columns["key"]
+        lo, hi = bisect_left(keys, value), bisect_left(keys, value + "\0")
+        return set(self.columns["key_row"][lo:hi])
+
+    def _word_rows(self, value):
+        words, word_rows = self.columns["word"], self.columns["word_row"]
+        rows = None
+        for token in re.findall(r"\w+", value):
+            lo, hi = prefix_range(words, token)
+            found = set(word_rows[lo:hi])
+            rows = found if rows is None else rows & found
+            if not rows:
+                break
+
+        return rows or set()
+
+    def _filter(self, rows, sub, co):
+        cos, sub_keys = self.columns["co"], self.columns["sub_key"]
+        if co:
+            rows = {row for row in rows if cos[row] == co}
+            if sub:
+                rows = {row for row in rows if sub_keys[row] == sub}
+
+        return rows
+
+    def _alias_rows(self, value):
+        aliases = self.columns["alias"]
+        lo, hi = bisect_left(aliases, value), bisect_left(aliases, value + "\0")
+        return list(self.columns["alias_row"][lo:hi])
+
+    def _ranked_rows(self, rows, order, by_zone):
+        pops, tzs = self.columns["pop"], self.columns["tz"]
+        rows = sorted(rows)
+        if order == "population":
+            rows.sort(key=lambda row: pops[row], reverse=True)
+
+        if by_zone:
+            best = {}
+            for row in rows:
+                tz = tzs[row]
+                if tz not in best or pops[row] > pops[best[tz]]:
+                    best[tz] = row
+
+            rows = [row for row in rows if best[tzs[row]] == row]
+
+        return rows
+
+    def search(self, value, exact=False, fuzzy=False, limit=None, order=None, by_zone=False):
+        if fuzzy:
+            return super().search(value, exact, fuzzy, limit, order, by_zone)
+
+        check_order(order)
+        if limit is not None:
+            check_limit(limit)
+
+        value, sub, co = self.parse_search(value)
+        if exact:
+            rows = self._filter(self._id_rows(value) | self._exact_rows(value), sub, co)
+        else:
+            rows = self._id_rows(value) | self._filter(self._word_rows(value), sub, co)
+
+        rows = [*self._alias_rows(value), *self._ranked_rows(rows, order, by_zone)]
+        return ranked([self.city(row) for row in rows], limit, by_zone)
+
+    def search_many(self, values, exact=False, fuzzy=False, limit=None, order=None, by_zone=False):
+        if fuzzy:
+            return super().search_many(values, exact, fuzzy, limit, order, by_zone)
+
+        return {
+            value: self.search(value, exact, False, limit, order, by_zone)
+            for value in dict.fromkeys(values)
+        }
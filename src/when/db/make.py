@@ -1,10 +1,21 @@
+import csv
+import hashlib
 import io
-import time
+import json
+import os
+import re
+import struct
+import sys
 import zipfile
-from collections import defaultdict, namedtuple
+from array import array
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import compress
 from pathlib import Path
 
 from .. import utils
+from .index import InternedBuilder, StringsBuilder, read_columns, write_columns
 
 logger = utils.logger()
 GeoCity = namedtuple(
@@ -15,99 +26,447 @@ DB_DIR = Path(__file__).parent
 GEONAMES_CITIES_URL_FMT = "https://download.geonames.org/export/dump/cities{}.zip"
 GEONAMES_TZ_URL = "https://download.geonames.org/export/dump/timeZones.txt"
 GEONAMES_ADMIN1_URL = "https://download.geonames.org/export/dump/admin1CodesASCII.txt"
+ADMIN1_FILENAME = "admin1CodesASCII.txt"
+GEONAMES_ALT_NAMES_URL = "https://download.geonames.org/export/dump/alternateNamesV2.zip"
+ALT_NAME_LANGUAGES = ["en", "de", "fr", "es", "it", "pt"]
 CITY_FILE_SIZES = {
     500,  # ~10M
     1_000,  # ~7.8M
     5_000,  # ~3.9M
     15_000,  # ~2.3M
 }
+# Capitals and admin division seats each cities file keeps whatever their population
+CITY_FILE_SEATS = {
+    500: {"PPLC", "PPLA", "PPLA2", "PPLA3", "PPLA4"},
+    1_000: {"PPLC", "PPLA", "PPLA2", "PPLA3"},
+    5_000: {"PPLC", "PPLA"},
+    15_000: {"PPLC"},
+}
+CHUNK_SIZE = 1 << 20
+COLUMNS_SUFFIX = ".cols"
+GEONAMES_COLUMNS = ("id", "name", "ascii", "co", "a1", "tz", "pop", "lat", "lng", "fcode")
+RECORD_FORMATS = {".ndjson": "ndjson", ".jsonl": "ndjson"}
+UPDATE_FILE_RE = re.compile(r"(modifications|deletes)-(\d{4}-\d{2}-\d{2})\.txt")
 
 
 @utils.timer
-def fetch_cities(size, dirname=DB_DIR):
-    assert size in CITY_FILE_SIZES, f"{size} is invalid"
-    txt_filename = dirname / f"cities{size}.txt"
-    if txt_filename.exists():
-        return txt_filename
+def fetch_alt_names(dirname=DB_DIR):
+    zip_filename = dirname / "alternateNamesV2.zip"
+    if not zip_filename.exists():
+        logger.info(f"Beginning download from {GEONAMES_ALT_NAMES_URL}")
+        utils.download(GEONAMES_ALT_NAMES_URL, zip_filename)
 
-    url = GEONAMES_CITIES_URL_FMT.format(size)
-    logger.info(f"Beginning download from {url}")
-    start = time.time()
-    zip_bytes = utils.fetch(url)
-    end = time.time()
-    logger.info(f"Received {len(zip_bytes):,} bytes in {end - start:,}s")
-    zip_filename = io.BytesIO(zip_bytes)
-    with zipfile.ZipFile(zip_filename) as z:
-        z.extract(txt_filename.name, txt_filename.parent)
+    return zip_filename
 
-    return txt_filename
 
+@contextmanager
+def open_geonames(filename, binary=False):
+    """
+    Open a GeoNames ``.txt`` file, or the ``.txt`` member of a ``.zip`` file without
+    extracting it, for reading lines (or bytes, if ``binary``).
+    """
+    filename = Path(filename)
+    if filename.suffix != ".zip":
+        with filename.open("rb") if binary else filename.open(encoding="utf-8") as fp:
+            yield fp
+
+        return
+
+    with zipfile.ZipFile(filename) as z, z.open(f"{filename.stem}.txt") as member:
+        yield member if binary else io.TextIOWrapper(member, encoding="utf-8")
+
+
+# Unconditionally kept
+# --------------------
+# PPLA   seat of a first-order administrative division, seat of a first-order
+#        administrative division (PPLC takes precedence over PPLA)
+# PPLA2  seat of a second-order administrative division
+# PPLA3  seat of a third-order administrative division
+# PPLA4  seat of a fourth-order administrative division
+# PPLA5  seat of a fifth-order administrative division
+# PPLC   capital of a political entity
+# PPLG   seat of government of a political entity
+
+# Unconditionally skipped
+# -----------------------
+# PPLCH  historical capital of a political entity a former capital of a political entity
+# PPLH   historical populated place, a populated place that no longer exists
+# PPLQ   abandoned populated place
+# PPLW   destroyed populated place, a village, town or city destroyed by a natural disaster,
+#        or by war
+# PPLX   section of populated place
+# STLMT  israeli settlement
+SKIP = {"PPLCH", "PPLH", "PPLQ", "PPLW", "PPLX", "STLMT"}
+
+# Conditionally skipped
+# ---------------------
+# PPL    populated place: city, town, village, or other agglomeration of buildings
+#        where people live and work
+# PPLL   populated locality: an area similar to a locality but with a small group of dwellings
+#        or other buildings
+# PPLS   populated places: cities, towns, villages, or other agglomerations of buildings where
+#        people live and work
+# PPLR   religious populated place, a populated place whose population is largely engaged in
+#        religious occupations
+# PPLF   farm village, a populated place where the population is largely engaged in
+#        agricultural activities
+SKIP_IF = {"PPL", "PPLL", "PPLS", "PPLF", "PPLR"}
 
-@utils.timer
-def process_geonames_txt(fobj, minimum_population=15_000, admin_1=None):
-    fcodes = defaultdict(int)
-    skipped = defaultdict(int)
-
-    # Unconditionally kept
-    # --------------------
-    # PPLA   seat of a first-order administrative division, seat of a first-order
-    #        administrative division (PPLC takes precedence over PPLA)
-    # PPLA2  seat of a second-order administrative division
-    # PPLA3  seat of a third-order administrative division
-    # PPLA4  seat of a fourth-order administrative division
-    # PPLA5  seat of a fifth-order administrative division
-    # PPLC   capital of a political entity
-    # PPLG   seat of government of a political entity
-
-    # Unconditionally skipped
-    # -----------------------
-    # PPLCH  historical capital of a political entity a former capital of a political entity
-    # PPLH   historical populated place, a populated place that no longer exists
-    # PPLQ   abandoned populated place
-    # PPLW   destroyed populated place, a village, town or city destroyed by a natural disaster,
-    #        or by war
-    # PPLX   section of populated place
-    # STLMT  israeli settlement
-    skip = {"PPLCH", "PPLH", "PPLQ", "PPLW", "PPLX", "STLMT"}
-
-    # Conditionally skipped
-    # ---------------------
-    # PPL    populated place: city, town, village, or other agglomeration of buildings
-    #        where people live and work
-    # PPLL   populated locality: an area similar to a locality but with a small group of dwellings
-    #        or other buildings
-    # PPLS   populated places: cities, towns, villages, or other agglomerations of buildings where
-    #        people live and work
-    # PPLR   religious populated place, a populated place whose population is largely engaged in
-    #        religious occupations
-    # PPLF   farm village, a populated place where the population is largely engaged in
-    #        agricultural activities
-    skip_if = {"PPL", "PPLL", "PPLS", "PPLF", "PPLR"}
-    admin_1 = admin_1 or {}
-    data = []
-    for i, line in enumerate(fobj, 1):
-        i += 1
-        ct = GeoCity(*line.rstrip().split("\t"))
 
+def keep_city(ct, pop, minimum_population):
+    return not (
+        (ct.fcode in SKIP)
+        or (ct.fcode in SKIP_IF and (pop < minimum_population))
+        or (ct.fcode == "PPLA5" and ct.name.startswith("Marseille") and ct.name[-1].isdigit())
+    )
+
+
+def in_city_file(ct, pop, size):
+    """
+    Whether the GeoNames ``cities{size}`` file includes ``ct``: populated places with a
+    population over ``size``, or capitals and seats of admin divisions
+    """
+    return ct.fclass == "P" and (pop > size or ct.fcode in CITY_FILE_SEATS[size])
+
+
+def city_row(ct, pop, admin_1):
+    sub = admin_1.get(f"{ct.co}.{ct.a1}", ct.a1)
+    return [int(ct.gid), ct.name, ct.aname, ct.co, sub, ct.tz, pop, float(ct.lat), float(ct.lng)]
+
+
+def parse_lines(lines, minimum_population, admin_1, kept, skipped):
+    for line in lines:
+        ct = GeoCity(*line.rstrip().split("\t"))
         pop = int(ct.pop) if ct.pop else 0
-        if (
-            (ct.fcode in skip)
-            or (ct.fcode in skip_if and (pop < minimum_population))
-            or (ct.fcode == "PPLA5" and ct.name.startswith("Marseille") and ct.name[-1].isdigit())
-        ):
+        if not keep_city(ct, pop, minimum_population):
             skipped[ct.fcode] += 1
             continue
 
-        fcodes[ct.fcode] += 1
-        sub = admin_1.get(f"{ct.co}.{ct.a1}", ct.a1)
-        data.append([int(ct.gid), ct.name, ct.aname, ct.co, sub, ct.tz, pop])
+        kept[ct.fcode] += 1
+        yield city_row(ct, pop, admin_1)
+
 
-    for title, dct in [["KEPT", fcodes], ["SKIP", skipped]]:
-        for k, v in sorted(dct.items(), key=lambda kv: kv[1], reverse=True):
+def log_counts(kept, skipped):
+    for title, dct in [["KEPT", kept], ["SKIP", skipped]]:
+        for k, v in dct.most_common():
             logger.debug(f"{title} {k:5}: {v}")
 
-    logger.info(f"Processed {i:,} lines, kept {len(data):,}")
-    return data
+    logger.info(f"Processed {kept.total() + skipped.total():,} lines, kept {kept.total():,}")
+
+
+def process_geonames_txt(fobj, minimum_population=15_000, admin_1=None):
+    kept, skipped = Counter(), Counter()
+    yield from parse_lines(fobj, minimum_population, admin_1 or {}, kept, skipped)
+    log_counts(kept, skipped)
+
+
+def iter_chunks(fobj, chunk_size=CHUNK_SIZE):
+    """
+    Read a binary file object in blocks of roughly ``chunk_size`` bytes, each ending on a
+    line boundary
+    """
+    rest = b""
+    while block := fobj.read(chunk_size):
+        block = rest + block
+        end = block.rfind(b"\n") + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+
+    if rest:
+        yield rest
+
+
+def _read_chunk(chunk):
+    return [geonames_record(line) for line in chunk.decode().splitlines()]
+
+
+def map_chunks(fobj, func, workers, chunk_size=CHUNK_SIZE):
+    """
+    Yield ``func(chunk)`` for each line-aligned chunk of the binary file object ``fobj``, in
+    file order, from a pool of ``workers`` processes. At most two chunks per worker are in
+    flight at once.
+    """
+    pending = deque()
+    with ProcessPoolExecutor(workers) as pool:
+        for chunk in iter_chunks(fobj, chunk_size):
+            pending.append(pool.submit(func, chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def geonames_record(line):
+    """
+    Unfiltered GeoNames city line as a ``GEONAMES_COLUMNS`` tuple
+    """
+    ct = GeoCity(*line.rstrip("\r\n").split("\t"))
+    pop = int(ct.pop) if ct.pop else 0
+    return (
+        int(ct.gid),
+        ct.name,
+        ct.aname,
+        ct.co,
+        ct.a1,
+        ct.tz,
+        pop,
+        float(ct.lat),
+        float(ct.lng),
+        ct.fcode,
+    )
+
+
+def read_geonames(fobj, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield a ``geonames_record`` for every line of the binary file object ``fobj``. Lines
+    are read in line-aligned chunks that are parsed by a pool of ``workers`` processes, and
+    records are yielded in file order. With a single worker, lines are parsed in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(geonames_record, io.TextIOWrapper(fobj, encoding="utf-8"))
+        return
+
+    for records in map_chunks(fobj, _read_chunk, workers, chunk_size):
+        yield from records
+
+
+def geonames_columns(records):
+    """
+    Build the ``GEONAMES_COLUMNS`` of ``records``, with repeated strings interned
+    """
+    ids, pops, lats, lngs = array("q"), array("q"), array("d"), array("d")
+    names, asciis = StringsBuilder(), StringsBuilder()
+    cos, a1s, tzs, fcodes = (InternedBuilder() for _ in range(4))
+    for gid, name, aname, co, a1, tz, pop, lat, lng, fcode in records:
+        ids.append(gid)
+        names.append(name)
+        asciis.append(aname)
+        cos.append(co)
+        a1s.append(a1)
+        tzs.append(tz)
+        pops.append(pop)
+        lats.append(lat)
+        lngs.append(lng)
+        fcodes.append(fcode)
+
+    columns = (ids, names, asciis, cos, a1s, tzs, pops, lats, lngs, fcodes)
+    return {
+        name: column if isinstance(column, array) else column.build()
+        for name, column in zip(GEONAMES_COLUMNS, columns)
+    }
+
+
+def file_checksum(filename):
+    digest = hashlib.sha256()
+    with Path(filename).open("rb") as fp:
+        while block := fp.read(CHUNK_SIZE):
+            digest.update(block)
+
+    return digest.hexdigest()[:16]
+
+
+@utils.timer
+def load_geonames_columns(filename, workers=None):
+    """
+    Parse the GeoNames cities file ``filename`` (``.zip`` or ``.txt``) into unfiltered
+    columns, cached next to it as ``<stem>-<checksum>.cols`` so that builds with other
+    filters skip the parse. Caches of earlier versions of the file are removed.
+    """
+    filename = Path(filename)
+    cache = filename.with_name(f"{filename.stem}-{file_checksum(filename)}{COLUMNS_SUFFIX}")
+    if cache.exists():
+        try:
+            with cache.open("rb") as fp:
+                return read_columns(fp)
+        except (ValueError, struct.error, UnicodeDecodeError) as err:
+            logger.warning(f"Ignoring unreadable columns cache {cache}: {err}")
+
+    with open_geonames(filename, binary=True) as fp:
+        columns = geonames_columns(read_geonames(fp, workers))
+
+    for stale in filename.parent.glob(f"{filename.stem}-*{COLUMNS_SUFFIX}"):
+        stale.unlink()
+
+    try:
+        part = cache.with_suffix(".part")
+        with part.open("wb") as fp:
+            write_columns(fp, columns)
+
+        os.replace(part, cache)
+    except OSError as err:
+        logger.warning(f"Unable to write columns cache {cache}: {err}")
+
+    return columns
+
+
+def process_geonames_columns(columns, minimum_population=15_000, admin_1=None):
+    """
+    Same as ``process_geonames_txt``, for ``load_geonames_columns`` columns. The feature
+    code filters are decided once per distinct code, then applied to whole columns with
+    ``compress``; only the rows kept are built.
+    """
+    admin_1 = admin_1 or {}
+    fcodes, pops, names = columns["fcode"], columns["pop"], columns["name"]
+    codes = list(fcodes.values)
+    always = [code not in SKIP and code not in SKIP_IF for code in codes]
+    if_pop = [code in SKIP_IF for code in codes]
+    keep = [
+        always[fc] or (if_pop[fc] and pop >= minimum_population)
+        for fc, pop in zip(fcodes.indices, pops)
+    ]
+    if "PPLA5" in codes:
+        ppla5 = codes.index("PPLA5")
+        for row in compress(range(len(keep)), (fc == ppla5 for fc in fcodes.indices)):
+            name = names[row]
+            keep[row] = not (name.startswith("Marseille") and name[-1].isdigit())
+
+    kept = Counter(compress(fcodes.indices, keep))
+    skipped = Counter(fcodes.indices) - kept
+    subs = {}
+    rows = zip(
+        columns["id"],
+        names,
+        columns["ascii"],
+        columns["co"],
+        columns["a1"],
+        columns["tz"],
+        pops,
+        columns["lat"],
+        columns["lng"],
+    )
+    for gid, name, ascii, co, a1, tz, pop, lat, lng in compress(rows, keep):
+        if (sub := subs.get((co, a1))) is None:
+            sub = subs[co, a1] = admin_1.get(f"{co}.{a1}", a1)
+
+        yield [gid, name, ascii, co, sub, tz, pop, lat, lng]
+
+    log_counts(
+        Counter({codes[fc]: n for fc, n in kept.items()}),
+        Counter({codes[fc]: n for fc, n in skipped.items()}),
+    )
+
+
+def process_alternate_names(fobj, city_ids, languages=ALT_NAME_LANGUAGES):
+    """
+    Yield (name, city id, language) from a GeoNames ``alternateNamesV2`` file, for the
+    ``city_ids`` and ``languages`` given
+    """
+    languages = set(languages)
+    for line in fobj:
+        _, gid, lang, name, _ = line.split("\t", 4)
+        if lang in languages and (gid := int(gid)) in city_ids:
+            yield name, gid, lang
+
+
+def records_format(filename):
+    """
+    ``ndjson`` for ``.ndjson`` and ``.jsonl`` files, otherwise ``csv``
+    """
+    return RECORD_FORMATS.get(Path(filename).suffix.lower(), "csv")
+
+
+@contextmanager
+def open_records(filename, write=False):
+    """
+    Open a CSV or NDJSON file of records for reading (or writing); ``-`` is stdin (or stdout)
+    """
+    if str(filename) == "-":
+        yield sys.stdout if write else sys.stdin
+        return
+
+    with Path(filename).open("w" if write else "r", encoding="utf-8", newline="") as fp:
+        yield fp
+
+
+def read_records(fobj, fmt="csv"):
+    """
+    Yield each record of a CSV file with a header row, or of an NDJSON file, as a dict.
+    Empty CSV values are read as ``None``.
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(fobj):
+            yield {key: value or None for key, value in row.items()}
+    else:
+        for line in fobj:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_records(fobj, fields, rows, fmt="csv"):
+    """
+    Write ``rows`` of ``fields`` values to ``fobj`` as CSV (with a header row) or NDJSON,
+    one at a time, returning the number of rows written
+    """
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(fobj, lineterminator="\n")
+        writer.writerow(fields)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+    else:
+        for count, row in enumerate(rows, 1):
+            fobj.write(f"{json.dumps(dict(zip(fields, row)), ensure_ascii=False)}\n")
+
+    return count
+
+
+def process_aliases(records):
+    """
+    Yield (alias, city id, language) from ``alias``, ``city_id`` and optional ``lang``
+    records, raising ``ValueError`` for the first invalid one
+    """
+    for n, record in enumerate(records, 1):
+        try:
+            alias = record["alias"].strip()
+            gid = int(record["city_id"])
+        except (KeyError, AttributeError, TypeError, ValueError):
+            raise ValueError(f"Invalid alias record {n:,}: {record}")
+
+        if not alias:
+            raise ValueError(f"Invalid alias record {n:,}: {record}")
+
+        yield alias, gid, record.get("lang")
+
+
+def find_updates(dirname, since=None):
+    """
+    Find the GeoNames daily ``modifications-YYYY-MM-DD.txt`` and ``deletes-YYYY-MM-DD.txt``
+    files in ``dirname`` dated after ``since``, as {date: {kind: path}} in date order
+    """
+    updates = defaultdict(dict)
+    for path in Path(dirname).iterdir():
+        if m := UPDATE_FILE_RE.fullmatch(path.name):
+            kind, date = m.groups()
+            if not since or date > since:
+                updates[date][kind] = path
+
+    return dict(sorted(updates.items()))
+
+
+def process_modifications(fobj, size, minimum_population, admin_1=None):
+    """
+    Split a GeoNames modifications file into the rows to upsert and the ids of cities that
+    would not be in a DB built from ``cities{size}`` with ``minimum_population``: those the
+    file leaves out, that the ``process_geonames_txt`` filters skip, or that are not cities
+    """
+    admin_1 = admin_1 or {}
+    rows, removed = [], []
+    for line in fobj:
+        ct = GeoCity(*line.rstrip("\r\n").split("\t"))
+        pop = int(ct.pop) if ct.pop else 0
+        if in_city_file(ct, pop, size) and keep_city(ct, pop, minimum_population):
+            rows.append(city_row(ct, pop, admin_1))
+        else:
+            removed.append(int(ct.gid))
+
+    return rows, removed
+
+
+def process_deletes(fobj):
+    return [int(line.split("\t", 1)[0]) for line in fobj if line.strip()]
 
 
 def load_admin1(txt):
@@ -120,12 +479,27 @@ def load_admin1(txt):
 
 
 def fetch_admin_1(dirname=DB_DIR):
-    filename = dirname / "admin1CodesASCII.txt"
-    if filename.exists():
-        txt = filename.read_text()
-    else:
-        txt = utils.fetch(GEONAMES_ADMIN1_URL).decode()
-        filename.write_text(txt)
-        logger.info(f"Downloaded {len(txt):,} bytes from {GEONAMES_ADMIN1_URL}")
+    filename = dirname / ADMIN1_FILENAME
+    if not filename.exists():
+        utils.download(GEONAMES_ADMIN1_URL, filename)
+        logger.info(f"Downloaded {filename.stat().st_size:,} bytes from {GEONAMES_ADMIN1_URL}")
+
+    return load_admin1(filename.read_text(encoding="utf-8"))
+
+
+@utils.timer
+def fetch_build_inputs(size, dirname=DB_DIR):
+    """
+    Download the cities file for ``size`` and the admin 1 codes file at the same time,
+    unless they already are in ``dirname``. Returns the cities filename and the admin 1
+    names.
+    """
+    assert size in CITY_FILE_SIZES, f"{size} is invalid"
+    cities = dirname / f"cities{size}.zip"
+    admin_1 = dirname / ADMIN1_FILENAME
+    with utils.Downloader() as downloader:
+        downloader.download_all(
+            {GEONAMES_CITIES_URL_FMT.format(size): cities, GEONAMES_ADMIN1_URL: admin_1}
+        )
 
-    return load_admin1(txt)
+    return cities, load_admin1(admin_1.read_text(encoding="utf-8"))
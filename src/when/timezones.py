@@ -1,6 +1,13 @@
+import fnmatch
 import re
+from functools import cache
+from types import MappingProxyType
 
-from dateutil.tz import gettz, tzoffset
+from dateutil.tz import tzoffset
+
+from . import utils
+
+GLOB_RE = re.compile(r"[*?[]")
 
 ALIASES = {
     "ACDT": [("Australia/Adelaide", "Australian Central Daylight Time")],
@@ -324,7 +331,8 @@ class Zones:
         self._cached = {}
         self.utc_offset_re = re.compile(r"^UTC[+±-]\d\d?(:\d\d)?$", re.IGNORECASE)
 
-    def get(self, abbr):
+    def get(self, abbr, backend=None):
+        backend = backend or utils.tz_backend()
         lower = abbr.lower()
         utc_offset_match = False
         if lower not in self.abbrs:
@@ -332,22 +340,54 @@ class Zones:
             if not utc_offset_match:
                 return []
 
-        if lower not in self._cached:
+        key = (backend.name, lower)
+        if key not in self._cached:
             values = []
             if utc_offset_match:
-                values.append((gettz(abbr), abbr.upper()))
+                values.append((utils.gettz(abbr.upper(), backend), abbr.upper()))
             else:
                 for value, name in self.abbrs[lower]:
-                    values.append(
-                        (
-                            gettz(value) if isinstance(value, str) else tzoffset(name, value),
-                            name,
-                        )
+                    tz = (
+                        utils.gettz(value, backend)
+                        if isinstance(value, str)
+                        else tzoffset(name, value)
                     )
+                    values.append((tz, name))
 
-            self._cached[lower] = values
+            self._cached[key] = values
 
-        return self._cached[lower]
+        return self._cached[key]
 
 
 zones = Zones(ALIASES)
+
+
+class ZoneIndex:
+    """
+    Immutable lookup of zone names, and of their lower-cased forms, to zone names. Names
+    without glob characters are looked up directly rather than matched against every key.
+    """
+
+    __slots__ = ("keys", "lookup")
+
+    def __init__(self, names):
+        lookup = {name: name for name in names}
+        for name in names:
+            lookup[name.lower()] = name
+
+        self.lookup = MappingProxyType(lookup)
+        self.keys = tuple(lookup)
+
+    def find(self, pattern):
+        if GLOB_RE.search(pattern):
+            return fnmatch.filter(self.keys, pattern)
+
+        return [pattern] if pattern in self.lookup else []
+
+
+@cache
+def zone_index():
+    """
+    The ``ZoneIndex`` of all zone names, built on first use and shared from then on
+    """
+    return ZoneIndex(utils.zone_names())
@@ -0,0 +1,210 @@
+"""
+Compiled zone transitions, for converting many timestamps, or one timestamp to many zones.
+
+A ``ZoneTable`` holds the UTC epochs at which a zone's offset changes, and the offset,
+abbreviation and DST flag in effect from each of them, so that converting an epoch to local
+time, or back, is one ``bisect`` rather than a round of ``tzinfo`` calls per datetime.
+Tables give the same results, ``fold`` included, as the ``tzinfo`` they are compiled from.
+"""
+
+import math
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from zoneinfo import TZPATH, ZoneInfo
+
+from dateutil.tz import tzfile, tzoffset, tzutc
+
+from . import utils
+
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+NEVER = -math.inf
+
+Period = namedtuple("Period", "offset abbr isdst")
+
+
+class ZoneTable:
+    __slots__ = ("abbrs", "fold_until", "hi", "isdst", "lo", "offsets", "starts", "trans", "tz")
+
+    def __init__(self, tz, trans, periods, fold_until, starts, lo=-math.inf, hi=math.inf):
+        """
+        ``periods`` are the ``(offset, abbr, isdst)`` in effect before the first of the UTC
+        epochs in ``trans`` and from each one on. ``fold_until`` is the local time up to
+        which each period repeats the end of the one before it (``fold=1``), and ``starts``
+        the local times each period but the first starts at, for ``fold=0`` and ``fold=1``.
+        Epochs outside ``[lo, hi)`` are left to ``tz`` itself.
+        """
+        self.tz = tz
+        self.trans = array("q", trans)
+        offsets, abbrs, isdst = zip(*periods)
+        self.offsets = array("l", offsets)
+        self.abbrs = abbrs
+        self.isdst = array("b", isdst)
+        self.fold_until = array("d", fold_until)
+        self.starts = tuple(array("q", s) for s in starts)
+        self.lo = lo
+        self.hi = hi
+
+    @classmethod
+    def fixed(cls, tz):
+        offset = tz.utcoffset(None)
+        return cls(tz, [], [(int(offset.total_seconds()), tz.tzname(None), 0)], [NEVER], [[], []])
+
+    @classmethod
+    def from_tzfile(cls, source, tz=None, pep495=False):
+        """
+        Compile the transitions read by a dateutil ``tzfile``, as ``tzfile`` itself resolves
+        them or, with ``pep495``, as ``zoneinfo`` does (only between the first and last
+        transitions, past which ``zoneinfo`` follows rules of its own)
+        """
+        trans = source._trans_list_utc
+        if not source._ttinfo_std or (pep495 and len(trans) < 2):
+            return None
+
+        if pep495:
+            infos = [source._ttinfo_before, *source._trans_idx]
+        else:
+            # ``tzfile`` uses its standard time ttinfo from the last transition on
+            infos = [source._get_ttinfo(idx) for idx in range(-1, len(trans))]
+
+        offsets = [info.offset for info in infos]
+        fold_until, start0, start1 = [NEVER], [], []
+        for k, (utc, before, after) in enumerate(zip(trans, offsets, offsets[1:])):
+            if pep495:
+                fold_until.append(utc + before if after < before else NEVER)
+                start0.append(utc + max(before, after))
+                start1.append(utc + min(before, after))
+            else:
+                local = source._trans_list[k]
+                fold_until.append(local + before - after if k else NEVER)
+                start0.append(local + max(0, before - after) if k else local)
+                start1.append(local)
+
+        if start0 != sorted(start0) or start1 != sorted(start1):
+            return None
+
+        periods = [(info.offset, info.abbr, int(info.isdst)) for info in infos]
+        bounds = (trans[1], trans[-1]) if pep495 else ()
+        return cls(tz or source, trans, periods, fold_until, [start0, start1], *bounds)
+
+    def period(self, epoch):
+        p = bisect_right(self.trans, epoch)
+        return Period(self.offsets[p], self.abbrs[p], bool(self.isdst[p]))
+
+    def periods(self, epochs):
+        """
+        The ``Period`` in effect at each of the UTC ``epochs``
+        """
+        results = []
+        for epoch in epochs:
+            if self.lo <= epoch < self.hi:
+                results.append(self.period(epoch))
+            else:
+                dt = datetime.fromtimestamp(epoch, self.tz)
+                offset = int(dt.utcoffset().total_seconds())
+                results.append(Period(offset, dt.tzname(), bool(dt.dst())))
+
+        return results
+
+    def to_local(self, epochs):
+        """
+        Aware local datetimes for each of the UTC ``epochs``, the same as
+        ``datetime.fromtimestamp(epoch, tz)``
+        """
+        tz, trans, offsets, fold_until, lo, hi = (
+            self.tz,
+            self.trans,
+            self.offsets,
+            self.fold_until,
+            self.lo,
+            self.hi,
+        )
+        results = []
+        for epoch in epochs:
+            if lo <= epoch < hi:
+                p = bisect_right(trans, epoch)
+                local = epoch + offsets[p]
+                dt = EPOCH + timedelta(seconds=local)
+                results.append(dt.replace(tzinfo=tz, fold=int(local < fold_until[p])))
+            else:
+                results.append(datetime.fromtimestamp(epoch, tz))
+
+        return results
+
+    def to_utc(self, local, fold=0):
+        """
+        UTC epochs for each of the naive ``local`` datetimes, the same as
+        ``dt.replace(tzinfo=tz, fold=fold).timestamp()``: ``fold`` picks the earlier (0) or
+        later (1) of an ambiguous time, and the offset from before (0) or after (1) a gap
+        """
+        tz, offsets, starts, lo, hi = self.tz, self.offsets, self.starts[fold], self.lo, self.hi
+        results = []
+        for dt in local:
+            epoch = (dt - EPOCH) / SECOND
+            epoch -= offsets[bisect_right(starts, epoch)]
+            if not lo <= epoch < hi:
+                epoch = dt.replace(tzinfo=tz, fold=fold).timestamp()
+
+            results.append(epoch)
+
+        return results
+
+
+def zoneinfo_source(tz):
+    if tz.key:
+        for dirname in TZPATH:
+            path = Path(dirname, tz.key)
+            if path.is_file():
+                return tzfile(str(path))
+
+    return None
+
+
+def compile_zone(tz):
+    """
+    A ``ZoneTable`` for ``tz``, or ``None`` if it is not a kind of zone that can be compiled.
+    ``tzfile`` transitions are read from its private attributes, so a dateutil release
+    without them gets ``None`` too, and conversions fall back to ``tz`` itself.
+    """
+    try:
+        match tz:
+            case tzutc() | tzoffset() | timezone():
+                return ZoneTable.fixed(tz)
+            case tzfile():
+                return ZoneTable.from_tzfile(tz)
+            case ZoneInfo():
+                source = zoneinfo_source(tz)
+                return source and ZoneTable.from_tzfile(source, tz, pep495=True)
+    except AttributeError as err:
+        utils.logger().debug("Unable to compile %s: %s", tz, err)
+
+    return None
+
+
+_tables = utils.LRUCache(1024)
+
+
+def zone_table(tz):
+    """
+    The cached ``compile_zone(tz)``, keyed by identity as ``tzfile`` zones are unhashable
+    """
+    entry = _tables.get(id(tz))
+    if entry is None or entry[0] is not tz:
+        entry = (tz, compile_zone(tz))
+        _tables.put(id(tz), entry)
+
+    return entry[1]
+
+
+def to_local(tz, epochs):
+    """
+    ``ZoneTable.to_local`` for any ``tz``, or ``datetime.fromtimestamp`` for those without
+    a table and for ``ZoneInfo`` zones, whose own ``fromutc`` (in C) is faster still
+    """
+    if not isinstance(tz, ZoneInfo) and (table := zone_table(tz)) is not None:
+        return table.to_local(epochs)
+
+    return [datetime.fromtimestamp(epoch, tz) for epoch in epochs]
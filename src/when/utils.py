@@ -4,17 +4,21 @@ import re
 import sys
 import time
 import logging
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
 from datetime import datetime, timedelta
 from pathlib import Path
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import requests
 from dateutil.parser import parse as dt_parse
 from dateutil.tz import gettz as _gettz
 from dateutil.tz import tzfile
-from dateutil.zoneinfo import get_zonefile_instance
 
 from .exceptions import WhenError
+from .zonenames import ZONE_NAMES
 
 
 @cache
@@ -22,14 +26,67 @@ def logger():
     return logging.getLogger("when")
 
 
-def gettz(name=None):
-    tz = _gettz(name)
+TZ_BACKEND_ENV = "WHENTZ"
+
+
+class DateutilBackend:
+    """
+    ``dateutil.tz`` zones, pure Python, for IANA names as well as POSIX TZ strings such as
+    ``UTC+8:30``
+    """
+
+    name = "dateutil"
+
+    def gettz(self, name):
+        return _gettz(name)
+
+
+class ZoneInfoBackend:
+    """
+    Standard library ``zoneinfo.ZoneInfo`` zones, which ``ZoneInfo`` caches itself and
+    looks offsets up for in C. Names it has no zone for, such as POSIX TZ strings, are left
+    to ``dateutil``
+    """
+
+    name = "zoneinfo"
+
+    def gettz(self, name):
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            return _gettz(name)
+
+
+# By name, for the ``timezones.backend`` setting; others can be added
+TZ_BACKENDS = {backend.name: backend for backend in (DateutilBackend, ZoneInfoBackend)}
+# The name of the default backend, read once at startup and checked like any other
+DEFAULT_TZ_BACKEND = os.getenv(TZ_BACKEND_ENV) or DateutilBackend.name
+_tz_backends = {}
+
+
+def tz_backend(name=None):
+    """
+    The ``TZ_BACKENDS`` backend ``name``, or the default one set by ``TZ_BACKEND_ENV``
+    """
+    name = name or DEFAULT_TZ_BACKEND
+    backend = _tz_backends.get(name)
+    if backend is None:
+        if name not in TZ_BACKENDS:
+            raise WhenError(f"Unknown timezone backend: {name}")
+
+        backend = _tz_backends[name] = TZ_BACKENDS[name]()
+
+    return backend
+
+
+def gettz(name=None, backend=None):
     if name is None:
+        tz = _gettz()
         name = get_timezone_db_name(tz)
-        if name is not None:
-            tz = _gettz(name)
+        if name is None:
+            return tz
 
-    return tz
+    return (backend or tz_backend()).gettz(name)
 
 
 def format_timedelta(td, short=False):
@@ -149,19 +206,172 @@ def timer(func):
     return inner if os.getenv("WHENTIMER") else func
 
 
+class IncompleteDownload(Exception):
+    pass
+
+
+class Downloader:
+    """
+    Stream URLs to files through one pooled ``requests.Session``. Each file is written to a
+    ``.part`` file, alongside the ``.etag`` of the response it comes from. That file is only
+    renamed into place once its size matches the one the server gave.
+
+    Failed transfers are retried up to ``retries`` times, with exponential ``backoff``.
+    A retry resumes from the end of the ``.part`` file with an HTTP ``Range`` request.
+    That request is conditional on the ETag (``If-Range``), so the server sends the whole
+    file again if it has changed since.
+    """
+
+    RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, retries=5, backoff=0.5, timeout=30, chunk_size=1 << 16, workers=4):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.session.close()
+
+    def download(self, url, filename):
+        filename = Path(filename)
+        for attempt in range(self.retries + 1):
+            try:
+                return self._download(url, filename)
+            except (requests.RequestException, IncompleteDownload) as err:
+                if attempt == self.retries:
+                    raise WhenError(f"Download failed after {attempt + 1} attempts: {url}: {err}")
+
+                logger().warning(f"Retrying {url} after {err}")
+                time.sleep(self.backoff * 2**attempt)
+
+    def download_all(self, downloads):
+        """
+        Download the {url: filename} ``downloads`` concurrently, skipping files that
+        already exist
+        """
+        missing = {url: Path(fn) for url, fn in downloads.items() if not Path(fn).exists()}
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(self.download, missing, missing.values()))
+
+        return list(downloads.values())
+
+    def _download(self, url, filename):
+        part = filename.with_name(f"{filename.name}.part")
+        etag_file = filename.with_name(f"{filename.name}.etag")
+        offset = part.stat().st_size if part.exists() else 0
+        etag = etag_file.read_text() if etag_file.exists() else None
+        headers = {"Accept-Encoding": "identity"}
+        if offset and etag:
+            headers.update({"Range": f"bytes={offset}-", "If-Range": etag})
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code in self.RETRY_STATUS:
+                raise IncompleteDownload(f"{r.status_code} response")
+
+            if r.status_code == 416:
+                part.unlink()
+                raise IncompleteDownload("the partial download is no longer valid")
+
+            if not r.ok:
+                part.unlink(missing_ok=True)
+                etag_file.unlink(missing_ok=True)
+                raise WhenError(f"{r.status_code}: {url}")
+
+            if r.status_code == 206:
+                size = int(r.headers["Content-Range"].rpartition("/")[-1])
+            else:
+                offset = 0
+                size = int(r.headers.get("Content-Length", -1))
+                if etag := r.headers.get("ETag"):
+                    etag_file.write_text(etag)
+                else:
+                    etag_file.unlink(missing_ok=True)
+
+            with part.open("ab" if offset else "wb") as fp:
+                for chunk in r.iter_content(self.chunk_size):
+                    fp.write(chunk)
+
+        received = part.stat().st_size
+        if size >= 0 and received != size:
+            raise IncompleteDownload(f"received {received:,} of {size:,} bytes")
+
+        part.replace(filename)
+        etag_file.unlink(missing_ok=True)
+        return filename
+
+
 @timer
-def fetch(url):
-    r = requests.get(url)
-    if r.ok:
-        return r.content
+def download(url, filename, chunk_size=1 << 16):
+    """
+    Stream the body of ``url`` to ``filename`` with a ``Downloader``
+    """
+    with Downloader(chunk_size=chunk_size) as downloader:
+        return downloader.download(url, filename)
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache:
+    """
+    Thread-safe mapping that holds at most ``maxsize`` items, discarding the least recently
+    used first, and counting hits and misses like ``functools.lru_cache``
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
 
-    raise WhenError(f"{r.status_code}: {url}")
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
 
 
 def get_timezone_db_name(tz):
     filename = None
     if isinstance(tz, str):
         filename = tz
+    elif isinstance(tz, ZoneInfo):
+        filename = tz.key
     elif isinstance(tz, tzfile):
         filename = getattr(tz, "_filename", None)
 
@@ -177,6 +387,13 @@ def get_timezone_db_name(tz):
     return filename
 
 
+def zone_names():
+    """
+    Sorted names of the zones in dateutil's bundled zoneinfo tarball, as generated into
+    ``zonenames``, so that listing them opens neither the tarball nor any zone
+    """
+    return ZONE_NAMES
+
+
 def all_zones():
-    zi = get_zonefile_instance()
-    return sorted(zi.zones)
+    return list(zone_names())
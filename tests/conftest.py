@@ -9,6 +9,7 @@ from when.config import Settings
 
 TEST_DIR = Path(__file__).parent
 DATA_DIR = TEST_DIR / "data"
+PLAN_DB_SIZE = 500
 
 
 @pytest.fixture
@@ -31,12 +32,35 @@ def db(loader):
     db_client = client.DB(db_path)
     admin1 = make.load_admin1(loader("admin1"))
     with open(DATA_DIR / "cities") as fp:
-        data = make.process_geonames_txt(fp, 0, admin_1=admin1)
-    db_client.create_db(data)
+        db_client.create_db(make.process_geonames_txt(fp, 0, admin_1=admin1))
+
     yield db_client
 
+    db_client.close()
     if not os.getenv("WHENSAVEDB"):
         db_path.unlink()
+        db_client.user_filename.unlink(missing_ok=True)
+        db_path.with_suffix(".cmp").unlink(missing_ok=True)
+
+
+@pytest.fixture(scope="session")
+def plan_db(loader, tmp_path_factory):
+    """
+    The test cities padded out with made up ones, enough that the statistics ANALYZE
+    gathers favor the same indexes as for a full-size database, unlike a handful of cities
+    """
+    cities = loader("cities").splitlines()
+    lines = list(cities)
+    for i in range(len(cities), PLAN_DB_SIZE):
+        fields = cities[i % len(cities)].split("\t")
+        fields[:3] = [str(10_000_000 + i), f"Town {i}", f"Town {i}"]
+        lines.append("\t".join(fields))
+
+    db_client = client.DB(tmp_path_factory.mktemp("plan") / "plan.db")
+    admin1 = make.load_admin1(loader("admin1"))
+    db_client.create_db(make.process_geonames_txt(lines, 0, admin_1=admin1))
+    yield db_client
+    db_client.close()
 
 
 @pytest.fixture
@@ -1,19 +1,31 @@
+import io
 import os
+import asyncio
 import re
 import math
 import time
 import json
+import sqlite3
+import threading
+import tarfile
+import zipfile
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from types import SimpleNamespace
-from datetime import datetime, timedelta, date
-from dateutil.tz import gettz
+from datetime import datetime, timedelta, timezone, date
+from zoneinfo import ZoneInfo
+from dateutil.tz import gettz, tzfile, tzlocal, tzoffset
+from dateutil.zoneinfo import METADATA_FN, getzoneinfofile_stream
 
 from when.cli import main as when_main
 from when.timezones import zones
-from when import utils, lunar, core, exceptions
+from when import timezones
+from when import utils, lunar, core, exceptions, transitions
 from when import db as dbm
 from when.config import Settings
 from when.core import When
+from when.aio import AsyncWhen
 from when.db import make
 
 import pytest
@@ -56,12 +68,198 @@ class TestZones:
 
         z = zones.get("UTC+8:30")
         assert z and z[0][1] == "UTC+8:30"
+        assert z[0][0].utcoffset(datetime(2024, 1, 1)) == timedelta(hours=8, minutes=30)
 
     def test_abbr_src_abbr_tgt(self, when):
         result = when.convert("Jan 10, 2023 4:30am", sources="EST", targets="KST")
         expect = datetime(2023, 1, 10, 18, 30, tzinfo=gettz("Asia/Seoul"))
         assert result[0].dt == expect
 
+    def test_country_targets(self, when):
+        assert [z.name for z in when.zones_for_country("us", "hawaii")] == ["Pacific/Honolulu"]
+        result = when.convert("Jan 10, 2023 4:30am", sources="UTC", targets=["co:US", "Asia/Seoul"])
+        assert [(r.zone.name, r.dt.hour) for r in result] == [
+            ("America/New_York", 23),
+            ("Pacific/Honolulu", 18),
+            ("Asia/Seoul", 13),
+        ]
+        with pytest.raises(exceptions.UnknownSourceError):
+            when.find_zones("co:XX")
+
+    @pytest.mark.parametrize("backend,tz_type", [("dateutil", tzfile), ("zoneinfo", ZoneInfo)])
+    def test_tz_backend(self, db, backend, tz_type):
+        settings = Settings(name="NopeNopeNope")
+        settings.data["timezones"] = {"backend": backend}
+        when = When(settings, db=db)
+        assert when.tz_backend.name == backend
+        result = when.convert(
+            "Jul 10, 2023 4:30am",
+            sources=["America/New_York", "Europe/Paris"],
+            targets=["Seoul", "UTC+8:30"],
+        )
+
+        assert [(r.zone.name, r.dt.strftime("%H:%M %z")) for r in result] == [
+            ("Asia/Seoul", "17:30 +0900"),
+            ("UTC+8:30", "17:00 +0830"),
+            ("Asia/Seoul", "11:30 +0900"),
+            ("UTC+8:30", "11:00 +0830"),
+        ]
+        assert isinstance(result[0].zone.tz, tz_type)
+        assert isinstance(result[2].source.zone.tz, tz_type)
+        assert utils.get_timezone_db_name(result[0].zone.tz) == "Asia/Seoul"
+
+    def test_tz_backend_per_instance(self, db):
+        settings = Settings(name="NopeNopeNope")
+        settings.data["timezones"] = {"backend": "zoneinfo"}
+        default = utils.tz_backend()
+        zi_when = When(settings, db=db)
+        settings = Settings(name="NopeNopeNope")
+        settings.data["timezones"] = {"backend": "dateutil"}
+        du_when = When(settings, db=db)
+        assert utils.tz_backend() is default
+        assert isinstance(zi_when.find_zones("KST")[0].tz, ZoneInfo)
+        assert isinstance(du_when.find_zones("KST")[0].tz, tzfile)
+        assert isinstance(zi_when.find_zones("seoul")[0].tz, ZoneInfo)
+        default_type = type(default.gettz("Asia/Seoul"))
+        assert isinstance(timezones.zones.get("KST")[0][0], default_type)
+
+    def test_missing_zone_data(self, db, monkeypatch):
+        when = When(Settings(name="NopeNopeNope"), db=db)
+        monkeypatch.setattr(utils, "gettz", lambda name=None, backend=None: None)
+        with pytest.raises(exceptions.WhenError, match="No timezone data for Asia/Seoul"):
+            when.db_zone("Asia/Seoul")
+
+        with pytest.raises(exceptions.WhenError, match="No timezone data for Europe/Paris"):
+            when.get_tz("europe/paris")
+
+    def test_unknown_tz_backend(self, monkeypatch):
+        with pytest.raises(exceptions.WhenError, match="Unknown timezone backend: pytz"):
+            utils.tz_backend("pytz")
+
+        # As set by ``WHENTZ=pytz``
+        monkeypatch.setattr(utils, "DEFAULT_TZ_BACKEND", "pytz")
+        with pytest.raises(exceptions.WhenError, match="Unknown timezone backend: pytz"):
+            utils.gettz("UTC")
+
+    def test_zone_index(self):
+        index = timezones.ZoneIndex(["America/New_York", "Europe/Paris", "UTC"])
+        assert index.find("Europe/Paris") == ["Europe/Paris"]
+        assert index.find("utc") == ["utc"] and index.lookup["utc"] == "UTC"
+        assert index.find("UTC/*") == [] and index.find("Paris") == []
+        assert index.find("E*/*") == ["Europe/Paris"]
+        assert index.find("*/n*") == ["america/new_york"]
+        with pytest.raises(TypeError):
+            index.lookup["Mars/Olympus_Mons"] = "UTC"
+
+    def test_lazy_zone_index(self, db, monkeypatch):
+        timezones.zone_index.cache_clear()
+        monkeypatch.setattr(utils, "zone_names", lambda: pytest.fail("Zone names loaded"))
+        when = When(Settings(name="NopeNopeNope"), db=db)
+        assert [z.name for z in when.zones_for_country("KR")] == ["Asia/Seoul"]
+        monkeypatch.undo()
+
+        assert [z.name for z in when.find_zones("europe/paris")] == ["europe/paris"]
+        assert timezones.zone_index() is timezones.zone_index()
+        assert when.tz_dict["europe/paris"] == "Europe/Paris"
+
+    def test_city_lookup_skips_tarball(self, db, monkeypatch):
+        timezones.zone_index.cache_clear()
+        monkeypatch.setattr(tarfile, "open", lambda *a, **kw: pytest.fail("Tarball opened"))
+        when = When(Settings(name="NopeNopeNope"), db=db)
+        assert [z.city.id for z in when.find_zones("seoul")] == [1835848]
+
+    def test_zone_names(self):
+        stream = getzoneinfofile_stream()
+        with tarfile.open(fileobj=stream) as tf:
+            names = sorted(m.name for m in tf if not m.isdir() and m.name != METADATA_FN)
+
+        # Regenerate ``when.zonenames`` with ``just zonenames`` when this fails
+        assert list(utils.zone_names()) == names
+
+    @pytest.mark.parametrize("get_tz", [gettz, ZoneInfo])
+    @pytest.mark.parametrize(
+        "name", ["America/New_York", "Europe/Dublin", "Australia/Lord_Howe", "Asia/Kolkata"]
+    )
+    def test_zone_table(self, get_tz, name):
+        def fields(dt):
+            return (dt.replace(tzinfo=None), dt.fold, dt.utcoffset(), dt.tzname(), dt.dst())
+
+        tz = get_tz(name)
+        table = transitions.compile_zone(tz)
+        epochs = [-3e9, 0, 4e9] + [
+            t + delta for t in table.trans for delta in (-3601, -1, 0, 1, 1800, 3600)
+        ]
+        results = table.to_local(epochs)
+        assert [fields(dt) for dt in results] == [
+            fields(datetime.fromtimestamp(epoch, tz)) for epoch in epochs
+        ]
+        # dateutil's own ``tzname`` resolves the first transition by local time, so
+        # periods are checked against zoneinfo's, within the span both read the same
+        span = [epoch for epoch in epochs if table.trans[1] <= epoch < table.trans[-1]]
+        assert [(p.offset, p.abbr, p.isdst) for p in table.periods(span)] == [
+            (dt.utcoffset().total_seconds(), dt.tzname(), bool(dt.dst()))
+            for dt in (datetime.fromtimestamp(epoch, ZoneInfo(name)) for epoch in span)
+        ]
+
+        local = [
+            dt.replace(tzinfo=None) + timedelta(minutes=m) for dt in results for m in (-30, 30)
+        ]
+        for fold in (0, 1):
+            assert table.to_utc(local, fold) == [
+                dt.replace(tzinfo=tz, fold=fold).timestamp() for dt in local
+            ]
+
+    def test_zone_table_fold_and_gap(self):
+        table = transitions.compile_zone(ZoneInfo("America/New_York"))
+        utc = [datetime(2023, 11, 5, h, 30, tzinfo=timezone.utc).timestamp() for h in (5, 6)]
+        assert [(dt.hour, dt.fold, dt.tzname()) for dt in table.to_local(utc)] == [
+            (1, 0, "EDT"),
+            (1, 1, "EST"),
+        ]
+        assert table.to_utc([datetime(2023, 11, 5, 1, 30)], fold=1) == utc[1:]
+        assert table.to_utc([datetime(2023, 11, 5, 1, 30)]) == utc[:1]
+
+        # 2:30 never happens on the day clocks go forward: fold picks the offset before or after
+        gap = datetime(2023, 3, 12, 2, 30)
+        assert [
+            table.to_utc([gap], fold)[0] - (gap - datetime(1970, 1, 1)).total_seconds()
+            for fold in (0, 1)
+        ] == [5 * 3600, 4 * 3600]
+
+    @pytest.mark.parametrize("tz", [tzoffset("IST", 19800), timezone(timedelta(hours=-3))])
+    def test_zone_table_fixed(self, tz):
+        table = transitions.compile_zone(tz)
+        [dt] = table.to_local([0])
+        assert dt.tzinfo is tz and dt.utcoffset() == tz.utcoffset(None)
+        assert table.to_utc([dt.replace(tzinfo=None)]) == [0]
+        assert transitions.compile_zone(tzlocal()) is None
+
+    def test_zone_table_missing_attributes(self, monkeypatch):
+        def from_tzfile(*args, **kwargs):
+            raise AttributeError("'tzfile' object has no attribute '_trans_list_utc'")
+
+        monkeypatch.setattr(transitions.ZoneTable, "from_tzfile", from_tzfile)
+        tz = transitions.zoneinfo_source(ZoneInfo("Europe/Dublin"))
+        assert transitions.compile_zone(tz) is None
+        epochs = [0, 1_700_000_000]
+        assert transitions.to_local(tz, epochs) == [datetime.fromtimestamp(e, tz) for e in epochs]
+
+    @pytest.mark.parametrize("backend", list(utils.TZ_BACKENDS))
+    def test_convert_all(self, db, backend):
+        settings = Settings(name="NopeNopeNope")
+        settings.data["timezones"] = {"backend": backend}
+        when = When(settings, db=db)
+        sources = when.find_zones("America/New_York") + when.find_zones("Europe/Dublin")
+        targets = sources + when.find_zones("Seoul") + when.find_zones("UTC+8:30")
+        for timestr in ["Nov 5, 2023 1:30am", "Mar 12, 2023 2:30am", "Jul 10, 2023 4:30am"]:
+            dt = utils.parse_timestamp(timestr)
+            srcs = [core.Result(src.replace(dt), src) for src in sources]
+            expected = [src.convert(tz) for src in srcs for tz in targets]
+            results = core.Result.convert_all(srcs, targets, when.tz_backend)
+            assert [(r.dt, r.dt.fold, r.dt.utcoffset(), r.zone, r.source) for r in results] == [
+                (r.dt, r.dt.fold, r.dt.utcoffset(), r.zone, r.source) for r in expected
+            ]
+
     def test_zones_get(self):
         result = zones.get("Eastern")
         assert len(result) == 1
@@ -105,15 +303,14 @@ class TestUtils:
         assert utils.get_timezone_db_name(None) is None
         assert utils.get_timezone_db_name("/some/path/zoneinfo/foo/bar") == "foo/bar"
 
-    def test_fetch(self):
+    def test_download(self, tmp_path):
+        url = "https://foo.com/bar/"
         with responses.RequestsMock() as rsp:
-            rsp.add(responses.GET, "https://foo.com/bar/", body=b"asdf", status=200)
-            assert utils.fetch("https://foo.com/bar/") == b"asdf"
+            rsp.add(responses.GET, url, body=b"asdf", status=200)
+            filename = utils.download(url, tmp_path / "bar")
 
-            url = "https://foo.com/baz/"
-            rsp.add(responses.GET, url, status=404)
-            with pytest.raises(exceptions.WhenError, match=f"404: {url}"):
-                utils.fetch(url)
+        assert filename.read_bytes() == b"asdf"
+        assert [p.name for p in tmp_path.iterdir()] == ["bar"]
 
 
 class TestLunar:
@@ -147,10 +344,24 @@ class TestDB:
             dict(
                 db_search=None,
                 db_size=None,
+                db_update=None,
+                db_migrate=False,
+                db_near=None,
                 db_alias=False,
                 db_aliases=False,
+                db_alias_import=None,
+                db_alias_export=None,
+                db_conflict="replace",
+                db_dump=None,
+                db_alt_names=False,
+                db_alt_names_file=None,
+                db_langs="en,de,fr,es",
                 db_force=False,
                 db_exact=False,
+                db_fuzzy=False,
+                db_limit=None,
+                db_order=None,
+                db_by_zone=False,
                 db_pop=10_000,
             )
             | kwargs
@@ -176,7 +387,7 @@ class TestDB:
 
     def test_db_create(self, loader):
         db = dbm.client.DB(HERE_DIR / "test_create.db")
-        files = [db.filename, HERE_DIR / "cities500.txt", HERE_DIR / "admin1CodesASCII.txt"]
+        files = [db.filename, HERE_DIR / "cities500.zip", HERE_DIR / "admin1CodesASCII.txt"]
         [f.unlink(True) for f in files]
 
         try:
@@ -198,30 +409,629 @@ class TestDB:
                 dbm.db_main(db, args)
                 assert 2 == len(db.search("Paris"))
         finally:
-            [f.unlink(True) for f in files]
+            [f.unlink(True) for f in [*files, *HERE_DIR.glob("cities500-*.cols")]]
+
+    @pytest.fixture
+    def tmp_db(self, loader, tmp_path):
+        db = dbm.client.DB(tmp_path / "update.db")
+        admin1 = make.load_admin1(loader("admin1"))
+        db.create_db(make.process_geonames_txt(loader("cities").splitlines(), 0, admin1))
+        db.set_meta(size=500, population=10_000)
+        db.add_alias("MSTRCHT", 2751283)
+        yield db
+        db.close()
+
+    def test_update(self, tmp_db, loader, data_dir):
+        admin1 = make.load_admin1(loader("admin1"))
+        updates = data_dir / "updates"
+        assert dbm.update(tmp_db, updates, admin1) == [
+            ("2024-07-23", 2, 2),
+            ("2024-07-24", 1, 0),
+        ]
+        assert tmp_db.meta()["updated"] == "2024-07-24"
+        assert [str(c) for c in tmp_db.search("Mstrcht")] == [
+            "Maastricht-Stad, Limburg, NL, Europe/Amsterdam"
+        ]
+        assert [c.name for c in tmp_db.search("maastricht")] == ["Maastricht-Stad"]
+        assert [c.name for c in tmp_db.search("london")] == ["Greater London"]
+        assert [c.name for c in tmp_db.search("greater londn", fuzzy=True)] == ["Greater London"]
+        assert [c.co for c in tmp_db.search("Paris")] == ["FR"]
+        assert tmp_db.search("Lahaina") == []
+        assert tmp_db.search("Haleakala") == []
+
+        assert dbm.update(tmp_db, updates, admin1) == []
+
+    def test_lookups_read_new_ids(self, tmp_db):
+        reader = dbm.client.DB(tmp_db.filename)
+        assert [c.tz for c in reader.search("maastricht")] == ["Europe/Amsterdam"]
+        assert "America/Nuuk" not in reader.lookups(reader._reader)[2].values()
+
+        row = [1, "Nuuk", "Nuuk", "GL", "Sermersooq", "America/Nuuk", 19_000, 64.18, -51.72]
+        tmp_db.update_db([row])
+        assert [str(c) for c in reader.search("nuuk")] == ["Nuuk, Sermersooq, GL, America/Nuuk"]
+        reader.close()
+
+    def test_update_requires_meta(self, tmp_db, data_dir):
+        with tmp_db.connection(commit=True) as con:
+            con.execute("DELETE FROM meta WHERE key = 'size'")
+
+        with pytest.raises(dbm.client.DBError, match="does not record the cities file"):
+            dbm.update(tmp_db, data_dir / "updates", {})
+
+    @pytest.mark.parametrize(
+        "size,kept", [(500, ["Seat", "Town"]), (1_000, ["Seat"]), (5_000, []), (15_000, [])]
+    )
+    def test_process_modifications(self, size, kept):
+        lines = [
+            f"{gid}\t{name}\t{name}\t\t0\t0\tP\t{fcode}\tUS\t\tHI\t\t\t\t{pop}\t\t0\tUTC\t2024-07-23"
+            for gid, name, fcode, pop in [(1, "Seat", "PPLA3", 800), (2, "Town", "PPLS", 800)]
+        ]
+        rows, removed = make.process_modifications(lines, size, 0)
+        assert [row[1] for row in rows] == kept
+        assert len(rows) + len(removed) == 2
+
+    def test_update_main(self, tmp_db, capsys, loader, data_dir):
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, make.GEONAMES_ADMIN1_URL, body=loader("admin1"), status=200)
+            assert 0 == dbm.db_main(tmp_db, self._args(db_update=data_dir / "updates"))
+
+        assert capsys.readouterr().out.splitlines() == [
+            "2024-07-23: 2 updated, 2 removed",
+            "2024-07-24: 1 updated, 0 removed",
+        ]
+
+    @pytest.fixture
+    def v1_db(self, loader, tmp_path):
+        # City and alias tables as they were before schema versions
+        filename = tmp_path / "v1.db"
+        admin1 = make.load_admin1(loader("admin1"))
+        rows = make.process_geonames_txt(loader("cities").splitlines(), 0, admin1)
+        con = sqlite3.connect(filename)
+        con.executescript(
+            """
+            CREATE TABLE city (id INTEGER PRIMARY KEY, name, ascii, co, sub, tz, pop);
+            CREATE TABLE alias (alias TEXT PRIMARY KEY, city_id INTEGER);
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            INSERT INTO alias VALUES ('Mstrcht', 2751283);
+            INSERT INTO meta VALUES ('size', '500');
+            """
+        )
+        con.executemany("INSERT INTO city VALUES (?, ?, ?, ?, ?, ?, ?)", [r[:7] for r in rows])
+        con.commit()
+        con.close()
+        db = dbm.client.DB(filename)
+        yield db
+        db.close()
+
+    def test_schema(self, tmp_db):
+        with tmp_db.connection() as con:
+            assert dbm.client.schema_version(con) == dbm.client.SCHEMA_VERSION
+            zones = [tz for (tz,) in con.execute("SELECT name FROM zone ORDER BY name")]
+            tzs = sorted({tz for (tz,) in con.execute("SELECT tz FROM city")})
+
+        assert zones == tzs
+        assert tmp_db.migrate() is False
+
+    def test_migrate(self, v1_db):
+        with pytest.raises(dbm.client.DBError, match="--db-migrate"):
+            v1_db.update_db([], [2751283])
+
+        with pytest.raises(dbm.client.DBError, match="--db-migrate"):
+            v1_db.search("paris")
+
+        assert v1_db.migrate() is True
+        with v1_db.connection() as con:
+            assert dbm.client.schema_version(con) == dbm.client.SCHEMA_VERSION
+
+        assert [c.id for c in v1_db.search("paris")] == [2988507, 4974617]
+        assert v1_db.search("lāhaina, hawaii, us", exact=True)[0].id == 5849996
+        assert [c.id for c in v1_db.search("mstrcht")] == [2751283]
+        assert list(v1_db.export_aliases()) == [("Mstrcht", 2751283, None)]
+        assert v1_db.meta() == {"size": "500"}
+        assert v1_db.update_db([], [2751283, 1]) == (0, 1)
+        assert v1_db.search("maastricht") == []
+        assert not v1_db.filename.with_suffix(".migrate").exists()
+
+    def test_migrate_main(self, v1_db, capsys):
+        assert 0 == dbm.db_main(v1_db, self._args(db_migrate=True))
+        assert capsys.readouterr().out.startswith("Migrated to schema version 2: ")
+        assert 0 == dbm.db_main(v1_db, self._args(db_migrate=True))
+        assert capsys.readouterr().out == "Already at schema version 2\n"
+
+    def test_user_overlay(self, tmp_db, loader):
+        base = tmp_db.filename.read_bytes()
+        assert tmp_db.user_filename == tmp_db.filename.with_name("update-user.db")
+        assert tmp_db.user_filename.exists()
+        tmp_db.add_alt_names([("Hanseong", 1835848, "ko"), ("Paname", 2988507, "fr")])
+        tmp_db.add_alias("Hanseong", 5128581)
+        assert tmp_db.filename.read_bytes() != base
+
+        base = tmp_db.filename.read_bytes()
+        tmp_db.add_alias("Big Apple", 5128581)
+        assert tmp_db.filename.read_bytes() == base
+        assert [c.id for c in tmp_db.search("hanseong")] == [5128581]
+        assert tmp_db.search_many(["hanseong"])["hanseong"][0].id == 5128581
+        assert sorted(row[:2] for row in tmp_db.aliases()) == [
+            ("Big Apple", "New York City"),
+            ("Hanseong", "New York City"),
+            ("MSTRCHT", "Maastricht"),
+            ("Paname", "Paris"),
+        ]
+
+        # A rebuild replaces the base DB (and its alternate names) but not the overlay
+        admin1 = make.load_admin1(loader("admin1"))
+        tmp_db.create_db(make.process_geonames_txt(loader("cities").splitlines(), 0, admin1))
+        assert [c.id for c in tmp_db.search("mstrcht")] == [2751283]
+        assert [c.id for c in tmp_db.search("hanseong")] == [5128581]
+        assert tmp_db.search("paname") == []
+        assert not tmp_db.filename.with_name("update.db.build").exists()
+
+    def test_overlay_created_elsewhere(self, loader, tmp_path):
+        db = dbm.client.DB(tmp_path / "base.db")
+        admin1 = make.load_admin1(loader("admin1"))
+        db.create_db(make.process_geonames_txt(loader("cities").splitlines(), 0, admin1))
+        assert db.search("mstrcht") == []
+
+        # As another process would, with readers of its own
+        other = dbm.client.DB(db.filename)
+        other.add_alias("MSTRCHT", 2751283)
+        other.close()
+        assert [c.id for c in db.search("mstrcht")] == [2751283]
+        db.close()
+
+    def test_create_db_keeps_aliases(self, loader, tmp_path, monkeypatch):
+        monkeypatch.setenv(dbm.client.USER_DB_ENV, str(tmp_path / "user" / "aliases.db"))
+        db = dbm.client.DB(tmp_path / "base.db")
+        admin1 = make.load_admin1(loader("admin1"))
+        db.create_db(make.process_geonames_txt(loader("cities").splitlines(), 0, admin1))
+        # Made by hand in the base DB, before there were user overlays
+        with db.connection(commit=True) as con:
+            con.execute("INSERT INTO alias VALUES ('Mstrcht', 2751283, 'MSTRCHT', NULL)")
+
+        assert not db.user_filename.exists()
+        db.create_db(make.process_geonames_txt(loader("cities").splitlines(), 0, admin1))
+        assert db.user_filename == tmp_path / "user" / "aliases.db"
+        assert list(db.export_aliases()) == [("Mstrcht", 2751283, None)]
+        assert [c.id for c in db.search("mstrcht")] == [2751283]
+        db.close()
+
+    @pytest.fixture(params=["db", "index"])
+    def san_db(self, request, tmp_path):
+        filename = tmp_path / "san.db"
+        db = dbm.client.DB(filename)
+        db.create_db(
+            [
+                [1, "San Jose", "San Jose", "US", "CA", "America/Los_Angeles", 1_000_000, 37, -122],
+                [
+                    2,
+                    "San Diego",
+                    "San Diego",
+                    "US",
+                    "CA",
+                    "America/Los_Angeles",
+                    1_400_000,
+                    33,
+                    -117,
+                ],
+                [
+                    3,
+                    "San Antonio",
+                    "San Antonio",
+                    "US",
+                    "TX",
+                    "America/Chicago",
+                    1_500_000,
+                    29,
+                    -98,
+                ],
+                [4, "San Juan", "San Juan", "PR", "01", "America/Puerto_Rico", 300_000, 18, -66],
+                [5, "Santa Fe", "Santa Fe", "US", "NM", "America/Denver", 90_000, 36, -106],
+            ]
+        )
+        if request.param == "index":
+            db = dbm.index.CityIndex(filename)
+
+        yield db
+        db.close()
+
+    @pytest.mark.parametrize(
+        "options,expect",
+        [
+            ({}, [1, 2, 3, 4, 5]),
+            ({"limit": 2}, [1, 2]),
+            ({"order": "population"}, [3, 2, 1, 4, 5]),
+            ({"order": "population", "limit": 2}, [3, 2]),
+            ({"by_zone": True}, [2, 3, 4, 5]),
+            ({"by_zone": True, "order": "population", "limit": 3}, [3, 2, 4]),
+        ],
+    )
+    def test_search_ranked(self, san_db, options, expect):
+        assert [c.id for c in san_db.search("san", **options)] == expect
+        assert [c.id for c in san_db.search_many(["san"], **options)["san"]] == expect
+
+    def test_ranked_query(self, db):
+        with db.connection() as con:
+            sql, params = db.search_query(con, "SAN", order="population")
+            sql, params = db.ranked_query(sql, params, 5, "population")
+            assert "OVER" not in sql and sql.count("city_data") == 1
+            assert sql.endswith("ORDER BY c.pop DESC, c.id\nLIMIT :max_rows")
+
+            sql, params = db.search_query(con, "SAN", columns=dbm.client.RANKED_COLUMNS)
+            sql, params = db.ranked_query(sql, params, 5, "population", by_zone=True)
+            assert "PARTITION BY r.tz_id" in sql and sql.count("city_data") == 1
+
+    def test_search_ranked_alias(self, san_db):
+        san_db.add_alias("SAN", 5)
+        assert [c.id for c in san_db.search("san", limit=2)] == [5, 1]
+        assert [c.id for c in san_db.search("san", by_zone=True)] == [5, 2, 3, 4]
+        assert [c.id for c in san_db.search_many(["san"], by_zone=True)["san"]] == [5, 2, 3, 4]
+
+    def test_search_ranked_error(self, san_db):
+        with pytest.raises(dbm.client.DBError, match="Invalid search order: size"):
+            san_db.search("san", order="size")
+
+        for limit in (0, -1):
+            with pytest.raises(ValueError, match="limit must be at least 1"):
+                san_db.search("san", limit=limit)
+
+            with pytest.raises(ValueError, match="limit must be at least 1"):
+                san_db.search_many(["san"], limit=limit)
+
+    def test_find_zones_by_zone(self, san_db):
+        when = When(Settings(name="NopeNopeNope"), db=san_db)
+        zones = when.find_zones("san", by_zone=True, order="population")
+        assert [z.city.id for z in zones] == [3, 2, 4, 5]
+
+    def test_import_alt_names(self, tmp_db, data_dir):
+        assert dbm.import_alt_names(tmp_db, data_dir / "alternateNames") == 4
+        assert [c.name for c in tmp_db.search("nueva york")] == ["New York City"]
+        assert [c.name for c in tmp_db.search("Big Apple")] == ["New York City"]
+        assert [c.name for c in tmp_db.search("söul")] == ["Seoul"]
+        assert [c.co for c in tmp_db.search("paname", exact=True)] == ["FR"]
+        assert tmp_db.search("Maestricht") == []
+        assert tmp_db.search("mstrcht")[0].id == 2751283
+
+        assert dbm.import_alt_names(tmp_db, data_dir / "alternateNames", ["nl"]) == 1
+        assert tmp_db.search("Maestricht")[0].id == 2751283
+        assert dbm.import_alt_names(tmp_db, data_dir / "alternateNames") == 0
+
+    ALIAS_RECORDS = (
+        {"alias": "Hanseong", "city_id": "1835848", "lang": "ko"},
+        {"alias": "Nowhere", "city_id": "1", "lang": None},
+        {"alias": "MSTRCHT", "city_id": "1835848", "lang": None},
+    )
+
+    def write_aliases(self, filename, records):
+        with filename.open("w") as fp:
+            make.write_records(
+                fp,
+                ("alias", "city_id", "lang"),
+                [r.values() for r in records],
+                make.records_format(filename),
+            )
+
+    @pytest.mark.parametrize("suffix", [".csv", ".ndjson"])
+    def test_alias_import_export(self, tmp_db, tmp_path, capsys, suffix):
+        filename = tmp_path / f"aliases{suffix}"
+        self.write_aliases(filename, self.ALIAS_RECORDS)
+        assert 0 == dbm.db_main(tmp_db, self._args(db_alias_import=filename))
+        assert capsys.readouterr().out == "Imported 3 aliases: 2 added or changed\n"
+        assert [c.id for c in tmp_db.search("hanseong")] == [1835848]
+        assert [c.id for c in tmp_db.search("mstrcht")] == [1835848]
+        assert tmp_db.search("nowhere") == []
+
+        exported = tmp_path / f"exported{suffix}"
+        assert 0 == dbm.db_main(tmp_db, self._args(db_alias_export=exported))
+        assert capsys.readouterr().err == "Exported 2 aliases\n"
+        with filename.open() as fp:
+            records = list(make.read_records(fp, make.records_format(filename)))
+            assert list(make.process_aliases(records)) == [
+                ("Hanseong", 1835848, "ko"),
+                ("Nowhere", 1, None),
+                ("MSTRCHT", 1835848, None),
+            ]
+
+        with exported.open() as fp:
+            assert list(
+                make.process_aliases(make.read_records(fp, make.records_format(exported)))
+            ) == [
+                ("Hanseong", 1835848, "ko"),
+                ("MSTRCHT", 1835848, None),
+            ]
+
+    @pytest.mark.parametrize(
+        "conflict,records,error",
+        [
+            ("ignore", ALIAS_RECORDS, None),
+            ("fail", ALIAS_RECORDS, "Alias import failed at row 3: UNIQUE constraint failed"),
+            (
+                "replace",
+                [*ALIAS_RECORDS[:1], {"alias": "Nope", "city_id": "x"}],
+                "Invalid alias record 2",
+            ),
+        ],
+    )
+    def test_alias_import_conflicts(self, tmp_db, tmp_path, conflict, records, error):
+        filename = tmp_path / "aliases.csv"
+        self.write_aliases(filename, records)
+        if error:
+            with pytest.raises(dbm.client.DBError, match=error):
+                dbm.import_aliases(tmp_db, filename, conflict)
+        else:
+            assert dbm.import_aliases(tmp_db, filename, conflict) == (3, 1)
+
+        assert [c.id for c in tmp_db.search("mstrcht")] == [2751283]
+        assert bool(tmp_db.search("hanseong")) == (error is None)
+
+    def test_db_dump(self, db, tmp_path, capsys):
+        filename = tmp_path / "cities.ndjson"
+        assert 0 == dbm.db_main(db, self._args(db_dump=filename))
+        count = int(capsys.readouterr().err.split()[1])
+        with filename.open() as fp:
+            cities = list(make.read_records(fp, "ndjson"))
+
+        assert count == len(cities) == len(db.city_ids())
+        seoul = next(c for c in cities if c["id"] == 1835848)
+        assert seoul | {"pop": 0, "lat": 0, "lng": 0} == {
+            "id": 1835848,
+            "name": "Seoul",
+            "ascii": "Seoul",
+            "sub": "Seoul",
+            "co": "KR",
+            "tz": "Asia/Seoul",
+            "pop": 0,
+            "lat": 0,
+            "lng": 0,
+        }
+
+        dbm.db_main(db, self._args(db_dump="-"))
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0] == "id,name,ascii,sub,co,tz,pop,lat,lng"
+        assert len(lines) == count + 1
+
+    def test_import_alt_names_keeps_aliases(self, tmp_db, data_dir):
+        tmp_db.add_alias("Big Apple", 4974617)
+        dbm.import_alt_names(tmp_db, data_dir / "alternateNames")
+        assert [c.id for c in tmp_db.search("big apple")] == [4974617]
+
+    def test_import_alt_names_main(self, tmp_db, capsys, data_dir):
+        args = self._args(db_alt_names_file=data_dir / "alternateNames")
+        assert 0 == dbm.db_main(tmp_db, args)
+        assert capsys.readouterr().out == "Imported 4 aliases\n"
+
+    def test_find_zones_cache(self, tmp_db, monkeypatch):
+        when = When(Settings(name="NopeNopeNope"), db=tmp_db)
+        searched = []
+        search_many = tmp_db.search_many
+        monkeypatch.setattr(
+            tmp_db,
+            "search_many",
+            lambda values, *args: searched.append(values) or search_many(values, *args),
+        )
+        for _ in range(3):
+            assert [z.city.id for z in when.find_zones(["seoul", "KST"]) if z.city] == [1835848]
+            with pytest.raises(exceptions.UnknownSourceError):
+                when.find_zones("Hanseong")
+
+        assert searched == [["seoul", "KST"], ["Hanseong"]]
+        assert when.cache_info() == utils.CacheInfo(hits=6, misses=3, maxsize=1024, currsize=3)
+
+        tmp_db.add_alias("Hanseong", 1835848)
+        assert [z.city.id for z in when.find_zones("Hanseong")] == [1835848]
+        assert searched[-1] == ["Hanseong"]
+        assert when.cache_info().currsize == 1
+
+    def test_complete(self, tmp_db, capsys, monkeypatch):
+        when = When(Settings(name="NopeNopeNope"), db=tmp_db)
+        assert [c.text for c in when.complete("", limit=3)] == ["Asia/Seoul", "KST", "Seoul"]
+        assert when.complete("se", limit=2) == [
+            dbm.index.Completion("Asia/Seoul", "zone", 10349312),
+            dbm.index.Completion("Seoul", "city", 10349312),
+        ]
+        assert [c.text for c in when.complete("new_y")] == ["America/New_York"]
+        assert [c.kind for c in when.complete("mstr")] == ["alias"]
+        assert when.completion_snapshot.exists()
+
+        def unlink(*args, **kwargs):
+            raise PermissionError("read-only")
+
+        with monkeypatch.context() as m:
+            m.setattr(Path, "unlink", unlink)
+            tmp_db.add_alias("Hanseong", 1835848)
+            assert [c.text for c in when.complete("Hans")] == ["Hanseong"]
+
+        monkeypatch.setattr(tmp_db, "completions", None)
+        reloaded = When(Settings(name="NopeNopeNope"), db=tmp_db)
+        assert reloaded.complete("han") == when.complete("han")
+
+        assert 0 == when_main(["--complete", "utc,se", "--limit", "2"], when)
+        assert capsys.readouterr().out == "utc,Asia/Seoul\nutc,Seoul\n"
+
+    def test_prefix_index(self):
+        entries = [
+            ("Springfield", "city", 100, ["SPRINGFIELD"]),
+            ("Springfield", "alias", 200, ["SPRINGFIELD"]),
+            ("Spring", "city", None, ["SPRING"]),
+            *[(f"Sp{i:03}", "city", i, [f"SP{i:03}"]) for i in range(20)],
+        ]
+        prefixes = dbm.index.PrefixIndex.from_entries(entries, top=4, span=8)
+        assert len(prefixes) == 22
+        assert set(prefixes.best) == {"", "S", "SP", "SP0", "SP00", "SP01"}
+        assert prefixes.complete("spr") == [
+            dbm.index.Completion("Springfield", "alias", 200),
+            dbm.index.Completion("Spring", "city", 0),
+        ]
+        for prefix, limit in [("sp", 3), ("sp", 6), ("sp", None), ("sp01", 2), ("x", 2)]:
+            # Texts are numbered most populous first
+            expected = [t for t in prefixes.columns["text"] if t.upper().startswith(prefix.upper())]
+            assert [c.text for c in prefixes.complete(prefix, limit)] == expected[:limit]
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+        assert (cache.get("b"), cache.get("a"), cache.get("c")) == (None, 1, 3)
+        assert cache.cache_info() == utils.CacheInfo(hits=3, misses=1, maxsize=2, currsize=2)
+
+    def test_alias_search_plan(self, plan_db):
+        with plan_db.connection() as con:
+            sql = f"EXPLAIN QUERY PLAN {dbm.client.ALIAS_SEARCH_QUERY}"
+            plan = "\n".join(row[-1] for row in con.execute(sql, ("MUNCHEN",)))
+
+        assert "SCAN" not in plan
+        assert "INDEX alias-key" in plan
+
+    def test_cities_in(self, db):
+        assert [c.id for c in db.cities_in("us")] == [5128581, 4140963, 5849996, 4974617]
+        assert [c.id for c in db.cities_in("US", min_pop=100_000)] == [5128581, 4140963]
+        assert [c.id for c in db.cities_in("US", limit=1)] == [5128581]
+        assert [str(c) for c in db.cities_in("US", "hawaii")] == [
+            "Lāhaina (Lahaina), Hawaii, US, Pacific/Honolulu"
+        ]
+        assert db.cities_in("US", "Bavaria") == []
+        assert db.zones_in("US") == ["America/New_York", "Pacific/Honolulu"]
+        assert db.zones_in("FR", "Île-de-France") == ["Europe/Paris"]
+        assert db.zones_in("XX") == []
+
+    def test_country_plans(self, plan_db):
+        filters = " ".join(dbm.client.COUNTRY_FILTERS.values())
+        params = {"co": "US", "sub": "HAWAII", "min_pop": 1, "max_rows": -1}
+        with plan_db.connection() as con:
+            for sql in [dbm.client.CITIES_IN_QUERY, dbm.client.ZONES_IN_QUERY]:
+                for query in [sql.format(""), sql.format(filters)]:
+                    plan = "\n".join(
+                        r[-1] for r in con.execute(f"EXPLAIN QUERY PLAN {query}", params)
+                    )
+                    assert "INDEX city-country (co_id=?" in plan
+                    assert "SCAN d" not in plan
+
+    def test_update_adds_country_index(self, tmp_db, loader, data_dir):
+        with tmp_db.connection(commit=True) as con:
+            con.execute('DROP INDEX "city-country"')
+
+        dbm.update(tmp_db, data_dir / "updates", make.load_admin1(loader("admin1")))
+        with tmp_db.connection() as con:
+            assert "city-country" in {
+                name
+                for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            }
+
+    def test_search_country_main(self, capsys, db):
+        dbm.db_main(db, self._args(db_search=True, timestr=["co:us,", "hawaii"]))
+        assert (
+            capsys.readouterr().out == "5849996 Lāhaina (Lahaina), Hawaii, US, Pacific/Honolulu\n"
+        )
 
-    def test_fetch_cities(self, loader):
+    def test_fetch_build_inputs(self, loader, tmp_path):
         size = 500
-        expect = HERE_DIR / f"cities{size}.txt"
-        expect.unlink(True)
-        url = make.GEONAMES_CITIES_URL_FMT.format(size)
+        cities_url = make.GEONAMES_CITIES_URL_FMT.format(size)
         with responses.RequestsMock() as mock:
             body = loader("cities500.zip", binary=True)
-            rsp = mock.add(responses.GET, url, body=body, status=200)
-            fn = make.fetch_cities(size, HERE_DIR)
-            assert fn == expect
-            assert rsp.call_count == 1
+            cities_rsp = mock.add(responses.GET, cities_url, body=body, status=200)
+            admin_rsp = mock.add(
+                responses.GET, make.GEONAMES_ADMIN1_URL, body=loader("admin1", binary=True)
+            )
+            filename, admin_1 = make.fetch_build_inputs(size, tmp_path)
+            assert filename == tmp_path / "cities500.zip"
+            assert admin_1 == make.load_admin1(loader("admin1"))
+            assert sorted(p.name for p in tmp_path.iterdir()) == [
+                "admin1CodesASCII.txt",
+                "cities500.zip",
+            ]
+
+            assert make.fetch_build_inputs(size, tmp_path)[0] == filename
+            assert cities_rsp.call_count == admin_rsp.call_count == 1
+
+        with make.open_geonames(filename) as fp:
+            assert len(list(make.process_geonames_txt(fp, 10_000))) == 7
+
+    def test_open_geonames(self, loader, tmp_path):
+        zip_filename = tmp_path / "cities500.zip"
+        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("cities500.txt", loader("cities"))
+
+        expect = list(make.process_geonames_txt(loader("cities").splitlines(), 0))
+        with make.open_geonames(zip_filename) as fp:
+            rows = make.process_geonames_txt(fp, 0)
+            assert next(rows) == expect[0]
+            assert list(rows) == expect[1:]
+
+        assert not (tmp_path / "cities500.txt").exists()
+
+    def test_iter_chunks(self):
+        fobj = io.BytesIO(b"a\tb\nccc\nd\n\nee")
+        chunks = list(make.iter_chunks(fobj, 3))
+        assert all(chunk.endswith(b"\n") for chunk in chunks[:-1])
+        assert b"".join(chunks) == b"a\tb\nccc\nd\n\nee"
+
+    def test_read_geonames(self, loader):
+        lines = loader("cities").splitlines()
+        expect = [make.geonames_record(line) for line in lines]
+        fobj = io.BytesIO(loader("cities", binary=True))
+        assert list(make.read_geonames(fobj, workers=2, chunk_size=512)) == expect
+
+        fobj = io.BytesIO(loader("cities", binary=True))
+        assert list(make.read_geonames(fobj, workers=1)) == expect
+
+    def test_geonames_columns(self, loader):
+        records = [make.geonames_record(line) for line in loader("cities").splitlines()]
+        columns = make.geonames_columns(iter(records))
+        for k, name in enumerate(make.GEONAMES_COLUMNS):
+            assert list(columns[name]) == [record[k] for record in records]
+
+        columns = make.geonames_columns(iter(()))
+        assert all(len(columns[name]) == 0 for name in make.GEONAMES_COLUMNS)
+
+    @pytest.mark.parametrize("pop", [0, 10_000])
+    def test_process_geonames_columns(self, loader, pop):
+        admin1 = make.load_admin1(loader("admin1"))
+        lines = loader("cities").splitlines()
+        columns = make.geonames_columns(map(make.geonames_record, lines))
+        expect = list(make.process_geonames_txt(lines, pop, admin1))
+        assert list(make.process_geonames_columns(columns, pop, admin1)) == expect
+
+    def test_load_geonames_columns(self, loader, tmp_path, monkeypatch):
+        filename = tmp_path / "cities500.txt"
+        filename.write_text(loader("cities"))
+        columns = make.load_geonames_columns(filename, workers=1)
+        (cache,) = tmp_path.glob("*.cols")
+        assert cache.name == f"cities500-{make.file_checksum(filename)}.cols"
+
+        def read_geonames(*args):
+            raise AssertionError("parsed again")
+
+        with monkeypatch.context() as m:
+            m.setattr(make, "read_geonames", read_geonames)
+            cached = make.load_geonames_columns(filename)
+
+        assert list(make.process_geonames_columns(cached, 0)) == list(
+            make.process_geonames_columns(columns, 0)
+        )
 
-            fn = make.fetch_cities(size, HERE_DIR)
-            assert fn == expect
-            assert rsp.call_count == 1
+        filename.write_text(loader("cities").splitlines(keepends=True)[0])
+        assert len(make.load_geonames_columns(filename, workers=1)["id"]) == 1
+        assert [p.name for p in tmp_path.glob("*.cols")] != [cache.name]
+        assert len(list(tmp_path.glob("*.cols"))) == 1
 
-            with expect.open() as fp:
-                data = make.process_geonames_txt(fp, 10_000)
+    def test_create_db_indexes(self, db):
+        with db.connection() as con:
+            indexes = {
+                name
+                for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            }
 
-            assert len(data) == 7
+        assert {"city-index", "city-name-key", "city-ascii-key"} <= indexes
 
-        expect.unlink(True)
+    def test_download_error(self, tmp_path):
+        url = "https://foo.com/cities500.zip"
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, url, status=404)
+            with pytest.raises(exceptions.WhenError, match=f"404: {url}"):
+                utils.download(url, tmp_path / "cities500.zip")
+
+        assert not list(tmp_path.iterdir())
 
     def test_fetch_admin_1(self, loader):
         expect = HERE_DIR / "admin1CodesASCII.txt"
@@ -263,6 +1073,212 @@ class TestDB:
         assert len(result) == 1
         assert result[0].tz == "Europe/Paris"
 
+    def test_db_search_fts_prefix(self, db):
+        result = db.search("new yo")
+        assert [r.id for r in result] == [5128581]
+
+        result = db.search("lahai")
+        assert [r.id for r in result] == [5849996]
+
+    def test_db_search_like_fallback(self, db):
+        like_db = dbm.client.DB(db.filename, fts=False)
+        assert [r.id for r in like_db.search("aastrich")] == [2751283]
+        assert db.search("aastrich") == []
+        assert like_db.search("paris") == db.search("paris")
+
+    def test_fts_match(self):
+        assert dbm.client.fts_match("new york") == '{name ascii} : ("new"* "york"*)'
+        assert dbm.client.fts_match(" - ") == '""'
+
+    def test_persistent_reader(self, db):
+        with db.connection() as con1, db.connection() as con2:
+            assert con1 is con2
+            assert con1.execute("PRAGMA query_only").fetchone() == (1,)
+            with pytest.raises(sqlite3.OperationalError):
+                con1.execute("DELETE FROM alias")
+
+        others = []
+        thread = threading.Thread(target=lambda: others.append(db._reader))
+        thread.start()
+        thread.join()
+        assert others[0] is not con1
+
+        db.close()
+        with db.connection() as con3:
+            assert con3 is not con1
+
+    def test_per_call_connection(self, db):
+        per_call = dbm.client.DB(db.filename, persistent=False)
+        with per_call.connection() as con1, per_call.connection() as con2:
+            assert con1 is not con2
+
+        assert per_call.search("maastricht") == db.search("maastricht")
+
+    def _query_plan(self, db, value, exact):
+        value, sub, co = db.parse_search(value)
+        with db.connection() as con:
+            sql, params = db.search_query(con, value, exact, sub, co)
+            return "\n".join(row[-1] for row in con.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+    def test_normalize(self):
+        assert dbm.client.normalize("Île-de-France") == "ILE-DE-FRANCE"
+        assert dbm.client.normalize("Lāhaina") == "LAHAINA"
+
+    def test_db_exact_search_accents(self, db):
+        result = db.search("lahaina, hawaii, us", exact=True)
+        assert [r.id for r in result] == [5849996]
+        assert db.search("Paris, ile-de-france, FR", exact=True)[0].id == 2988507
+
+    @pytest.mark.parametrize("value", ["paris", "paris,fr", "paris,maine,us"])
+    def test_db_exact_search_plan(self, plan_db, value):
+        plan = self._query_plan(plan_db, value, exact=True)
+        assert "SCAN" not in plan
+        assert "USING INDEX city-name-key" in plan
+        assert "USING INDEX city-ascii-key" in plan
+
+    @pytest.mark.parametrize("exact", [False, True])
+    def test_db_search_many(self, db, exact):
+        values = ["paris", "paris,fr", "seoul", "5128581", "nowhere", "paris"]
+        statements = []
+        db._reader.set_trace_callback(statements.append)
+        try:
+            result = db.search_many(values, exact)
+        finally:
+            db._reader.set_trace_callback(None)
+
+        assert sum("JOIN city_data c" in sql for sql in statements) == 1
+        assert list(result) == ["paris", "paris,fr", "seoul", "5128581", "nowhere"]
+        for value in result:
+            assert result[value] == db.search(value, exact)
+
+    def test_db_search_many_like(self, db):
+        like_db = dbm.client.DB(db.filename, fts=False)
+        assert like_db.search_many(["aastrich", "paris"]) == {
+            "aastrich": like_db.search("aastrich"),
+            "paris": like_db.search("paris"),
+        }
+
+    @pytest.mark.parametrize(
+        "value,expect",
+        [("maastrict", 2751283), ("Seoull", 1835848), ("new yrok city", 5128581)],
+    )
+    def test_db_fuzzy_search(self, db, value, expect):
+        assert db.search(value) == []
+        result = db.search(value, fuzzy=True)
+        assert result[0].id == expect
+
+    def test_db_fuzzy_search_co(self, db):
+        assert [r.id for r in db.search("pariss, us", fuzzy=True)] == [4974617]
+        assert db.search("xyzzy", fuzzy=True) == []
+
+    def test_fuzzy_population_tiebreak(self, db):
+        # Both Paris entries are equally similar, so the more populous comes first
+        result = db.search("paris", fuzzy=True)
+        assert [r.co for r in result[:2]] == ["FR", "US"]
+
+    def test_main_fuzzy(self, capsys, when):
+        when_main(["--search", "--fuzzy", "maastrict"], when)
+        assert capsys.readouterr().out.startswith("2751283 Maastricht")
+
+        with freeze_time("2025-02-03 22:00", tz_offset=0):
+            when_main(["--source", "utc", "--target", "seoull", "--fuzzy"], when)
+            assert "Seoul, KR" in capsys.readouterr().out
+
+    def test_nearest(self, db):
+        [(city, km)] = db.nearest(48.86, 2.35)
+        assert city.id == 2988507
+        assert km < 2
+
+        found = db.nearest(44.0, -70.0, limit=3)
+        assert [c.id for c, _ in found] == [4974617, 5128581, 4140963]
+        assert [km for _, km in found] == sorted(km for _, km in found)
+
+    def test_nearest_many(self, db, loader):
+        rows = make.process_geonames_txt(loader("cities").splitlines(), 0)
+        coords = {gid: (lat, lng) for gid, *_, lat, lng in rows}
+        points = [(-33.9, 18.4), (60.0, -179.9), (21.0, 179.0), (-89.9, 0.0), (37.5, 127.0)]
+        for (lat, lng), [(city, km)] in zip(points, db.nearest_many(points)):
+            expect = min(
+                (dbm.client.distance(lat, lng, *coord), gid) for gid, coord in coords.items()
+            )
+            assert (city.id, round(km, 6)) == (expect[1], round(expect[0], 6))
+
+    def test_near_boxes(self):
+        assert dbm.client.near_boxes(0, 179.5, 1) == [
+            (-1, 1, pytest.approx(178.5), 180.0),
+            (-1, 1, -180.0, pytest.approx(-179.5)),
+        ]
+        assert dbm.client.near_boxes(89.5, 0, 1) == [(88.5, 90.0, -180.0, 180.0)]
+
+    def test_nearest_invalid(self, db):
+        with pytest.raises(dbm.client.DBError, match="Invalid coordinates"):
+            db.nearest(91, 0)
+
+        for limit in (0, -1):
+            with pytest.raises(ValueError, match="limit must be at least 1"):
+                db.nearest(48.86, 2.35, limit)
+
+            with pytest.raises(ValueError, match="limit must be at least 1"):
+                db.nearest_many([(48.86, 2.35)], limit)
+
+    def test_zone_at(self, when):
+        zone = when.zone_at(48.86, 2.35)
+        assert zone.name == "Europe/Paris"
+        assert zone.city.id == 2988507
+        assert [z.name for z in when.zones_at([(37.5, 127.0), (40.7, -74.0)])] == [
+            "Asia/Seoul",
+            "America/New_York",
+        ]
+
+    def test_main_near(self, capsys, when):
+        when_main(["--near=50.85,5.69"], when)
+        assert capsys.readouterr().out.startswith("2751283 Maastricht, Limburg, NL")
+
+    @pytest.mark.parametrize("limit", ["0", "-1", "x"])
+    def test_main_invalid_limit(self, capsys, when, limit):
+        with pytest.raises(SystemExit):
+            when_main(["--search", "par", "--limit", limit], when)
+
+        assert "--limit: expected" in capsys.readouterr().err
+
+    def test_profile(self, plan_db):
+        with plan_db.profile() as profiler:
+            plan_db.search("paris")
+            plan_db.search("seoul")
+            plan_db.search_many(["paris", "maastricht", "nowhere"])
+
+        assert plan_db.profiler is None
+        assert len(profiler.queries) == 5
+        assert all(q.elapsed >= 0 and q.plan for q in profiler.queries)
+        assert profiler.queries[0].params == ("PARIS",)
+        assert profiler.queries[1].rows == 2
+
+        summary = profiler.summary()
+        assert sorted(s.count for s in summary) == [1, 2, 2]
+        assert sum(s.rows for s in summary) == 6
+        assert any("VALUES (?, ?, ?, ?, ?), ..." in s.shape for s in summary)
+        assert profiler.scans() == [s for s in summary if "SCAN q" in "".join(s.plan)]
+
+        report = profiler.report(total=1.0)
+        assert "alias-key" in report
+        assert report.splitlines()[-1].startswith("5 statements, ")
+
+    def test_query_shape(self):
+        sql = "SELECT *\n  FROM q\nWHERE x IN (VALUES (?, ?), (?, ?), (?, ?))"
+        assert dbm.client.query_shape(sql) == "SELECT * FROM q WHERE x IN (VALUES (?, ?), ...)"
+
+    def test_main_db_profile(self, capsys, when):
+        when_main(["--db-profile", "--source", "maastricht"], when)
+        captured = capsys.readouterr()
+        assert "Maastricht" in captured.out
+        assert "total ms" in captured.err
+        assert re.search(r"statements, .*ms of .*ms total \(\d+\.\d%\)", captured.err)
+
+    def test_main_db_search_ranked(self, capsys, db):
+        args = self._args(db_search=True, timestr=["paris"], db_limit=1, db_order="population")
+        dbm.db_main(db, args)
+        assert capsys.readouterr().out == "2988507 Paris, Île-de-France, FR, Europe/Paris\n"
+
     def test_main_db_search(self, capsys, when):
         argv = "--search maastricht".split()
         when_main(argv, when)
@@ -270,6 +1286,75 @@ class TestDB:
         assert captured.out == "2751283 Maastricht, Limburg, NL, Europe/Amsterdam\n"
 
 
+class TestCityIndex:
+    @pytest.fixture
+    def city_index(self, db, tmp_path):
+        return dbm.index.CityIndex(db.filename, snapshot=tmp_path / "when.idx")
+
+    @pytest.mark.parametrize("exact", [False, True])
+    @pytest.mark.parametrize(
+        "value",
+        ["paris", "paris,fr", "paris,maine,us", "new yo", "lahaina", "5128581", "nowhere", "-"],
+    )
+    def test_search(self, db, city_index, value, exact):
+        assert city_index.search(value, exact) == db.search(value, exact)
+
+    def test_search_many(self, db, city_index):
+        values = ["paris", "seoul", "paris,fr", "nowhere"]
+        assert city_index.search_many(values) == db.search_many(values)
+
+    def test_snapshot(self, db, city_index):
+        columns = city_index.columns
+        assert city_index.snapshot.exists()
+
+        reloaded = dbm.index.CityIndex(db.filename, snapshot=city_index.snapshot)
+        assert reloaded.is_fresh()
+        assert reloaded.load().keys() == columns.keys()
+        assert list(reloaded.columns["key"]) == list(columns["key"])
+        assert list(reloaded.columns["tz"].values) == list(columns["tz"].values)
+        assert reloaded.search("maastricht") == db.search("maastricht")
+
+    @pytest.mark.parametrize("size", [0, 5, 40, -3])
+    def test_corrupt_snapshot(self, db, city_index, size):
+        columns = city_index.columns
+        data = city_index.snapshot.read_bytes()
+        city_index.snapshot.write_bytes(data[:size] if size else b"WHENIDX0")
+
+        reloaded = dbm.index.CityIndex(db.filename, snapshot=city_index.snapshot)
+        assert reloaded.search("maastricht") == db.search("maastricht")
+        assert list(reloaded.columns["key"]) == list(columns["key"])
+        assert city_index.snapshot.read_bytes() == data
+
+    def test_add_alias_resets(self, db, city_index):
+        assert city_index.search("LAHAINA TOWN") == []
+        city_index.add_alias("LAHAINA TOWN", 5849996)
+        assert not city_index.snapshot.exists()
+        assert [c.id for c in city_index.search("lahaina town")] == [5849996]
+
+    def test_add_alt_names_resets(self, loader, tmp_path):
+        city_index = dbm.index.CityIndex(tmp_path / "alt.db")
+        admin1 = make.load_admin1(loader("admin1"))
+        city_index.create_db(make.process_geonames_txt(loader("cities").splitlines(), 0, admin1))
+        assert city_index.search("paname") == []
+        assert city_index.snapshot.exists()
+
+        assert city_index.add_alt_names([("Paname", 2988507, "fr")]) == 1
+        assert not city_index.snapshot.exists()
+        assert [c.id for c in city_index.search("paname")] == [2988507]
+        city_index.close()
+
+    def test_strings(self):
+        strings = dbm.index.Strings(["Lāhaina", "", "Seoul"])
+        assert list(strings) == ["Lāhaina", "", "Seoul"]
+        assert list(dbm.index.Strings.from_bytes(strings.to_bytes())) == list(strings)
+
+    def test_when(self, city_index):
+        when = When(Settings(name="NopeNopeNope"), db=city_index)
+        result = when.convert("Jan 10, 2023 4:30am", sources="New York City", targets="Seoul")
+        assert result[0].dt == datetime(2023, 1, 10, 18, 30, tzinfo=gettz("Asia/Seoul"))
+        assert result[0].zone.city.name == "Seoul"
+
+
 class TestIANA:
     def test_iana_src_iana_tgt(self, when):
         result = when.convert(
@@ -287,6 +1372,174 @@ class TestJSON:
         assert_nested_items_are_equal(result, expected)
 
 
+class TestAsync:
+    @pytest.fixture
+    def awhen(self, when):
+        awhen = AsyncWhen(when, max_workers=2)
+        yield awhen
+        awhen.close()
+
+    @pytest.mark.parametrize(
+        "sources,targets",
+        [(None, None), ("Lahaina", None), (None, ["Seoul", "paris"]), (["paris", "UTC"], "Seoul")],
+    )
+    def test_results(self, when, awhen, sources, targets):
+        timestamp = "Jan 19, 2024 22:00"
+        expect = when.results(timestamp, sources, targets)
+        result = asyncio.run(awhen.results(timestamp, sources, targets))
+        assert [(r.dt, r.zone.name, r.source and r.source.zone.name) for r in result] == [
+            (r.dt, r.zone.name, r.source and r.source.zone.name) for r in expect
+        ]
+
+    def test_as_json(self, when, awhen):
+        args = ("Jan 19, 2024 22:00", "Lahaina", "Seoul")
+        assert asyncio.run(awhen.as_json(*args)) == when.as_json(*args)
+
+    def test_complete(self, when, awhen):
+        assert asyncio.run(awhen.complete("se", 2)) == when.complete("se", 2)
+
+    def test_concurrent(self, when, awhen, monkeypatch):
+        threads = set()
+        search_many = when.db.search_many
+
+        def record(*args):
+            threads.add(threading.current_thread())
+            return search_many(*args)
+
+        monkeypatch.setattr(when.db, "search_many", record)
+        targets = ["Seoul", "paris", "maastricht", "New York City"] * 25
+
+        async def run():
+            return await asyncio.gather(
+                *(awhen.results("2024-01-19 22:00", "UTC", target) for target in targets)
+            )
+
+        results = asyncio.run(run())
+        assert threading.main_thread() not in threads
+        assert len(threads) <= 2
+        assert [r[0].zone.city.name for r in results] == [
+            when.results("2024-01-19 22:00", "UTC", target)[0].zone.city.name for target in targets
+        ]
+
+    def test_errors(self, awhen):
+        with pytest.raises(exceptions.UnknownSourceError):
+            asyncio.run(awhen.results("", "nowhere-at-all"))
+
+        assert asyncio.run(awhen.zone_at(37.5, 127.0)).name == "Asia/Seoul"
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Serve ``server.files`` ({path: body}) with ETags and ``Range``/``If-Range`` support,
+    failing the first requests as ``server.faults`` ({path: [fault, ...]}) says: an
+    ``HTTPStatus``, or a number of bytes to send before dropping the connection
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+
+        body, etag = server.files[self.path], f'"{len(server.files[self.path])}-v1"'
+        fault = server.faults.get(self.path, []) and server.faults[self.path].pop(0)
+        if isinstance(fault, HTTPStatus):
+            self.send_error(fault)
+            return
+
+        start = 0
+        if (match := re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))) and self.headers.get(
+            "If-Range"
+        ) == etag:
+            start = int(match[1])
+
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+
+        self.end_headers()
+        self.wfile.write(body[start : start + fault] if fault else body[start:])
+        if fault:
+            self.close_connection = True
+
+
+class TestDownload:
+    BODY = bytes(range(256)) * 1000
+
+    @pytest.fixture
+    def server(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        server.files, server.faults, server.requests = {"/cities.zip": self.BODY}, {}, []
+        server.url = f"http://127.0.0.1:{server.server_port}"
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    @pytest.fixture
+    def downloader(self):
+        with utils.Downloader(retries=3, backoff=0, timeout=5, chunk_size=1000) as downloader:
+            yield downloader
+
+    def test_resume(self, server, downloader, tmp_path):
+        server.faults["/cities.zip"] = [100_000, HTTPStatus.SERVICE_UNAVAILABLE, 50_000]
+        filename = tmp_path / "cities.zip"
+        assert downloader.download(f"{server.url}/cities.zip", filename) == filename
+        assert filename.read_bytes() == self.BODY
+        assert [h.get("Range") for _, h in server.requests] == [
+            None,
+            "bytes=100000-",
+            "bytes=100000-",
+            "bytes=150000-",
+        ]
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["cities.zip"]
+
+    def test_changed_etag(self, server, downloader, tmp_path):
+        filename = tmp_path / "cities.zip"
+        filename.with_name("cities.zip.part").write_bytes(b"stale")
+        filename.with_name("cities.zip.etag").write_text('"old"')
+        downloader.download(f"{server.url}/cities.zip", filename)
+        assert filename.read_bytes() == self.BODY
+        assert server.requests[0][1]["If-Range"] == '"old"'
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["cities.zip"]
+
+    def test_errors(self, server, downloader, tmp_path):
+        with pytest.raises(exceptions.WhenError, match="404: .*/missing.zip"):
+            downloader.download(f"{server.url}/missing.zip", tmp_path / "missing.zip")
+
+        server.faults["/cities.zip"] = [1000] * 4
+        with pytest.raises(exceptions.WhenError, match="failed after 4 attempts"):
+            downloader.download(f"{server.url}/cities.zip", tmp_path / "cities.zip")
+
+        assert (tmp_path / "cities.zip.part").stat().st_size == 4000
+        assert len(server.requests) == 5
+
+    def test_download_all(self, server, downloader, tmp_path):
+        server.files["/admin1.txt"] = b"admin1"
+        server.faults["/admin1.txt"] = [2]
+        (tmp_path / "done.txt").write_bytes(b"done")
+        downloads = {
+            f"{server.url}/cities.zip": tmp_path / "cities.zip",
+            f"{server.url}/admin1.txt": tmp_path / "admin1.txt",
+            f"{server.url}/done.txt": tmp_path / "done.txt",
+        }
+        assert downloader.download_all(downloads) == list(downloads.values())
+        assert (tmp_path / "cities.zip").read_bytes() == self.BODY
+        assert (tmp_path / "admin1.txt").read_bytes() == b"admin1"
+        assert sorted(path for path, _ in server.requests) == [
+            "/admin1.txt",
+            "/admin1.txt",
+            "/cities.zip",
+        ]
+
+
 class TestCity:
     def test_string(self):
         city = dbm.client.City(1, "foo", "foo", "foobar", "FO", "UTC")